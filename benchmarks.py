@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the most expensive stages of download_data_edr3.py on synthetic fields of increasing number of stars. Results are appended to a JSON lines file, together with the commit, so the timings of different commits can be compared.
+"""
+
+import sys
+import os
+import gc
+import io
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+import contextlib
+
+import numpy as np
+import pandas as pd
+
+import download_data_edr3 as pipeline
+
+
+# Centre of the synthetic field and distance of the synthetic cluster (kpc)
+field_ra, field_dec, field_radius, field_distance = 40., -34.4, 0.3, 20.
+
+
+def git_commit():
+   """
+   This routine returns the commit of the working tree, and whether it has uncommitted changes.
+   """
+
+   path = os.path.dirname(os.path.abspath(__file__))
+   try:
+      commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = path, stderr = subprocess.DEVNULL).decode().strip()
+      dirty = len(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd = path, stderr = subprocess.DEVNULL).strip()) > 0
+   except (OSError, subprocess.CalledProcessError):
+      commit, dirty = 'unknown', False
+
+   return commit, dirty
+
+
+def synthetic_field(n_stars, seed = 0):
+   """
+   This routine returns a synthetic Gaia table of about n_stars stars with all the columns of the pipeline query, and the corrections applied by main.
+   """
+
+   query, quality_cols = pipeline.columns_n_conditions('gaiaedr3.gaia_source', 'cone', pipeline.gaia_astrometric_cols, pipeline.gaia_photometric_cols, pipeline.gaia_quality_cols, field_ra, field_dec, max_radius = field_radius,
+                                                       min_parallax = -10, max_parallax = 10, min_pmra = -30, max_pmra = 30, min_pmdec = -30, max_pmdec = 30)
+
+   table = pipeline.synthetic_gaia_query(query, 10., 21., n_stars = n_stars, cluster_pm = [1., -1.], distance = field_distance, seed = seed)
+   table['corrected_flux_excess_factor'] = pipeline.correct_flux_excess_factor(table['bp_rp'], table['phot_bp_rp_excess_factor'])
+
+   return table.set_index('source_id', drop = False)
+
+
+def synthetic_isochrones(n_isochrones, n_points = 300, seed = 0):
+   """
+   This routine returns n_isochrones toy isochrones, shifted in colour, with the columns of read_isochrones.
+   """
+
+   rng = np.random.default_rng(seed)
+
+   isochrones = []
+   for shift in rng.normal(0, 0.03, n_isochrones):
+      gmag_0 = np.linspace(-3., 8., n_points)
+      bp_rp_0 = pipeline.synthetic_isochrone_color(gmag_0) + shift
+      isochrones.append(pd.DataFrame({'evolutionary_state': np.where(gmag_0 < 3., 3., 1.), 'Mass': np.linspace(0.9, 0.3, n_points), 'gmag_0': gmag_0, 'bpmag_0': gmag_0 + 0.45*bp_rp_0, 'rpmag_0': gmag_0 - 0.55*bp_rp_0}))
+
+   return isochrones
+
+
+def synthetic_hst_image(filename, ra, dec):
+   """
+   This routine writes a minimal ACS/WFC-like FITS file, with the WCS of its two chips in the extensions read by find_stars_to_align.
+   """
+   from astropy.io import fits
+
+   hdus = [fits.PrimaryHDU()]
+   for ii in range(1, 7):
+      header = fits.Header()
+      if ii in [2, 5]:
+         # Two chips of 202x101 arcsec, one above the other
+         chip_dec = dec + (50.5 if ii == 2 else -50.5)/3600.
+         header.update({'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN', 'CRVAL1': ra, 'CRVAL2': chip_dec, 'CRPIX1': 8.5, 'CRPIX2': 4.5,
+                        'CD1_1': -202./16/3600., 'CD1_2': 0., 'CD2_1': 0., 'CD2_2': 101./8/3600.})
+      hdus.append(fits.ImageHDU(data = np.zeros((8, 16), dtype = np.float32), header = header))
+
+   fits.HDUList(hdus).writeto(filename, overwrite = True)
+
+
+def synthetic_matches(table, n_images = 4, seed = 0):
+   """
+   This routine returns the concatenated matches of n_images HST images, as launch_xym2pm_Gaia averages them: one row per star and image, with the star as index.
+   """
+
+   rng = np.random.default_rng(seed)
+
+   matches = []
+   for ii in range(n_images):
+      filter = ['F606W', 'F814W'][ii % 2]
+      t_baseline = rng.uniform(5, 15)
+      q_hst = np.clip(0.02*10**(0.15*(table.gmag.values-15.)), 0.01, 0.9)
+      pm_error = q_hst*50.*0.85/t_baseline
+
+      matches.append(pd.DataFrame({filter: table.gmag.values - 26. + rng.normal(0, 0.02, len(table)), '%s_error'%filter: q_hst,
+                                   'relative_hst_gaia_pmra': table.pmra.values - 1. + rng.normal(0, pm_error), 'relative_hst_gaia_pmra_error': pm_error,
+                                   'relative_hst_gaia_pmdec': table.pmdec.values + 1. + rng.normal(0, pm_error), 'relative_hst_gaia_pmdec_error': pm_error,
+                                   'gaia_ra_uncertaintity': table.ra_error.values/t_baseline, 'gaia_dec_uncertaintity': table.dec_error.values/t_baseline}, index = table.index))
+
+   return pd.concat(matches, sort = True)
+
+
+def setup_stage(stage, table, path):
+   """
+   This routine prepares the inputs of a stage and returns a function that runs it, so only the stage itself is timed. Tables modified by the stage are copied in every run.
+   """
+
+   if stage == 'plot_fields':
+      import matplotlib.pyplot as plt
+      obs_table, data_products_by_obs = pipeline.synthetic_mast_tables(field_ra, field_dec, radius = 0.1)
+      def run():
+         pipeline.plot_fields(table.loc[:, ['ra', 'dec']], obs_table.copy(), path, name = path+'plot_fields.png')
+         plt.close('all')
+
+   elif stage == 'find_stars_to_align':
+      synthetic_hst_image(path+'jsyn00001_flc.fits', field_ra, field_dec)
+      def run():
+         pipeline.find_stars_to_align(table.loc[:, ['ra', 'dec']], path+'jsyn00001_flc.fits')
+
+   elif stage == 'combine_isochrones':
+      # Many Ages and metallicities are combined in large fields
+      isochrones = synthetic_isochrones(max(1, len(table)//10000))
+      def run():
+         pipeline.combine_isochrones(isochrones)
+
+   elif stage == 'cmd_cleaning':
+      isochrones_cmd = pipeline.combine_isochrones(synthetic_isochrones(1))
+      def run():
+         pipeline.cmd_cleaning(table, isochrones_cmd, distance = field_distance, AV = 0.1, plots = False)
+
+   elif stage == 'pm_cleaning_GMM_recursive':
+      def run():
+         pipeline.pm_cleaning_GMM_recursive(table, ['pmra', 'pmdec', 'parallax'], data_0 = [1., -1., 1./field_distance], n_components = 1, plots = False)
+
+   elif stage == 'grouped_weighted_avg_err':
+      matches = synthetic_matches(table)
+      def run():
+         pipeline.grouped_weighted_avg_err(matches)
+
+   elif stage == 'weighted_avg_err_groupby':
+      # The groupby-apply averaging of the matches, as it was done before grouped_weighted_avg_err
+      matches = synthetic_matches(table)
+      def run():
+         matches.groupby(level = 0).apply(pipeline.weighted_avg_err)
+
+   elif stage == 'absolute_pm':
+      averaged = pipeline.grouped_weighted_avg_err(synthetic_matches(table))
+      averaged['relative_hst_gaia_pmra_mean_error'] = np.sqrt(averaged['relative_hst_gaia_pmra_mean_error']**2 + averaged['gaia_ra_uncertaintity_mean']**2)
+      averaged['relative_hst_gaia_pmdec_mean_error'] = np.sqrt(averaged['relative_hst_gaia_pmdec_mean_error']**2 + averaged['gaia_dec_uncertaintity_mean']**2)
+      Gaia_table_hst = table.loc[:, ['pmra', 'pmra_error', 'pmdec', 'pmdec_error']].join(averaged)
+      def run():
+         pipeline.absolute_pm(Gaia_table_hst)
+
+   elif stage == 'clean_photometry':
+      def run():
+         pipeline.clean_photometry(table.gmag, table.corrected_flux_excess_factor)
+
+   elif stage == 'read_csv':
+      table.to_csv(path+'Gaia_table.csv', index = False)
+      def run():
+         pd.read_csv(path+'Gaia_table.csv')
+
+   elif stage == 'read_parquet':
+      table.to_parquet(path+'Gaia_table.parquet', index = False)
+      def run():
+         pd.read_parquet(path+'Gaia_table.parquet')
+
+   return run
+
+
+stages = ['plot_fields', 'find_stars_to_align', 'combine_isochrones', 'cmd_cleaning', 'pm_cleaning_GMM_recursive', 'grouped_weighted_avg_err', 'weighted_avg_err_groupby', 'absolute_pm', 'clean_photometry', 'read_csv', 'read_parquet']
+
+
+def time_stage(run, repeats = 3, max_time = 300.):
+   """
+   This routine runs a stage repeats times, or until max_time (s) is exceeded, and returns the wall times of every run.
+   """
+
+   times = []
+   while (len(times) < repeats) and (sum(times) < max_time):
+      gc.collect()
+      start = time.perf_counter()
+      run()
+      times.append(time.perf_counter() - start)
+
+   return times
+
+
+def run_benchmarks(sizes, stages_to_run, repeats = 3, max_time = 300., seed = 0, verbose = False):
+   """
+   This routine times every stage for every number of stars. A stage is skipped for a field when its time with the previous field, extrapolated linearly with the number of stars, is longer than max_time.
+   """
+   import matplotlib
+   matplotlib.use('Agg')
+
+   results = []
+   time_per_star = {}
+   with tempfile.TemporaryDirectory() as path:
+      for n_stars in sorted(sizes):
+         table = synthetic_field(n_stars, seed = seed)
+         print('-->%i stars (%i after the query conditions).'%(n_stars, len(table)))
+
+         for stage in stages_to_run:
+            result = {'stage': stage, 'n_stars': n_stars, 'n_rows': len(table), 'repeats': 0, 'best_time': None, 'median_time': None, 'status': 'ok'}
+
+            expected_time = time_per_star.get(stage, 0.)*n_stars
+            if expected_time > max_time:
+               result['status'] = 'skipped: expected to take %i s, more than %s s'%(expected_time, max_time)
+            else:
+               output = sys.stdout if verbose else io.StringIO()
+               try:
+                  with contextlib.redirect_stdout(output):
+                     times = time_stage(setup_stage(stage, table, path+'/'), repeats = repeats, max_time = max_time)
+                  result.update({'repeats': len(times), 'best_time': min(times), 'median_time': float(np.median(times))})
+                  time_per_star[stage] = min(times)/n_stars
+               except ImportError as error:
+                  # Optional dependencies, e.g. descartes or pyarrow
+                  result['status'] = 'skipped: %s'%str(error).splitlines()[0]
+
+            if result['best_time'] is not None:
+               print('   %-26s %10.3f s'%(stage, result['best_time']))
+            else:
+               print('   %-26s %s'%(stage, result['status']))
+
+            results.append(result)
+
+   return results
+
+
+def save_results(results, results_filename):
+   """
+   This routine appends the results to the JSON lines file, with the commit, date and machine where they were obtained.
+   """
+
+   commit, dirty = git_commit()
+   run = {'commit': commit, 'dirty': dirty, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': platform.node(), 'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__}
+
+   with open(results_filename, 'a') as f:
+      for result in results:
+         f.write(json.dumps({**run, **result})+'\n')
+
+   return commit
+
+
+def compare_results(results, results_filename, reference, tolerance = 1.2, any_host = False):
+   """
+   This routine compares the results with the latest ones of the reference commit in the results file, obtained in the same machine unless any_host. Stages slower than tolerance times the reference are flagged.
+   """
+
+   try:
+      previous = pd.read_json(results_filename, lines = True, dtype = {'commit': str})
+   except ValueError:
+      previous = pd.DataFrame()
+
+   if len(previous) > 0:
+      previous = previous.loc[previous.commit.str.startswith(reference) & previous.best_time.notnull()]
+      if not any_host:
+         previous = previous.loc[previous.host == platform.node()]
+
+   if len(previous) == 0:
+      print('-->No results of %s to compare with.'%reference)
+      return 0
+
+   previous = previous.sort_values(by = 'date').groupby(['stage', 'n_stars']).best_time.last()
+
+   print('\nComparison with %s (ratio of best times):'%reference)
+   n_slower = 0
+   for result in results:
+      key = (result['stage'], result['n_stars'])
+      if (result['best_time'] is None) or (key not in previous.index):
+         continue
+      ratio = result['best_time'] / previous.loc[key]
+      flag = ''
+      if ratio > tolerance:
+         flag = 'SLOWER'
+         n_slower += 1
+      print('   %-26s %9i %8.2f %s'%(result['stage'], result['n_stars'], ratio, flag))
+
+   return n_slower
+
+
+def parse_args(argv):
+   """
+   This routine reads the command line arguments.
+   """
+
+   parser = argparse.ArgumentParser(description = 'Times the most expensive stages of download_data_edr3.py on synthetic fields of increasing size, and compares them with the results of other commits.')
+   parser.add_argument('--sizes', type = int, nargs = '+', default = [1000, 100000, 1000000], help = 'Number of stars of the synthetic fields. Default is 1000 100000 1000000.')
+   parser.add_argument('--stages', type = str, nargs = '+', default = stages, choices = stages, metavar = 'STAGE', help = 'Stages to time, among %s. Default is all of them.'%', '.join(stages))
+   parser.add_argument('--repeats', type = int, default = 3, help = 'Number of runs of every stage. The best time is kept. Default is 3.')
+   parser.add_argument('--max_time', type = float, default = 300., help = 'Time (s) after which a stage is not repeated. Stages expected to take longer, extrapolating their time with less stars, are not run. Default is 300.')
+   parser.add_argument('--seed', type = int, default = 0, help = 'Seed of the synthetic data. Default is 0.')
+   parser.add_argument('--results', type = str, default = 'benchmark_results.jsonl', help = 'File where the results are appended. Default is benchmark_results.jsonl.')
+   parser.add_argument('--save', type = pipeline.str2bool, default = True, help = 'Whether to append the results to the results file. Default is True.')
+   parser.add_argument('--compare', type = str, default = None, help = 'Commit to compare with, from the results file. Default is None.')
+   parser.add_argument('--tolerance', type = float, default = 1.2, help = 'Stages slower than tolerance times the compared commit are flagged, and the script exits with error. Default is 1.2.')
+   parser.add_argument('--any_host', type = pipeline.str2bool, default = False, help = 'Compare with results obtained in other machines. Default is False.')
+   parser.add_argument('--verbose', type = pipeline.str2bool, default = False, help = 'Show the output of the stages. Default is False.')
+
+   return parser.parse_args(argv)
+
+
+def main(argv):
+   """
+   This routine runs the benchmarks.
+   """
+
+   args = parse_args(argv)
+
+   results = run_benchmarks(args.sizes, args.stages, repeats = args.repeats, max_time = args.max_time, seed = args.seed, verbose = args.verbose)
+
+   n_slower = 0
+   if args.compare is not None:
+      n_slower = compare_results(results, args.results, args.compare, tolerance = args.tolerance, any_host = args.any_host)
+
+   if args.save:
+      commit = save_results(results, args.results)
+      print('\n-->Results of %s saved in %s.'%(commit, args.results))
+
+   if n_slower > 0:
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+   main(sys.argv[1:])
@@ -11,28 +11,9 @@ import warnings
 import numpy as np
 import pandas as pd
 
-import matplotlib.pyplot as plt
-from matplotlib.widgets import LassoSelector
-from matplotlib.path import Path
-
-from sklearn.utils.validation import check_is_fitted
-from sklearn import mixture
-
-from astropy.table import Table
-from astropy.io import fits
-from astropy.wcs import WCS
-from astropy.utils.data import get_pkg_data_filename
-from astropy.time import Time
-from astropy.coordinates import match_coordinates_sky
-from astropy.wcs.utils import proj_plane_pixel_scales
-from astropy.visualization import (MinMaxInterval, SqrtStretch, ImageNormalize, ManualInterval)
-import astropy.units as u
-from astropy.coordinates import SkyCoord
-
-from scipy import stats
 from math import log10, floor
 
-from zero_point import zpt
+# Heavy dependencies (matplotlib, sklearn, astropy, scipy, zero_point) are imported within the routines that use them, so the script starts fast. Import time can be checked with: python -X importtime download_data_edr3.py --help
 
 
 def correct_gband(bp_rp, astrometric_params_solved, phot_g_mean_mag, phot_g_mean_flux):
@@ -145,7 +126,54 @@ def round_significant(x, ex, sig=1):
    return round(x, significant), round(ex, significant)
 
 
-def manual_select_from_cmd(color, mag):
+def load_cmd_polygon(polygon_filename):
+   """
+   This routine reads the vertices of a CMD selection previously saved with save_cmd_polygon.
+   """
+   from matplotlib.path import Path
+
+   return Path(np.loadtxt(polygon_filename, ndmin = 2))
+
+
+def save_cmd_polygon(polygon_filename, path, color_name = 'color', mag_name = 'mag'):
+   """
+   This routine saves the vertices of a CMD selection so it can be replayed in later runs.
+   """
+
+   np.savetxt(polygon_filename, path.vertices, fmt = '%.6f', header = '%s %s'%(color_name.replace(' ', ''), mag_name.replace(' ', '')))
+
+
+def cmd_polygon_filename(polygons_path, color_name, mag_name, iteration = None):
+   """
+   This routine returns the name of the file containing the CMD selection for the given color, magnitude and, optionally, iteration.
+   """
+
+   if polygons_path is None:
+      return None
+
+   if iteration is None:
+      iteration_str = ''
+   else:
+      iteration_str = '_it%i'%iteration
+
+   return os.path.join(polygons_path, 'CMD_%s_vs_%s%s.txt'%(color_name.replace(' ', ''), mag_name.replace(' ', ''), iteration_str))
+
+
+def manual_select_from_cmd(color, mag, polygon_filename = None, interactive = True, reuse = True):
+   """
+   This routine selects stars in the CMD. If polygon_filename exists and reuse is True, the saved selection is applied. Otherwise the user selects the stars with a lasso, which is then saved in polygon_filename, unless interactive is False, in which case all stars are selected.
+   """
+   import matplotlib.pyplot as plt
+   from matplotlib.widgets import LassoSelector
+   from matplotlib.path import Path
+
+   if reuse and (polygon_filename is not None) and os.path.isfile(polygon_filename):
+      print('Using CMD selection from %s'%polygon_filename)
+      return load_cmd_polygon(polygon_filename).contains_points(np.array([color, mag]).T)
+
+   if not interactive:
+      print('WARNING: No CMD selection available for %s vs %s in non-interactive mode. Using all stars.'%(color.name, mag.name))
+      return [True]*len(mag)
 
    class SelectFromCollection(object):
       """
@@ -172,6 +200,7 @@ def manual_select_from_cmd(color, mag):
 
       def onselect(self, verts):
          path = Path(verts)
+         self.path = path
          self.ind = np.nonzero(path.contains_points(self.xys))[0]
          self.selection = path.contains_points(self.xys)
          self.fc[:, -1] = self.alpha_other
@@ -213,6 +242,8 @@ def manual_select_from_cmd(color, mag):
 
    input("Once your selection is made, please press enter to continue.")
    try:
+      if polygon_filename is not None:
+         save_cmd_polygon(polygon_filename, selector.path, color_name = color.name, mag_name = mag.name)
       return selector.selection
    except:
       return [True]*len(mag)
@@ -332,64 +363,83 @@ def pre_clean_data(phot_g_mean_mag, corrected_flux_excess_factor, ruwe, ipd_gof_
    return labels_photometric & labels_astrometric
 
 
-def remove_jobs():
+def remove_jobs(Gaia, jobs = None):
    """
-   This routine removes jobs from the Gaia archive server.
+   This routine removes jobs from the Gaia archive server, all of them with a single request. By default, all the asynchronous jobs of the user are removed.
    """
 
-   list_jobs = []
-   for job in Gaia.list_async_jobs():
-      list_jobs.append(job.get_jobid())
-   
-   Gaia.remove_jobs(list_jobs)
+   if jobs is None:
+      jobs = [job.get_jobid() for job in Gaia.list_async_jobs()]
+
+   if len(jobs) > 0:
+      Gaia.remove_jobs(list(jobs))
+
 
+# Gaia archive sessions of each process, by (process id, user). Forked workers inherit the sessions of their parent, but they open their own ones.
+gaia_sessions_cache = {}
 
-def gaia_log_in(gaia_user = None, gaia_paswd = None):
+
+def gaia_log_in(gaia_user = None, gaia_paswd = None, interactive = True, keep_session = False):
    """
-   This routine log in to the Gaia archive.
+   This routine log in to the Gaia archive and returns the session, and the user and password used. If keep_session, the session is kept open and reused by the next calls of the same process (e.g. by the next Gaia queries, or the next targets in service mode).
    """
 
-   from astroquery.gaia import Gaia
+   from astroquery.gaia import GaiaClass
    import getpass
 
+   if keep_session and ((os.getpid(), gaia_user) in gaia_sessions_cache):
+      return gaia_sessions_cache[(os.getpid(), gaia_user)], gaia_user, gaia_paswd
+
+   Gaia = GaiaClass()
    while True:
       try:
          Gaia.login(user=gaia_user, password=gaia_paswd)
          print("Welcome to the Gaia server!")
          break
       except:
+         if not interactive:
+            print("Could not log in to the Gaia archive. Please check --gaia_user and --gaia_paswd.\nExiting now.")
+            sys.exit(1)
          print("Please introduce username and password")
          gaia_user = input("Gaia username: ")
          gaia_paswd = getpass.getpass(prompt='Gaia password: ') 
 
-   return Gaia
+   if keep_session:
+      gaia_sessions_cache[(os.getpid(), gaia_user)] = Gaia
+
+   return Gaia, gaia_user, gaia_paswd
+
 
+def gaia_log_out(gaia_user = None):
+   """
+   This routine closes the Gaia archive session of the user opened by this process, if any.
+   """
+
+   Gaia = gaia_sessions_cache.pop((os.getpid(), gaia_user), None)
+   if Gaia is not None:
+      Gaia.logout()
 
-def gaia_query(Gaia, query, min_gmag, max_gmag, norm_uwe, test_mode, save_individual_queries, load_existing, name, n, n_total):
+
+def gaia_query(catalog, query, min_gmag, max_gmag, norm_uwe, save_individual_queries, load_existing, name, n, n_total):
    """
-   This routine launch the query to the Gaia archive.
+   This routine launch the query to the Gaia catalog backend: the Gaia archive (GaiaArchive), a local copy of the Gaia source table (ParquetCatalog) or, in test mode, synthetic stars (SyntheticCatalog).
    """
 
    query = query + " AND (phot_g_mean_mag > %.4f) AND (phot_g_mean_mag <= %.4f)"%(min_gmag, max_gmag)
 
-   if not test_mode:
-      
+   with StageReport('gaia_query', min_gmag = min_gmag, max_gmag = max_gmag, catalog = type(catalog).__name__) as stage:
       individual_query_filename = './%s/Gaia/individual_queries/%s_G_%.4f_%.4f.csv'%(name, name, min_gmag, max_gmag)
 
       if os.path.isfile(individual_query_filename) and load_existing:
          result = pd.read_csv(individual_query_filename)
 
       else:
-         job = Gaia.launch_job_async(query)
-         result = job.get_results()
-         removejob = Gaia.remove_jobs([job.jobid])
-         result = result.to_pandas()
+         result = catalog.query(query, min_gmag, max_gmag)
 
          if save_individual_queries:
             result.to_csv(individual_query_filename, index = False)
 
-   else:
-      result = pd.DataFrame()
+      stage['rows_out'] = len(result)
    
    print('\n')
    print('----------------------------')
@@ -419,6 +469,14 @@ def gaia_multi_query_run(args):
    return gaia_query(*args)
 
 
+# Columns of the Gaia query
+gaia_astrometric_cols = 'l, b, ra, ra_error, dec, dec_error, parallax, parallax_error, pmra, pmra_error, pmdec, pmdec_error, dr2_radial_velocity, dr2_radial_velocity_error, ra_dec_corr, ra_parallax_corr, ra_pmra_corr, ra_pmdec_corr, dec_parallax_corr, dec_pmra_corr, dec_pmdec_corr, parallax_pmra_corr, parallax_pmdec_corr, pmra_pmdec_corr'
+
+gaia_photometric_cols = 'phot_g_mean_flux, phot_g_mean_mag AS gmag, (1.086*phot_g_mean_flux_error/phot_g_mean_flux) AS gmag_error, phot_bp_mean_mag AS bpmag, (1.086*phot_bp_mean_flux_error/phot_bp_mean_flux) AS bpmag_error, phot_rp_mean_mag AS rpmag, (1.086*phot_rp_mean_flux_error/phot_rp_mean_flux) AS rpmag_error, bp_rp, sqrt( power( (1.086*phot_bp_mean_flux_error/phot_bp_mean_flux), 2) + power( (1.086*phot_rp_mean_flux_error/phot_rp_mean_flux), 2) ) as bp_rp_error'
+
+gaia_quality_cols = 'ecl_lat, pseudocolour, nu_eff_used_in_astrometry, visibility_periods_used, astrometric_excess_noise_sig, astrometric_params_solved, astrometric_n_good_obs_al, astrometric_chi2_al, phot_bp_rp_excess_factor, ruwe, (phot_bp_n_blended_transits+phot_rp_n_blended_transits) *1.0 / (phot_bp_n_obs + phot_rp_n_obs) AS beta, ipd_gof_harmonic_amplitude, phot_bp_n_contaminated_transits, phot_rp_n_contaminated_transits'
+
+
 def columns_n_conditions(source_table, search_type, astrometric_cols, photometric_cols, quality_cols, ra, dec, min_radius = 0.5, max_radius = 1.0, width = 1.0, height = 1.0, max_gmag_error = 0.5, max_rpmag_error = 0.5, max_bpmag_error = 0.5, min_parallax = -2, max_parallax = 1, max_parallax_error = 1.0, min_pmra = -6, max_pmra = 6, max_pmra_error = 1.0, min_pmdec = -6, max_pmdec = 6, max_pmdec_error = 1.0):
 
    """
@@ -452,282 +510,1031 @@ def columns_n_conditions(source_table, search_type, astrometric_cols, photometri
    return query, quality_cols
    
 
-def incremental_query(query, area, min_gmag = 10.0, max_gmag = 19.5, norm_uwe = True, use_parallel = True, test_mode = False, save_individual_queries = False, load_existing = False, name = 'output', gaia_user = None, gaia_paswd = None):
-
+def split_outside_parentheses(text, separator = ','):
    """
-   This routine search the Gaia archive and downloads the stars using parallel workers.
+   This routine splits an ADQL text by the separator, ignoring the separators within parentheses (e.g. the arguments of functions).
    """
 
-   from multiprocessing import Pool, cpu_count
+   parts, depth, start = [], 0, 0
+   for ii, char in enumerate(text):
+      if char == '(':
+         depth += 1
+      elif char == ')':
+         depth -= 1
+      elif (depth == 0) and (text[ii:ii+len(separator)].upper() == separator.upper()):
+         parts.append(text[start:ii].strip())
+         start = ii+len(separator)
+   parts.append(text[start:].strip())
 
-   if not test_mode:
-      Gaia = gaia_log_in(gaia_user = gaia_user, gaia_paswd = gaia_paswd)
-   else:
-      Gaia = None
+   return [part for part in parts if len(part) > 0]
 
-   mag_nodes = get_mag_bins(min_gmag, max_gmag, area)
-   n_total = len(mag_nodes)
-   
-   if (n_total > 1) and use_parallel:
 
-      print("Executing %s jobs."%(n_total-1))
+def query_expressions(query):
+   """
+   This routine returns the expressions selected by an ADQL query, and the names of their columns in the results.
+   """
+   import re
 
-      nproc = int(np.min((n_total, 20, cpu_count()*2)))
+   selection = query[query.index('SELECT ')+len('SELECT '):query.index(' FROM ')]
 
-      pool = Pool(nproc-1)
+   expressions = []
+   for column in split_outside_parentheses(selection, ','):
+      expression = re.split(r'\s+as\s+', column, flags = re.IGNORECASE)
+      expressions.append((expression[0].strip(), expression[-1].strip()))
 
-      args = []
-      for n, node in enumerate(range(n_total-1)):
-         args.append((Gaia, query, mag_nodes[n+1], mag_nodes[n], norm_uwe, test_mode, save_individual_queries, load_existing, name, n, n_total))
+   return expressions
 
-      tables_gaia_queries = pool.map(gaia_multi_query_run, args)
 
-      tables_gaia = [results[0] for results in tables_gaia_queries]
-      queries = [results[1] for results in tables_gaia_queries]
+def query_columns(query):
+   """
+   This routine returns the names of the columns selected by an ADQL query, as they appear in the results.
+   """
 
-      result_gaia = pd.concat(tables_gaia)
+   return [name for expression, name in query_expressions(query)]
 
-      pool.close()
 
+def query_field(query):
+   """
+   This routine returns the search area of a query built by columns_n_conditions, and its simple conditions (column, operator, value), e.g. ('pmra', '>', -6.).
+   """
+   import re
+
+   number = r'\s*(-?[\d.]+)\s*'
+
+   box = re.search(r"BOX\('ICRS',%s,%s,%s,%s\)"%(number, number, number, number), query)
+   circles = re.findall(r"CIRCLE\('ICRS',%s,%s,%s\)\)\s*=\s*([01])"%(number, number, number), query)
+
+   if box is not None:
+      ra, dec, width, height = map(float, box.groups())
+      field = {'search_type': 'box', 'ra': ra, 'dec': dec, 'width': width, 'height': height}
    else:
-      result_gaia, queries = gaia_query(Gaia, query, min_gmag, max_gmag, norm_uwe, test_mode, save_individual_queries, load_existing, name, 1, 1)
+      field = {'search_type': 'cone', 'ra': float(circles[0][0]), 'dec': float(circles[0][1]), 'min_radius': 0., 'max_radius': 0.}
+      for ra, dec, radius, inside in circles:
+         if inside == '1':
+            field['max_radius'] = float(radius)
+         else:
+            field['search_type'] = 'anulus'
+            field['min_radius'] = float(radius)
 
-   if not test_mode:
-      Gaia.logout()
+   field['conditions'] = [(column, operator, float(value)) for column, operator, value in re.findall(r'\((\w+)\s*([<>]=?)\s*(-?[\d.]+)\)', query)]
 
-   return result_gaia, queries
+   return field
 
 
-def get_area(search_type, max_radius, min_radius, width, height, dec):
+def synthetic_isochrone_color(abs_gmag):
    """
-   This routine calculates the covered area.
+   This routine returns the BP-RP colour of a toy old and metal-poor isochrone (main sequence, turn-off, subgiant and red giant branches) at the given absolute G magnitudes.
    """
 
-   if search_type == 'box':
-      area = height * width * np.abs(np.cos(np.deg2rad(dec)))
-   elif search_type == 'anulus':
-      area = np.pi*max_radius**2 - np.pi*min_radius**2
+   return np.interp(abs_gmag, [-3.0, 0.0, 3.0, 4.0, 5.0, 8.0], [1.8, 1.15, 0.9, 0.55, 0.7, 1.6])
+
+
+def synthetic_gaia_query(query, min_gmag, max_gmag, n_stars = 20000, cluster_fraction = 0.3, cluster_radius = 0.1, cluster_pm = None, distance = 20., gmag_range = (10., 21.), seed = 0):
+   """
+   This routine returns a synthetic Gaia table with the columns selected by the query and the stars within its area and conditions, with min_gmag < G <= max_gmag. n_stars is the number of stars in the area with G within gmag_range, before applying the conditions, and a cluster_fraction of them belong to a cluster centered in the area, with a Gaussian profile of cluster_radius (deg). Cluster stars follow an old isochrone at distance (kpc), and have the same PM, cluster_pm (mas/yr), by default the middle of the PM range of the query. Field stars have broad PM, parallax and colour distributions. Tables are reproducible, as each magnitude bin has its own random seed.
+   """
+   import astropy.units as u
+   from astropy.coordinates import SkyCoord
+
+   field = query_field(query)
+   conditions = field['conditions']
+   rng = np.random.default_rng([seed, int(round(min_gmag*1e4))])
+
+   if cluster_pm is None:
+      limits = {(column, operator): value for column, operator, value in conditions}
+      cluster_pm = [np.mean([limits.get((pm, '>'), 0.), limits.get((pm, '<'), 0.)]) for pm in ['pmra', 'pmdec']]
+
+   # Luminosity function proportional to 10**(0.3 G)
+   slope = 0.3
+   lf_limits = 10**(slope*np.clip([min_gmag, max_gmag], *gmag_range))
+   n_bin = n_stars * (lf_limits[1] - lf_limits[0]) / (10**(slope*gmag_range[1]) - 10**(slope*gmag_range[0]))
+   n_cluster, n_field = int(round(n_bin*cluster_fraction)), int(round(n_bin*(1-cluster_fraction)))
+   n_total = n_cluster + n_field
+   cluster = np.arange(n_total) < n_cluster
+
+   gmag = np.log10(lf_limits[0] + rng.random(n_total)*(lf_limits[1] - lf_limits[0]))/slope
+
+   # Positions in the tangent plane (deg)
+   if field['search_type'] == 'box':
+      x, y = (rng.random(n_total)-0.5)*field['width'], (rng.random(n_total)-0.5)*field['height']
    else:
-      area = np.pi*max_radius**2
+      radius = np.sqrt(field['min_radius']**2 + rng.random(n_total)*(field['max_radius']**2 - field['min_radius']**2))
+      angle = 2*np.pi*rng.random(n_total)
+      x, y = radius*np.cos(angle), radius*np.sin(angle)
+   x[cluster], y[cluster] = rng.normal(0, cluster_radius, (2, n_cluster))
 
-   return area
+   if field['search_type'] == 'box':
+      inside = (np.abs(x) <= field['width']/2) & (np.abs(y) <= field['height']/2)
+   else:
+      inside = (np.hypot(x, y) <= field['max_radius']) & (np.hypot(x, y) >= field['min_radius'])
+
+   dec = field['dec'] + y
+   ra = (field['ra'] + x / np.cos(np.radians(dec))) % 360.
+
+   # Errors as a function of G, roughly as in Gaia EDR3
+   pm_error = 0.025*10**(0.26*(gmag-15.))
+   gmag_error = 0.0003*10**(0.2*(gmag-13.))
+   bpmag_error, rpmag_error = 7*gmag_error, 5*gmag_error
+
+   bp_rp = np.where(cluster, synthetic_isochrone_color(gmag - (5*np.log10(distance*1e3)-5)) + rng.normal(0, 0.02, n_total), rng.normal(1.1, 0.35, n_total))
+   bp_rp = np.clip(bp_rp, 0.1, 3.5) + rng.normal(0, np.hypot(bpmag_error, rpmag_error))
+   bpmag, rpmag = gmag + 0.45*bp_rp, gmag - 0.55*bp_rp
+
+   pmra = np.where(cluster, rng.normal(cluster_pm[0], 0.05, n_total), rng.normal(0., 4., n_total)) + rng.normal(0, pm_error)
+   pmdec = np.where(cluster, rng.normal(cluster_pm[1], 0.05, n_total), rng.normal(-1., 4., n_total)) + rng.normal(0, pm_error)
+   parallax = np.where(cluster, 1./distance, rng.exponential(0.4, n_total)) + rng.normal(0, 0.8*pm_error)
+
+   five_parameters = gmag < 19.
+   ruwe = 1. + np.abs(rng.normal(0, 0.05, n_total))
+   n_good_obs = rng.integers(150, 400, n_total)
+
+   data = {'source_id': np.arange(n_total) + int(round(min_gmag*1e4))*10**7,
+           'ra': ra, 'ra_error': 0.7*pm_error, 'dec': dec, 'dec_error': 0.7*pm_error,
+           'parallax': parallax, 'parallax_error': 0.8*pm_error, 'pmra': pmra, 'pmra_error': pm_error, 'pmdec': pmdec, 'pmdec_error': pm_error,
+           'dr2_radial_velocity': np.full(n_total, np.nan), 'dr2_radial_velocity_error': np.full(n_total, np.nan),
+           'phot_g_mean_mag': gmag, 'gmag': gmag, 'gmag_error': gmag_error, 'phot_g_mean_flux': 10**(-0.4*(gmag-25.6874)),
+           'bpmag': bpmag, 'bpmag_error': bpmag_error, 'rpmag': rpmag, 'rpmag_error': rpmag_error, 'bp_rp': bp_rp, 'bp_rp_error': np.hypot(bpmag_error, rpmag_error),
+           'pseudocolour': np.where(five_parameters, np.nan, 1.5), 'nu_eff_used_in_astrometry': np.where(five_parameters, 1.5, np.nan),
+           'astrometric_params_solved': np.where(five_parameters, 31, 95), 'visibility_periods_used': rng.integers(12, 25, n_total),
+           'astrometric_excess_noise_sig': np.abs(rng.normal(0, 0.5, n_total)), 'astrometric_n_good_obs_al': n_good_obs, 'astrometric_chi2_al': n_good_obs*ruwe**2,
+           'phot_bp_rp_excess_factor': 1.154360 + 0.033772*bp_rp + 0.032277*bp_rp**2 + rng.normal(0, 0.005, n_total),
+           'ruwe': ruwe, 'beta': np.abs(rng.normal(0, 0.02, n_total)), 'ipd_gof_harmonic_amplitude': np.abs(rng.normal(0, 0.02, n_total)),
+           'phot_bp_n_contaminated_transits': rng.integers(0, 3, n_total), 'phot_rp_n_contaminated_transits': rng.integers(0, 3, n_total)}
+
+   for correlation in ['ra_dec_corr', 'ra_parallax_corr', 'ra_pmra_corr', 'ra_pmdec_corr', 'dec_parallax_corr', 'dec_pmra_corr', 'dec_pmdec_corr', 'parallax_pmra_corr', 'parallax_pmdec_corr', 'pmra_pmdec_corr']:
+      data[correlation] = np.clip(rng.normal(0, 0.1, n_total), -1, 1)
+
+   coo = SkyCoord(ra = ra*u.deg, dec = dec*u.deg, frame = 'icrs')
+   data['l'], data['b'] = coo.galactic.l.deg, coo.galactic.b.deg
+   data['ecl_lat'] = coo.barycentrictrueecliptic.lat.deg
+
+   # The conditions of the query on single columns are applied as the archive would
+   selected = inside & (gmag > min_gmag) & (gmag <= max_gmag)
+   operators = {'>': np.greater, '>=': np.greater_equal, '<': np.less, '<=': np.less_equal}
+   for column, operator, value in conditions:
+      if column in data:
+         selected &= operators[operator](data[column], value)
+
+   columns = query_columns(query)
+   table = pd.DataFrame({column: data[column][selected] if column in data else np.full(selected.sum(), np.nan) for column in columns}, columns = columns)
 
+   return table
 
-def get_coo_split(args, table):
-   
-   center = c.SkyCoord(args.ra*u.deg, args.dec*u.deg)
-   coords = c.SkyCoord(table.ra*u.deg, table.dec*u.deg)
 
-   table['r'] = center.separation(coords).to("arcsec").value
-   #table["phi"] = center.position_angle(coords).value
-   table['x'], table['y'] = wcs2xy(table.ra, table.dec, args.ra, args.dec)
+def synthetic_mast_tables(ra, dec, radius = 0.1, n_obs = 3, n_exp = 4, filters = ['F606W', 'F814W'], exptime = 500., date_second_epoch = 57531.0, min_baseline = 5., max_baseline = 15., seed = 0):
+   """
+   This routine returns synthetic MAST observation and data products tables, as search_mast does. There are n_obs ACS/WFC observations within radius (deg) of (ra, dec), each one with n_exp FLC images and a DRZ image. Their footprints (s_region) are squares of 202 arcsec with random orientations, and their time baselines are between min_baseline and max_baseline years.
+   """
+   from astropy.time import Time
 
-   data = table.loc[table.r <= (args.max_search_radius*u.deg).to("arcsec").value, :]
-   field = table.loc[table.r > (args.max_search_radius*u.deg).to("arcsec").value, :]
+   rng = np.random.default_rng(seed)
 
-   return data, field
+   obs, products = [], []
+   for ii in range(n_obs):
+      obsid = 2000000000 + ii
+      obs_id = 'jsyn%02i010'%ii
+      distance, angle = radius*np.sqrt(rng.random()), 2*np.pi*rng.random()
+      s_dec = dec + distance*np.sin(angle)
+      s_ra = (ra + distance*np.cos(angle)/np.cos(np.radians(s_dec))) % 360.
 
+      # Closed square of 202 arcsec
+      orientation = 2*np.pi*rng.random() + np.pi/4 + np.arange(5)*np.pi/2
+      corners_dec = s_dec + 101./3600.*np.sqrt(2)*np.sin(orientation)
+      corners_ra = s_ra + 101./3600.*np.sqrt(2)*np.cos(orientation)/np.cos(np.radians(s_dec))
+      s_region = 'POLYGON ' + ' '.join(['%.8f %.8f'%(corner_ra, corner_dec) for corner_ra, corner_dec in zip(corners_ra, corners_dec)])
 
-def create_dir(path):
-   """
-   This routine creates directories.
-   """
-   
-   try:
-      os.mkdir(path)
-   except OSError:  
-      print ("Creation of the directory %s failed" % path)
-   else:  
-      print ("Successfully created the directory %s " % path)
+      t_max = date_second_epoch - rng.uniform(min_baseline, max_baseline)*365.2422
+      filter = filters[ii % len(filters)]
 
+      obs.append({'obsid': obsid, 'obs_id': obs_id, 'obs_collection': 'HST', 'instrument_name': 'ACS/WFC', 'filters': filter, 's_ra': s_ra, 's_dec': s_dec, 's_region': s_region, 't_max': t_max, 't_exptime': n_exp*exptime, 'proposal_id': '%i'%(90000+ii), 'n_exp': n_exp})
 
-def round_significant(x, ex, sig=1):
-   """
-   This routine returns a quantity rounded to its error significan figures.
-   """
-   
-   try:
-      significant = sig-int(floor(log10(abs(ex))))-1
-   except:
-      significant = 4
+      products.append({'parent_obsid': obsid, 'obs_id': obs_id, 'productFilename': obs_id+'_drz.fits', 'productSubGroupDescription': 'DRZ', 'obs_collection': 'HST'})
+      for jj in range(n_exp):
+         exposure_id = obs_id[:-3]+'%03i'%(jj+1)
+         products.append({'parent_obsid': obsid, 'obs_id': exposure_id, 'productFilename': exposure_id+'_flc.fits', 'productSubGroupDescription': 'FLC', 'obs_collection': 'HST'})
 
-   return round(x, significant), round(ex, significant)
+   obs_table = pd.DataFrame(obs)
+   data_products_by_obs = pd.DataFrame(products)
 
+   obs_table['i_exptime'] = obs_table['t_exptime'] / obs_table['n_exp']
+   obs_time = Time(obs_table['t_max'], format='mjd')
+   obs_time.format = 'iso'
+   obs_time.out_subfmt = 'date'
+   obs_table['obs_time'] = obs_time.value
+   obs_table['t_baseline'] = round((date_second_epoch - obs_table['t_max']) / 365.2422, 2)
 
-def select_conditions(args, table):
+   data_products_by_obs = data_products_by_obs.merge(obs_table.loc[:, ['obsid', 'i_exptime', 'filters', 't_baseline', 's_ra', 's_dec']].rename(columns={'obsid':'parent_obsid'}), on = ['parent_obsid'])
+
+   return obs_table.reset_index(drop = False), data_products_by_obs.reset_index(drop = False)
+
+
+def synthetic_xym2pm_Gaia(Gaia_HST_table, ra_cent, dec_cent, t_baseline, lnk_filename = None, mat_filename = None, pixel_scale = 0.05, reference_pm = None, match_fraction = 0.9, hst_error = 0.02, xcen = 5000., ycen = 5000., seed = 0):
    """
-   Select table based on simple conditions
+   This routine returns a synthetic LNK table and MAT array, as xym2pm_Gaia would obtain for the stars in Gaia_HST_table (ra, dec, pmra, pmdec, their errors, gmag and use_for_alignment) and an HST image centered in (ra_cent, dec_cent), taken t_baseline years before Gaia. A match_fraction of the stars are found in the image, with positional errors of hst_error pixels. Their PMs relative to the reference stars are the Gaia PMs minus reference_pm, by default the median PM of the reference stars. The rows of the LNK table follow Gaia_HST_table, as the input table written by write_xym2pm_Gaia_input. If given, the LNK and MAT files are written.
    """
 
-   conditions_astrometry = (table.pmra >= args.min_pmra) & (table.pmra <= args.max_pmra)\
-                         & (table.pmdec >= args.min_pmdec) & (table.pmdec <= args.max_pmdec)\
-                         & (table.parallax >= args.min_parallax) & (table.parallax <= args.max_parallax)
-   
-   conditions_photometry = (table.bp_rp >= args.min_bp_rp) & (table.bp_rp <= args.max_bp_rp)\
-                         & (table.gmag >= args.min_gmag) & (table.gmag <= args.max_gmag)\
-                         & (table.bpmag <= args.max_gmag) & (table.rpmag <= args.max_rpmag)\
+   rng = np.random.default_rng(seed)
+   n_stars = len(Gaia_HST_table)
+   use_for_alignment = Gaia_HST_table['use_for_alignment'].values == True
 
-   conditions_astrometric_error = (table.pmra_error <= args.max_pmra_error) & (table.pmdec_error <= args.max_pmdec_error) & (table.parallax_error <= args.max_parallax_error)
+   if reference_pm is None:
+      reference = Gaia_HST_table.loc[use_for_alignment] if use_for_alignment.any() else Gaia_HST_table
+      reference_pm = (np.nanmedian(reference.pmra), np.nanmedian(reference.pmdec))
 
-   conditions_photometric_error = (table.bpmag_error <= args.max_bpmag_error) & (table.rpmag_error <= args.max_rpmag_error) & (table.gmag_error <= args.max_gmag_error)
+   dra, ddec = rd2xy(Gaia_HST_table.ra.values, Gaia_HST_table.dec.values, ra_cent, dec_cent)
+   x_gaia, y_gaia = xcen - dra*3600./pixel_scale, ycen + ddec*3600./pixel_scale
 
-   table = table[conditions_astrometry & conditions_photometry & conditions_astrometric_error & conditions_photometric_error]
-   
-   return table
+   # Displacements between the two epochs, in pixels
+   dx = (Gaia_HST_table.pmra.values - reference_pm[0]) * t_baseline / (1e3*pixel_scale)
+   dy = (Gaia_HST_table.pmdec.values - reference_pm[1]) * t_baseline / (1e3*pixel_scale)
 
+   matched = rng.random(n_stars) < match_fraction
+   xhst_gaia = x_gaia + dx + rng.normal(0, hst_error, n_stars)
+   yhst_gaia = y_gaia - dy + rng.normal(0, hst_error, n_stars)
+   xpm_gaia, ypm_gaia = x_gaia + dx, y_gaia - dy
 
+   m_hst = Gaia_HST_table.gmag.values - 26.
+   q_hst = np.clip(0.02*10**(0.15*(Gaia_HST_table.gmag.values-15.)), 0.01, 0.9)
 
+   lnk = pd.DataFrame({'xc_hst': xhst_gaia-xcen+2048., 'yc_hst': yhst_gaia-ycen+2048., 'm_hst': m_hst, 'q_hst': q_hst, 'xr_hst': xhst_gaia-xcen+2048., 'yr_hst': yhst_gaia-ycen+2048.,
+                       'xhst_gaia': xhst_gaia, 'yhst_gaia': yhst_gaia, 'x_gaia': x_gaia, 'y_gaia': y_gaia, 'g_gaia': Gaia_HST_table.gmag.values, 'xpm_gaia': xpm_gaia, 'ypm_gaia': ypm_gaia,
+                       'dra_gaia': dra*3600., 'ddec_gaia': ddec*3600., 'ra_gaia': Gaia_HST_table.ra.values, 'dec_gaia': Gaia_HST_table.dec.values, 'era_gaia': Gaia_HST_table.ra_error.values/1000., 'edec_gaia': Gaia_HST_table.dec_error.values/1000.,
+                       'pmra_gaia': Gaia_HST_table.pmra.values, 'epmra_gaia': Gaia_HST_table.pmra_error.values, 'pmdec_gaia': Gaia_HST_table.pmdec.values, 'epmdec_gaia': Gaia_HST_table.pmdec_error.values}, columns = lnk_columns)
 
+   # Stars not found in the image only keep their Gaia columns, as in xym2pm_Gaia
+   lnk.loc[~matched, ['xc_hst', 'yc_hst', 'm_hst', 'q_hst', 'xr_hst', 'yr_hst', 'xhst_gaia', 'yhst_gaia']] = 0.
 
+   used = matched & use_for_alignment
+   mat = np.c_[xpm_gaia[used], ypm_gaia[used], lnk.xc_hst.values[used], lnk.yc_hst.values[used], Gaia_HST_table.gmag.values[used], m_hst[used], xpm_gaia[used]-xhst_gaia[used], ypm_gaia[used]-yhst_gaia[used], xhst_gaia[used], yhst_gaia[used]]
 
+   if lnk_filename is not None:
+      write_lnk(lnk_filename, lnk)
+   if mat_filename is not None:
+      np.savetxt(mat_filename, mat, fmt='%12.4f')
 
+   return lnk, mat
 
 
+def healpix_nested(ra, dec, level):
+   """
+   This routine returns the HEALPix pixels (nested scheme) of the given level that contain the coordinates (deg). Gaia source_ids encode the level 12 pixel of each source, source_id // 2**35.
+   """
 
+   nside = 2**level
+   z = np.sin(np.radians(np.atleast_1d(dec).astype(float)))
+   za = np.abs(z)
+   tt = np.mod(np.radians(np.atleast_1d(ra).astype(float)), 2*np.pi) * 2/np.pi
+
+   # Equatorial region
+   temp1, temp2 = nside*(0.5 + tt), nside*z*0.75
+   jp, jm = (temp1 - temp2).astype(np.int64), (temp1 + temp2).astype(np.int64)
+   ifp, ifm = jp // nside, jm // nside
+   face = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+   ix, iy = jm & (nside - 1), nside - (jp & (nside - 1)) - 1
+
+   # Polar caps
+   polar = za > 2./3.
+   ntt = np.minimum(tt.astype(np.int64), 3)
+   tp = tt - ntt
+   tmp = nside*np.sqrt(3*(1 - za))
+   jp_polar = np.minimum((tp*tmp).astype(np.int64), nside - 1)
+   jm_polar = np.minimum(((1 - tp)*tmp).astype(np.int64), nside - 1)
+   face = np.where(polar, np.where(z > 0, ntt, ntt + 8), face)
+   ix = np.where(polar, np.where(z > 0, nside - jm_polar - 1, jp_polar), ix)
+   iy = np.where(polar, np.where(z > 0, nside - jp_polar - 1, jm_polar), iy)
+
+   # Bits of ix and iy are interleaved within each face
+   pixel = face * nside**2
+   for bit in range(level):
+      pixel += (((ix >> bit) & 1) << (2*bit)) | (((iy >> bit) & 1) << (2*bit + 1))
+
+   return pixel
+
+
+def query_field_radius(field):
+   """
+   This routine returns the maximum distance (deg) to the center of the search area of a query.
+   """
 
+   if field['search_type'] == 'box':
+      return np.hypot(field['width'], field['height'])/2.
+   else:
+      return field['max_radius']
 
 
+def query_healpix(field, level):
+   """
+   This routine returns the HEALPix pixels (nested scheme) of the given level that may contain stars of the search area of a query (see query_field). The area, with a margin of half a pixel, is sampled with a grid finer than the pixels.
+   """
 
+   pixel_size = np.degrees(np.sqrt(4*np.pi / (12*4**level)))
+   step = pixel_size/8.
+   radius = query_field_radius(field) + pixel_size/2.
 
+   dec_grid = np.clip(np.arange(field['dec'] - radius, field['dec'] + radius + step, step), -90., 90.)
+   ra_width = min(radius / np.cos(np.radians(min(np.abs(dec_grid).max(), 89.9))), 180.)
+   ra_grid = np.arange(field['ra'] - ra_width, field['ra'] + ra_width + step, step)
 
+   ra_grid, dec_grid = [grid.ravel() for grid in np.meshgrid(ra_grid, dec_grid)]
+   near = angular_distance(ra_grid, dec_grid, field['ra'], field['dec']) <= radius
 
+   return np.unique(healpix_nested(ra_grid[near] % 360., dec_grid[near], level))
 
 
+def angular_distance(ra1, dec1, ra2, dec2):
+   """
+   This routine returns the angular distance (deg) between two positions (deg), using the haversine formula.
+   """
 
+   ra1, dec1, ra2, dec2 = map(np.radians, (ra1, dec1, ra2, dec2))
 
+   return np.degrees(2*np.arcsin(np.sqrt(np.sin((dec2 - dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2 - ra1)/2)**2)))
 
 
+def in_query_field(ra, dec, field):
+   """
+   This routine returns which stars are within the search area of a query (see query_field). Boxes are approximated in the tangent plane, as in synthetic_gaia_query.
+   """
 
+   if field['search_type'] == 'box':
+      x = ((ra - field['ra'] + 180.) % 360. - 180.) * np.cos(np.radians(dec))
+      return (np.abs(x) <= field['width']/2) & (np.abs(dec - field['dec']) <= field['height']/2)
+   else:
+      distance = angular_distance(ra, dec, field['ra'], field['dec'])
+      return (distance <= field['max_radius']) & (distance >= field['min_radius'])
 
 
+class GaiaArchive(object):
+   """
+   Catalog backend that queries the Gaia archive through its TAP service. Each process opens its own session, which is reused by all its queries, and only the user and password are sent to the workers. Queries of areas smaller than sync_max_area (deg^2) are launched as synchronous jobs, without polling, unless they reach the sync_max_rows limit of the archive, when they are launched again as asynchronous jobs. Asynchronous jobs are removed by close() all at once, and the session of this process is closed unless keep_session.
+   """
 
+   def __init__(self, gaia_user = None, gaia_paswd = None, interactive = True, keep_session = False, sync_max_area = 0.01, sync_max_rows = 2000):
+      Gaia, self.gaia_user, self.gaia_paswd = gaia_log_in(gaia_user = gaia_user, gaia_paswd = gaia_paswd, interactive = interactive, keep_session = True)
+      self.keep_session = keep_session
+      self.sync_max_area = sync_max_area
+      self.sync_max_rows = sync_max_rows
+      self.jobs = []
 
-#def get_uwe(phot_g_mean_mag, bp_rp, astrometric_chi2_al, astrometric_n_good_obs_al, norm_uwe = True):
-   #"""
-   #Calculates the corresponding RUWE for Gaia stars.
-   #"""
+   def session(self):
+      return gaia_log_in(gaia_user = self.gaia_user, gaia_paswd = self.gaia_paswd, interactive = False, keep_session = True)[0]
 
-   #uwe = np.sqrt(astrometric_chi2_al/(astrometric_n_good_obs_al - 5.))
+   def query(self, query, min_gmag, max_gmag):
+      Gaia = self.session()
 
-   #if norm_uwe:
-      ##We make use of the normalization array from files table_u0_g_col.txt, table_u0_g.txt
+      field = query_field(query)
+      if get_area(field['search_type'], field.get('max_radius'), field.get('min_radius'), field.get('width'), field.get('height'), field['dec']) <= self.sync_max_area:
+         result = Gaia.launch_job(query).get_results().to_pandas()
+         if len(result) < self.sync_max_rows:
+            return result
 
-      #has_color = np.isfinite(bp_rp) & (np.isfinite(phot_g_mean_mag))
-      #u0gc = pd.read_csv('./Auxiliary/DR2_RUWE_V1/table_u0_g_col.txt', header =0)
+      job = Gaia.launch_job_async(query)
+      result = job.get_results().to_pandas()
 
-      ##histogram
-      #dx = 0.01
-      #dy = 0.1
-      #bins = [np.arange(np.amin(u0gc['g_mag'])-0.5*dx, np.amax(u0gc['g_mag'])+dx, dx), np.arange(np.amin(u0gc[' bp_rp'])-0.5*dy, np.amax(u0gc[' bp_rp'])+dy, dy)]
-      
-      #posx = np.digitize(phot_g_mean_mag[has_color], bins[0], right=False)
-      #posy = np.digitize(bp_rp[has_color], bins[1], right=False)
+      # The job is removed at the end, together with the rest
+      result.attrs['gaia_jobs'] = [job.jobid]
 
-      #posx[posx < 1] = 1
-      #posx[posx > len(bins[0])-1] = len(bins[0])-1
-      #posy[posy < 1] = 1
-      #posy[posy > len(bins[1])-1] = len(bins[1])-1
+      return result
 
-      #u0_gc = np.reshape(np.array(u0gc[' u0']), (len(bins[0])-1, len(bins[1])-1))[posx - 1, posy - 1]
-      #uwe[has_color] /= np.array(u0_gc)
+   def close(self):
+      if len(self.jobs) > 0:
+         remove_jobs(self.session(), self.jobs)
+         self.jobs = []
+      if not self.keep_session:
+         gaia_log_out(self.gaia_user)
 
-      #if not all(has_color):
-         #u0g = pd.read_csv('./Auxiliary/DR2_RUWE_V1/table_u0_g.txt', header =0)
 
-         #posx = np.digitize(phot_g_mean_mag[~has_color], bins[0], right=False)
+class SyntheticCatalog(object):
+   """
+   Catalog backend that generates the stars with synthetic_gaia_query, with the given options, for runs without network access.
+   """
 
-         #posx[posx < 1] = 1
-         #posx[posx > len(bins[0])-1] = len(bins[0])-1
+   def __init__(self, **options):
+      self.options = options
 
-         #u0_c = u0g.loc[posx - 1, ' u0']
-         #uwe[~has_color] /= np.array(u0_c)
+   def query(self, query, min_gmag, max_gmag):
+      return synthetic_gaia_query(query, min_gmag, max_gmag, **self.options)
 
-   #return uwe
+   def close(self):
+      pass
 
 
-#def clean_astrometry(phot_g_mean_mag, bp_rp, astrometric_chi2_al, astrometric_n_good_obs_al, norm_uwe = True):
-   #"""
-   #Select stars with good astrometry in Gaia.
-   #"""
-   
-   #b = 1.2 * np.maximum(np.ones_like(phot_g_mean_mag), np.exp(-0.2*(phot_g_mean_mag-19.5)))
-   
-   #uwe = get_uwe(phot_g_mean_mag, bp_rp, astrometric_chi2_al, astrometric_n_good_obs_al, norm_uwe = norm_uwe)
-   
-   #if norm_uwe:
-      #labels_uwe = uwe < 1.5
-   #else:
-      #labels_uwe = uwe < 1.95
- 
-   #labels_astrometric = (uwe < b) & labels_uwe
+class ParquetCatalog(object):
+   """
+   Catalog backend that reads the stars from a local copy of the Gaia source table, stored as Parquet files partitioned by HEALPix (see build_gaia_catalog). Only the files of the pixels covering the search area are read, with the columns used by the query, and the simple conditions of the query (e.g. pmra > -6) are pushed down to the Parquet reader. The rest of the query, its area and the remaining conditions and selected expressions, is evaluated on the stars read.
+   """
 
-   #return labels_astrometric, uwe
+   functions = {'sqrt': np.sqrt, 'power': np.power, 'abs': np.abs, 'log10': np.log10, 'exp': np.exp}
 
+   def __init__(self, path, level = None):
+      import re
 
-#def clean_photometry(bp_rp, phot_bp_rp_excess_factor):
-   #"""
-   #Select stars with good photometry in Gaia.
-   #"""
+      if not os.path.isdir(path):
+         print('Could not find the Gaia catalog in %s. Please check --gaia_catalog.\nExiting now.'%path)
+         sys.exit(1)
 
-   #labels_photometric = (1.0 + 0.015*bp_rp**2 < phot_bp_rp_excess_factor) & (1.5*(1.3 + 0.06*bp_rp**2) > phot_bp_rp_excess_factor)
+      self.path = path
+      self.level = level
+      if self.level is None:
+         for entry in os.scandir(path):
+            partition = re.match(r'healpix(\d+)=\d+$', entry.name)
+            if partition is not None:
+               self.level = int(partition.group(1))
+               break
+
+   def files(self, query):
+      files = []
+      for pixel in query_healpix(query_field(query), self.level):
+         pixel_path = os.path.join(self.path, 'healpix%i=%i'%(self.level, pixel))
+         if os.path.isdir(pixel_path):
+            files += sorted([os.path.join(pixel_path, file) for file in os.listdir(pixel_path) if file.endswith('.parquet')])
+      return files
+
+   def query(self, query, min_gmag, max_gmag):
+      import re
+      import operator
+      import pyarrow.dataset as ds
+
+      field = query_field(query)
+      expressions = query_expressions(query)
+      conditions = [condition for condition in split_outside_parentheses(query[query.index(' WHERE ')+len(' WHERE '):], ' AND ') if 'CONTAINS(' not in condition.upper()]
+
+      files = self.files(query)
+      if len(files) == 0:
+         return pd.DataFrame(columns = [name for expression, name in expressions])
+
+      dataset = ds.dataset(files, format = 'parquet')
+      schema = dataset.schema.names
+
+      # Columns used by the query, and simple conditions pushed down to the reader
+      used = set(re.findall(r'[A-Za-z_]\w*', ' '.join([expression for expression, name in expressions] + conditions))) | {'ra', 'dec'}
+      columns = [column for column in schema if column in used]
+
+      operators = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+      pushdown = (ds.field('dec') >= field['dec'] - query_field_radius(field)) & (ds.field('dec') <= field['dec'] + query_field_radius(field))
+      for column, comparison, value in field['conditions']:
+         if column in schema:
+            pushdown &= operators[comparison](ds.field(column), value)
+
+      stars = dataset.to_table(columns = columns, filter = pushdown).to_pandas()
+
+      selected = in_query_field(stars.ra.values, stars.dec.values, field)
+      with np.errstate(invalid = 'ignore', divide = 'ignore'):
+         for condition in conditions:
+            selected &= np.asarray(self.evaluate(re.sub(r'(?<![<>!=])=(?!=)', '==', condition.replace('<>', '!=')), stars), dtype = bool)
+         stars = stars.loc[selected]
+
+         result = pd.DataFrame({name: self.evaluate(expression, stars) for expression, name in expressions}, index = stars.index, columns = [name for expression, name in expressions])
+
+      return result.reset_index(drop = True)
+
+   def evaluate(self, expression, stars):
+      return eval(expression, {'__builtins__': {}, **self.functions}, stars)
+
+   def close(self):
+      pass
 
-   #return labels_photometric
 
+def build_gaia_catalog(filenames, path, level = 5, chunk_size = 1000000):
+   """
+   This routine builds a local copy of the Gaia source table that can be queried with ParquetCatalog, from CSV or ECSV files with its columns (e.g. those of the bulk download of the Gaia archive, http://cdn.gea.esac.esa.int/Gaia/). The stars are saved as Parquet files in one directory per HEALPix pixel of the given level (healpixLEVEL=PIXEL), obtained from their source_id, and sorted by source_id within each file.
+   """
 
-#def pre_clean_data(phot_g_mean_mag, bp_rp, astrometric_chi2_al, astrometric_n_good_obs_al, phot_bp_rp_excess_factor, norm_uwe = True):
-   #"""
-   #This routine cleans the Gaia data from astrometrically and photometric bad measured stars.
-   #"""
+   for filename in filenames:
+      print('Adding %s to the Gaia catalog in %s.'%(filename, path))
+      file_name = os.path.basename(filename).split('.')[0]
+      for ii, chunk in enumerate(pd.read_csv(filename, comment = '#', na_values = ['null', ''], chunksize = chunk_size)):
+         pixels = chunk.source_id.values // (2**35 * 4**(12-level))
+         for pixel, stars in chunk.groupby(pixels):
+            pixel_path = os.path.join(path, 'healpix%i=%i'%(level, pixel))
+            os.makedirs(pixel_path, exist_ok = True)
+            stars.sort_values(by = 'source_id').to_parquet(os.path.join(pixel_path, '%s_%i.parquet'%(file_name, ii)), index = False)
 
-   #labels_photometric = clean_photometry(bp_rp, phot_bp_rp_excess_factor)
-   
-   #labels_astrometric, uwe = clean_astrometry(phot_g_mean_mag, bp_rp, astrometric_chi2_al, astrometric_n_good_obs_al, norm_uwe = norm_uwe)
-   
-   #return labels_photometric & labels_astrometric, uwe
 
+# Environment variables with the file where the stages of the run are recorded and the stages to profile. Being in the environment, they reach the workers of the pool.
+run_report_variable = 'HST_GAIA_RUN_REPORT'
+profile_variable = 'HST_GAIA_PROFILE'
 
-#def remove_jobs():
-   #"""
-   #This routine removes jobs from the Gaia archive server.
-   #"""
+# Only one profiler can be active at a time in a process, so stages within a profiled stage are not profiled on their own. Processes are kept by their id, as forked workers inherit this list.
+active_profilers = []
 
-   #list_jobs = []
-   #for job in Gaia.list_async_jobs():
-      #list_jobs.append(job.get_jobid())
-   
-   #Gaia.remove_jobs(list_jobs)
 
+class StageReport(object):
+   """
+   This class measures a stage of the run: wall time, CPU time, peak memory (RSS) of the process, number of rows in and out, and CPU time and peak memory of the child processes (hst1pass.e, xym2pm_Gaia.e) finished during the stage. The record is appended to the run report started with start_run_report, also from the workers of the pool. The stages selected with start_profiling are also profiled with cProfile. Without a run report or profiling, it does nothing. Rows and any other information are set as items:
 
-#def gaia_log_in():
-   #"""
-   #This routine log in to the Gaia archive.
-   #"""
+   with StageReport('cmd_cleaning', rows_in = len(table)) as stage:
+      ...
+      stage['rows_out'] = member_cmd.sum()
+   """
 
-   #from astroquery.gaia import Gaia
-   #import getpass
-   
-   #while True:
-      #user_loging = input("Gaia username: ")
-      #user_paswd = getpass.getpass(prompt='Gaia password: ') 
-      #try:
-         #Gaia.login(user=user_loging, password=user_paswd)
-         #print("Welcome to the Gaia server!")
-         #break
+   def __init__(self, name, rows_in = None, **info):
+      self.record = dict(stage = name, rows_in = rows_in, rows_out = None, **info)
+      self.filename = os.environ.get(run_report_variable)
+      self.profiling = None
+      self.profiler = None
 
-      #except:
-         #print("Incorrect username or password!")
+      if profile_variable in os.environ:
+         import json
 
-   #return Gaia
+         profiling = json.loads(os.environ[profile_variable])
+         if (name in profiling['stages']) or ('all' in profiling['stages']):
+            self.profiling = profiling
 
+   def __setitem__(self, key, value):
+      self.record[key] = value
 
-#def gaia_query(Gaia, gaia_release, ra, dec, width, height, min_gmag, max_gmag, norm_uwe, test_mode, save_individual_queries, Gaia_ind_queries_path):
-   #"""
-   #This routine launch the query to the Gaia archive.
-   #"""
+   def __enter__(self):
+      if self.filename is not None:
+         import time
+         import resource
 
-   #if gaia_release == 'DR3':
-      #gaia_table = 'gaiadr3.gaia_source'
-   #else:
+         self.record['start'] = time.time()
+         self.wall_time, self.cpu_time = time.perf_counter(), time.process_time()
+         self.children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+      if (self.profiling is not None) and (os.getpid() not in active_profilers):
+         import cProfile
+
+         self.profiler = cProfile.Profile()
+         active_profilers.append(os.getpid())
+         self.profiler.enable()
+
+      return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      if self.profiler is not None:
+         self.profiler.disable()
+         active_profilers.remove(os.getpid())
+         self.record['profile'] = save_profile(self.profiler, self.record['stage'], self.profiling['path'], top = self.profiling['top'])
+
+      if self.filename is not None:
+         import time
+         import resource
+         import json
+
+         usage = resource.getrusage(resource.RUSAGE_SELF)
+         children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+         # ru_maxrss is given in bytes in macOS and in kilobytes elsewhere.
+         rss_to_mb = 1./2**20 if sys.platform == 'darwin' else 1./2**10
+
+         self.record.update(wall_time = time.perf_counter() - self.wall_time, cpu_time = time.process_time() - self.cpu_time, peak_rss_mb = usage.ru_maxrss * rss_to_mb,
+                            children_cpu_time = (children_usage.ru_utime + children_usage.ru_stime) - (self.children_usage.ru_utime + self.children_usage.ru_stime), children_peak_rss_mb = children_usage.ru_maxrss * rss_to_mb,
+                            pid = os.getpid(), failed = exc_type is not None)
+
+         with open(self.filename, 'a') as f:
+            f.write(json.dumps(self.record, default = lambda value: value.item() if isinstance(value, np.generic) else str(value))+'\n')
+
+      return False
+
+
+def save_profile(profiler, stage, path, top = 30):
+   """
+   This routine saves the statistics of a profiled stage (.prof file, to be read with pstats or tools like snakeviz) and a summary with the top functions by cumulative time (.txt file). It returns the name of the .prof file.
+   """
+   import pstats
+   import time
+
+   profile_filename = '%s%s_%i_%i'%(path, stage, os.getpid(), time.time()*1e3)
+
+   profiler.dump_stats(profile_filename+'.prof')
+
+   with open(profile_filename+'.txt', 'w') as f:
+      stats = pstats.Stats(profiler, stream = f)
+      stats.sort_stats('cumulative').print_stats(top)
+
+   return profile_filename+'.prof'
+
+
+def start_profiling(stages, path, top = 30):
+   """
+   This routine starts profiling the selected stages (names in the run report, or 'all'), saving the results in path.
+   """
+   import json
+   import time
+
+   os.environ[profile_variable] = json.dumps({'stages': list(stages), 'path': path, 'top': top, 'start': time.time()})
+
+
+def stop_profiling():
+   """
+   This routine stops profiling the stages, and warns about the selected stages that were not profiled during the run. Profiles are saved by the workers too, so they are looked for in the profiles directory.
+   """
+   import json
+   import re
+
+   profiling = os.environ.pop(profile_variable, None)
+   if profiling is None:
+      return
+
+   profiling = json.loads(profiling)
+   profiles = os.listdir(profiling['path']) if os.path.isdir(profiling['path']) else []
+   for stage in profiling['stages']:
+      if stage == 'all':
+         continue
+      # Profiles are named stage_pid_time, with the time in ms.
+      matches = [re.fullmatch(re.escape(stage)+r'_\d+_(\d+)\.prof', profile) for profile in profiles]
+      if not any((match is not None) and (int(match.group(1)) >= profiling['start']*1e3) for match in matches):
+         print('WARNING: Stage %s was not profiled. Check its name in the run report. Stages that run within another profiled stage are not profiled on their own.'%stage)
+
+
+def run_report_filenames(run_report_filename):
+   """
+   This routine returns the names of the files of the run report: the stages as they are recorded (JSON lines), and the final JSON and CSV reports.
+   """
+
+   return run_report_filename+'.jsonl', run_report_filename+'.json', run_report_filename+'.csv'
+
+
+def start_run_report(run_report_filename):
+   """
+   This routine starts recording the stages of the run, removing the records of previous runs.
+   """
+
+   records_filename = run_report_filenames(run_report_filename)[0]
+   remove_file(records_filename)
+   os.environ[run_report_variable] = records_filename
+
+
+def write_run_report(run_report_filename):
+   """
+   This routine stops recording the stages of the run and writes them as JSON and CSV files. It returns the report as a table.
+   """
+
+   records_filename, json_filename, csv_filename = run_report_filenames(run_report_filename)
+   os.environ.pop(run_report_variable, None)
+
+   try:
+      report = pd.read_json(records_filename, lines = True)
+   except:
+      return pd.DataFrame()
+
+   report = report.sort_values('start', kind = 'stable').reset_index(drop = True)
+   report = report.astype({'rows_in': 'Int64', 'rows_out': 'Int64'})
+   report.to_json(json_filename, orient = 'records', indent = 1)
+   report.to_csv(csv_filename, index = False)
+
+   return report
+
+
+class ExecutionContext(object):
+   """
+   This class owns the pool of processes shared by all the stages of the program (Gaia queries, hst1pass, xym2pm_Gaia). The pool is created the first time it is needed and reused until close() is called, so the cost of starting the workers is paid only once and the number of processes never exceeds n_processes.
+   """
+
+   def __init__(self, n_processes = None):
+      from multiprocessing import cpu_count
+
+      if n_processes is None:
+         n_processes = cpu_count()
+
+      self.n_processes = max(1, int(n_processes))
+      self.executor = None
+
+   @property
+   def parallel(self):
+      return self.n_processes > 1
+
+   def get_executor(self):
+      from concurrent.futures import ProcessPoolExecutor
+
+      if self.executor is None:
+         self.executor = ProcessPoolExecutor(max_workers = self.n_processes)
+
+      return self.executor
+
+   def start(self):
+      """
+      Starts the workers of the pool right away, instead of with the first task. Threads should only be started in the parent process after this, as forking a process with running threads can deadlock.
+      """
+
+      if self.parallel:
+         self.get_executor().submit(int).result()
+
+   def submit(self, function, args):
+      """
+      Sends function(args) to the pool. Without parallelization, the function is executed right away and a finished Future is returned.
+      """
+      from concurrent.futures import Future
+
+      if self.parallel:
+         return self.get_executor().submit(function, args)
+
+      future = Future()
+      try:
+         future.set_result(function(args))
+      except Exception as e:
+         future.set_exception(e)
+
+      return future
+
+   def map(self, function, args, max_tasks = None):
+      """
+      Same as the map built-in function, but using the pool when there is more than one task. If max_tasks is given, no more than max_tasks tasks are in the pool at the same time (e.g. to limit the simultaneous jobs in the Gaia archive).
+      """
+      from concurrent.futures import wait, FIRST_COMPLETED
+
+      if self.parallel and (len(args) > 1):
+         if max_tasks is None:
+            return list(self.get_executor().map(function, args))
+
+         futures, running = [], set()
+         for arg in args:
+            if len(running) >= max_tasks:
+               done, running = wait(running, return_when = FIRST_COMPLETED)
+            futures.append(self.get_executor().submit(function, arg))
+            running.add(futures[-1])
+
+         return [future.result() for future in futures]
+      else:
+         return [function(arg) for arg in args]
+
+   def close(self):
+      if self.executor is not None:
+         self.executor.shutdown(wait = True)
+         self.executor = None
+
+
+def incremental_query(query, area, min_gmag = 10.0, max_gmag = 19.5, norm_uwe = True, context = None, test_mode = False, save_individual_queries = False, load_existing = False, name = 'output', gaia_user = None, gaia_paswd = None, interactive = True, keep_gaia_session = False, gaia_sync_max_area = 0.01, catalog = None, max_gaia_jobs = 20):
+
+   """
+   This routine search the Gaia catalog and downloads the stars using parallel workers. The catalog backend can be given (e.g. a ParquetCatalog), otherwise the Gaia archive is used, or synthetic stars in test mode. No more than max_gaia_jobs queries run at the same time, whatever the number of processes.
+   """
+
+   if context is None:
+      context = ExecutionContext(n_processes = 1)
+
+   close_catalog = catalog is None
+   if catalog is None:
+      if not test_mode:
+         catalog = GaiaArchive(gaia_user = gaia_user, gaia_paswd = gaia_paswd, interactive = interactive, keep_session = keep_gaia_session, sync_max_area = gaia_sync_max_area)
+      else:
+         catalog = SyntheticCatalog(**(test_mode if isinstance(test_mode, dict) else {}))
+
+   mag_nodes = get_mag_bins(min_gmag, max_gmag, area)
+   n_total = len(mag_nodes)
+   
+   if (n_total > 1) and context.parallel:
+
+      print("Executing %s jobs."%(n_total-1))
+
+      args = []
+      for n, node in enumerate(range(n_total-1)):
+         args.append((catalog, query, mag_nodes[n+1], mag_nodes[n], norm_uwe, save_individual_queries, load_existing, name, n, n_total))
+
+      tables_gaia_queries = context.map(gaia_multi_query_run, args, max_tasks = max_gaia_jobs)
+
+      tables_gaia = [results[0] for results in tables_gaia_queries]
+      queries = [results[1] for results in tables_gaia_queries]
+
+   else:
+      result_gaia, queries = gaia_query(catalog, query, min_gmag, max_gmag, norm_uwe, save_individual_queries, load_existing, name, 1, 1)
+      tables_gaia = [result_gaia]
+
+   # Jobs left in the archive by the queries of any process are removed at the end
+   if hasattr(catalog, 'jobs'):
+      for table_gaia in tables_gaia:
+         catalog.jobs += table_gaia.attrs.get('gaia_jobs', [])
+
+   result_gaia = pd.concat(tables_gaia)
+
+   if close_catalog:
+      catalog.close()
+
+   return result_gaia, queries
+
+
+def get_area(search_type, max_radius, min_radius, width, height, dec):
+   """
+   This routine calculates the covered area.
+   """
+
+   if search_type == 'box':
+      area = height * width * np.abs(np.cos(np.deg2rad(dec)))
+   elif search_type == 'anulus':
+      area = np.pi*max_radius**2 - np.pi*min_radius**2
+   else:
+      area = np.pi*max_radius**2
+
+   return area
+
+
+def get_coo_split(args, table):
+   import astropy.units as u
+   
+   center = c.SkyCoord(args.ra*u.deg, args.dec*u.deg)
+   coords = c.SkyCoord(table.ra*u.deg, table.dec*u.deg)
+
+   table['r'] = center.separation(coords).to("arcsec").value
+   #table["phi"] = center.position_angle(coords).value
+   table['x'], table['y'] = wcs2xy(table.ra, table.dec, args.ra, args.dec)
+
+   data = table.loc[table.r <= (args.max_search_radius*u.deg).to("arcsec").value, :]
+   field = table.loc[table.r > (args.max_search_radius*u.deg).to("arcsec").value, :]
+
+   return data, field
+
+
+def create_dir(path):
+   """
+   This routine creates directories.
+   """
+   
+   try:
+      os.mkdir(path)
+   except OSError:  
+      print ("Creation of the directory %s failed" % path)
+   else:  
+      print ("Successfully created the directory %s " % path)
+
+
+def round_significant(x, ex, sig=1):
+   """
+   This routine returns a quantity rounded to its error significan figures.
+   """
+   
+   try:
+      significant = sig-int(floor(log10(abs(ex))))-1
+   except:
+      significant = 4
+
+   return round(x, significant), round(ex, significant)
+
+
+def select_conditions(args, table):
+   """
+   Select table based on simple conditions
+   """
+
+   conditions_astrometry = (table.pmra >= args.min_pmra) & (table.pmra <= args.max_pmra)\
+                         & (table.pmdec >= args.min_pmdec) & (table.pmdec <= args.max_pmdec)\
+                         & (table.parallax >= args.min_parallax) & (table.parallax <= args.max_parallax)
+   
+   conditions_photometry = (table.bp_rp >= args.min_bp_rp) & (table.bp_rp <= args.max_bp_rp)\
+                         & (table.gmag >= args.min_gmag) & (table.gmag <= args.max_gmag)\
+                         & (table.bpmag <= args.max_gmag) & (table.rpmag <= args.max_rpmag)\
+
+   conditions_astrometric_error = (table.pmra_error <= args.max_pmra_error) & (table.pmdec_error <= args.max_pmdec_error) & (table.parallax_error <= args.max_parallax_error)
+
+   conditions_photometric_error = (table.bpmag_error <= args.max_bpmag_error) & (table.rpmag_error <= args.max_rpmag_error) & (table.gmag_error <= args.max_gmag_error)
+
+   table = table[conditions_astrometry & conditions_photometry & conditions_astrometric_error & conditions_photometric_error]
+   
+   return table
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+#def get_uwe(phot_g_mean_mag, bp_rp, astrometric_chi2_al, astrometric_n_good_obs_al, norm_uwe = True):
+   #"""
+   #Calculates the corresponding RUWE for Gaia stars.
+   #"""
+
+   #uwe = np.sqrt(astrometric_chi2_al/(astrometric_n_good_obs_al - 5.))
+
+   #if norm_uwe:
+      ##We make use of the normalization array from files table_u0_g_col.txt, table_u0_g.txt
+
+      #has_color = np.isfinite(bp_rp) & (np.isfinite(phot_g_mean_mag))
+      #u0gc = pd.read_csv('./Auxiliary/DR2_RUWE_V1/table_u0_g_col.txt', header =0)
+
+      ##histogram
+      #dx = 0.01
+      #dy = 0.1
+      #bins = [np.arange(np.amin(u0gc['g_mag'])-0.5*dx, np.amax(u0gc['g_mag'])+dx, dx), np.arange(np.amin(u0gc[' bp_rp'])-0.5*dy, np.amax(u0gc[' bp_rp'])+dy, dy)]
+      
+      #posx = np.digitize(phot_g_mean_mag[has_color], bins[0], right=False)
+      #posy = np.digitize(bp_rp[has_color], bins[1], right=False)
+
+      #posx[posx < 1] = 1
+      #posx[posx > len(bins[0])-1] = len(bins[0])-1
+      #posy[posy < 1] = 1
+      #posy[posy > len(bins[1])-1] = len(bins[1])-1
+
+      #u0_gc = np.reshape(np.array(u0gc[' u0']), (len(bins[0])-1, len(bins[1])-1))[posx - 1, posy - 1]
+      #uwe[has_color] /= np.array(u0_gc)
+
+      #if not all(has_color):
+         #u0g = pd.read_csv('./Auxiliary/DR2_RUWE_V1/table_u0_g.txt', header =0)
+
+         #posx = np.digitize(phot_g_mean_mag[~has_color], bins[0], right=False)
+
+         #posx[posx < 1] = 1
+         #posx[posx > len(bins[0])-1] = len(bins[0])-1
+
+         #u0_c = u0g.loc[posx - 1, ' u0']
+         #uwe[~has_color] /= np.array(u0_c)
+
+   #return uwe
+
+
+#def clean_astrometry(phot_g_mean_mag, bp_rp, astrometric_chi2_al, astrometric_n_good_obs_al, norm_uwe = True):
+   #"""
+   #Select stars with good astrometry in Gaia.
+   #"""
+   
+   #b = 1.2 * np.maximum(np.ones_like(phot_g_mean_mag), np.exp(-0.2*(phot_g_mean_mag-19.5)))
+   
+   #uwe = get_uwe(phot_g_mean_mag, bp_rp, astrometric_chi2_al, astrometric_n_good_obs_al, norm_uwe = norm_uwe)
+   
+   #if norm_uwe:
+      #labels_uwe = uwe < 1.5
+   #else:
+      #labels_uwe = uwe < 1.95
+ 
+   #labels_astrometric = (uwe < b) & labels_uwe
+
+   #return labels_astrometric, uwe
+
+
+#def clean_photometry(bp_rp, phot_bp_rp_excess_factor):
+   #"""
+   #Select stars with good photometry in Gaia.
+   #"""
+
+   #labels_photometric = (1.0 + 0.015*bp_rp**2 < phot_bp_rp_excess_factor) & (1.5*(1.3 + 0.06*bp_rp**2) > phot_bp_rp_excess_factor)
+
+   #return labels_photometric
+
+
+#def pre_clean_data(phot_g_mean_mag, bp_rp, astrometric_chi2_al, astrometric_n_good_obs_al, phot_bp_rp_excess_factor, norm_uwe = True):
+   #"""
+   #This routine cleans the Gaia data from astrometrically and photometric bad measured stars.
+   #"""
+
+   #labels_photometric = clean_photometry(bp_rp, phot_bp_rp_excess_factor)
+   
+   #labels_astrometric, uwe = clean_astrometry(phot_g_mean_mag, bp_rp, astrometric_chi2_al, astrometric_n_good_obs_al, norm_uwe = norm_uwe)
+   
+   #return labels_photometric & labels_astrometric, uwe
+
+
+#def remove_jobs():
+   #"""
+   #This routine removes jobs from the Gaia archive server.
+   #"""
+
+   #list_jobs = []
+   #for job in Gaia.list_async_jobs():
+      #list_jobs.append(job.get_jobid())
+   
+   #Gaia.remove_jobs(list_jobs)
+
+
+#def gaia_log_in():
+   #"""
+   #This routine log in to the Gaia archive.
+   #"""
+
+   #from astroquery.gaia import Gaia
+   #import getpass
+   
+   #while True:
+      #user_loging = input("Gaia username: ")
+      #user_paswd = getpass.getpass(prompt='Gaia password: ') 
+      #try:
+         #Gaia.login(user=user_loging, password=user_paswd)
+         #print("Welcome to the Gaia server!")
+         #break
+
+      #except:
+         #print("Incorrect username or password!")
+
+   #return Gaia
+
+
+#def gaia_query(Gaia, gaia_release, ra, dec, width, height, min_gmag, max_gmag, norm_uwe, test_mode, save_individual_queries, Gaia_ind_queries_path):
+   #"""
+   #This routine launch the query to the Gaia archive.
+   #"""
+
+   #if gaia_release == 'DR3':
+      #gaia_table = 'gaiadr3.gaia_source'
+   #else:
       #gaia_table = 'gaiadr2.gaia_source'
 
    #query = "SELECT source_id, ra, ra_error, dec, dec_error, parallax, parallax_error, pmra, pmra_error, pmdec, pmdec_error, radial_velocity, radial_velocity_error, ra_dec_corr, ra_parallax_corr, ra_pmra_corr, ra_pmdec_corr, dec_parallax_corr, dec_pmra_corr, dec_pmdec_corr, parallax_pmra_corr, parallax_pmdec_corr, pmra_pmdec_corr, astrometric_n_obs_al, astrometric_n_obs_ac, astrometric_n_good_obs_al, astrometric_n_bad_obs_al, astrometric_gof_al, astrometric_chi2_al, astrometric_excess_noise, astrometric_excess_noise_sig, astrometric_weight_al, astrometric_pseudo_colour, astrometric_pseudo_colour_error, mean_varpi_factor_al, astrometric_matched_observations, visibility_periods_used, astrometric_sigma5d_max, matched_observations, phot_g_n_obs, phot_g_mean_mag AS gmag, (1.09*phot_g_mean_flux_error/phot_g_mean_flux) AS gmag_error, phot_bp_mean_mag AS bpmag, (1.09*phot_bp_mean_flux_error/phot_bp_mean_flux) AS bpmag_error, phot_rp_mean_mag AS rpmag, (1.09*phot_rp_mean_flux_error/phot_rp_mean_flux) AS rpmag_error, phot_g_mean_flux, phot_g_mean_flux_error, phot_bp_n_obs, phot_bp_mean_flux, phot_bp_mean_flux_error, phot_rp_n_obs, phot_rp_mean_flux, phot_rp_mean_flux_error,phot_bp_rp_excess_factor, bp_rp, bp_g, g_rp FROM "+gaia_table+" WHERE CONTAINS(POINT('ICRS',gaiadr2.gaia_source.ra,gaiadr2.gaia_source.dec),BOX('ICRS',%.8f,%.8f,%.8f,%.8f))=1 AND (phot_g_mean_mag > %.4f) AND (phot_g_mean_mag <= %.4f)"%(ra, dec, width, height, min_gmag, max_gmag)
@@ -843,6 +1650,8 @@ def plot_fields(Gaia_table, obs_table, HST_path, min_stars_alignment = 5, name =
    """
    This routine plots the fields and select Gaia stars within them.
    """
+   import matplotlib.pyplot as plt
+   import astropy.units as u
 
    from matplotlib.patches import Polygon
    from matplotlib.collections import PatchCollection
@@ -900,7 +1709,7 @@ def plot_fields(Gaia_table, obs_table, HST_path, min_stars_alignment = 5, name =
 
          # Make sure the field is complete. With at least 4 vertices.
          if len(tuples_list) > 4:
-            polygon = Polygon(tuples_list, True)
+            polygon = Polygon(tuples_list, closed = True)
             ecs.append(coolwarm(filter.replace(r'F', '').replace(r'W', '').replace('LP', ''), 1))
             
             # Check if the set seems downloaded
@@ -974,6 +1783,7 @@ def search_mast(ra, dec, width, height, filters = 'any', t_exptime_min = 50, t_e
    """
    This routine search for HST observations in MAST at a given position.
    """
+   from astropy.time import Time
 
    from astroquery.mast import Catalogs
    from astroquery.mast import Observations
@@ -1032,18 +1842,215 @@ def search_data_products_by_obs(obs_table):
    return data_products_by_obs[((data_products_by_obs['productSubGroupDescription'] == 'FLC') | (data_products_by_obs['productSubGroupDescription'] == 'DRZ')) & (data_products_by_obs['obs_collection'] == 'HST')]
 
 
-def download_HST_images(data_products_by_obs, path = './'):
+def select_HST_obs(obs_table, policy = 'ask', min_gaia_stars = None, min_baseline = None):
    """
-   This routine downloads the selected HST images from MAST.
+   This routine selects the HST observations to use. Depending on the policy, it asks the user ('ask'), takes 'all' or 'none' of them, or takes the observations numbers given in the policy, e.g. '1 3'. Observations with less than min_gaia_stars or a baseline shorter than min_baseline are not considered.
    """
-   
-   from astroquery.mast import Observations
 
-   images = Observations.download_products(data_products_by_obs, download_dir=path)
-   
+   if min_gaia_stars is not None:
+      obs_table = obs_table.loc[obs_table.gaia_stars_per_obs >= min_gaia_stars]
+   if min_baseline is not None:
+      obs_table = obs_table.loc[obs_table.t_baseline >= min_baseline]
+
+   if len(obs_table) == 0:
+      print('No HST observations fulfill the selection criteria.')
+      return False
+
+   if policy == 'ask':
+      print('Would you like to use the following HST observations?\n')
+      print(obs_table.loc[:, ['obsid', 'filters', 'n_exp', 'i_exptime', 'obs_time', 't_baseline', 'gaia_stars_per_obs', 'proposal_id', '']].to_string(index=False), '\n')
+
+      print("Type 'y' for all observations, 'n' for none. Type the number within parentheses at the right if you wish to use that specific set of observations. You can enter several numbers separated by space. \n")
+      HST_obs_to_use = input('Please type your answer and press enter: ')
+   else:
+      HST_obs_to_use = {'all': 'y', 'none': 'n'}.get(policy, policy)
+
+   try:
+      HST_obs_to_use = str2bool(HST_obs_to_use)
+   except:
+      try:
+         HST_obs_to_use = list(set([obsid for obsid in obs_table.obsid[[int(obsid)-1 for obsid in HST_obs_to_use.split()]] if np.isfinite(obsid)]))
+      except:
+         print('No valid input. Not downloading observations.')
+         HST_obs_to_use = False
+
+   if HST_obs_to_use is True:
+      HST_obs_to_use = list(obs_table['obsid'].values)
+
+   return HST_obs_to_use
+
+
+def file_md5(filename, chunk_size = 2**20):
+   """
+   This routine returns the MD5 checksum of a file.
+   """
+
+   import hashlib
+
+   md5 = hashlib.md5()
+   with open(filename, 'rb') as f:
+      for chunk in iter(lambda: f.read(chunk_size), b''):
+         md5.update(chunk)
+
+   return md5.hexdigest()
+
+
+# Columns of the records of the manifest of downloaded files
+download_manifest_columns = ['local_path', 'productFilename', 'obs_id', 'parent_obsid', 'productSubGroupDescription', 'status', 'message', 'size', 'md5']
+
+
+def read_download_manifest(manifest_filename):
+   """
+   This routine reads the manifest of downloaded files. It returns a dictionary with the last record of each file.
+   """
+
+   import json
+
+   manifest = {}
+   if os.path.isfile(manifest_filename):
+      with open(manifest_filename, 'r') as f:
+         for line in f:
+            try:
+               record = json.loads(line)
+               manifest[record['local_path']] = record
+            except ValueError:
+               # Possibly an interrupted write
+               pass
+
+   return manifest
+
+
+def download_HST_product(product, path, base_url, previous_record = None, chunk_size = 2**20, timeout = 120):
+   """
+   This routine downloads a single MAST product. Files already present with the expected size and checksum are skipped, and partial downloads are resumed.
+   """
+
+   from urllib.request import Request, urlopen
+   from urllib.parse import quote
+
+   output_dir = path+'mastDownload/HST/'+product['obs_id']+'/'
+   local_path = output_dir+product['productFilename']
+   part_path = local_path+'.part'
+
+   try:
+      expected_size = int(product['size'])
+   except (KeyError, TypeError, ValueError):
+      expected_size = None
+
+   record = {'local_path': local_path, 'productFilename': product['productFilename'], 'obs_id': product['obs_id'], 'parent_obsid': str(product.get('parent_obsid', '')), 'productSubGroupDescription': product.get('productSubGroupDescription', ''), 'status': 'COMPLETE', 'message': ''}
+
+   if os.path.isfile(local_path):
+      size = os.path.getsize(local_path)
+      if (previous_record is not None) and (previous_record.get('status') in ('COMPLETE', 'SKIPPED')) and (previous_record.get('size') == size) and ((expected_size is None) or (expected_size == size)):
+         md5 = file_md5(local_path)
+         if previous_record.get('md5') == md5:
+            record.update({'size': size, 'md5': md5, 'status': 'SKIPPED'})
+            return record
+      elif (previous_record is None) and (expected_size == size):
+         record.update({'size': size, 'md5': file_md5(local_path), 'status': 'SKIPPED'})
+         return record
+
+   os.makedirs(output_dir, exist_ok = True)
+
+   try:
+      request = Request('%s?uri=%s'%(base_url, quote(product['dataURI'])))
+      offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+      if offset > 0:
+         request.add_header('Range', 'bytes=%i-'%offset)
+
+      with urlopen(request, timeout = timeout) as response:
+         # If the server ignores the range we start again from scratch.
+         mode = 'ab' if (offset > 0) and (response.status == 206) else 'wb'
+         with open(part_path, mode) as f:
+            for chunk in iter(lambda: response.read(chunk_size), b''):
+               f.write(chunk)
+
+      size = os.path.getsize(part_path)
+      if (expected_size is not None) and (size != expected_size):
+         raise IOError('Size mismatch: %i bytes received, %i expected.'%(size, expected_size))
+
+      os.replace(part_path, local_path)
+      record.update({'size': size, 'md5': file_md5(local_path)})
+
+   except Exception as e:
+      record.update({'status': 'ERROR', 'message': str(e)})
+
+   return record
+
+
+def download_HST_images(data_products_by_obs, path = './', n_transfers = 4, base_url = 'https://mast.stsci.edu/api/v0.1/Download/file', on_download = None, stop = None):
+   """
+   This routine downloads the selected HST images from MAST using a bounded pool of concurrent transfers. Each finished file is recorded in the download_manifest.jsonl file in path, and passed to on_download, if given, as soon as it lands. If the stop event is set, the transfers that did not start yet are cancelled.
+   """
+
+   import json
+   from concurrent.futures import ThreadPoolExecutor, as_completed
+
+   os.makedirs(path, exist_ok = True)
+   manifest_filename = path+'download_manifest.jsonl'
+   manifest = read_download_manifest(manifest_filename)
+
+   products = data_products_by_obs.to_dict('records')
+
+   records = []
+   with ThreadPoolExecutor(max_workers = max(1, n_transfers)) as executor, open(manifest_filename, 'a') as f:
+      futures = []
+      for product in products:
+         local_path = path+'mastDownload/HST/'+product['obs_id']+'/'+product['productFilename']
+         futures.append(executor.submit(download_HST_product, product, path, base_url, manifest.get(local_path)))
+
+      for ii, future in enumerate(as_completed(futures)):
+         if (stop is not None) and stop.is_set():
+            for pending in futures:
+               pending.cancel()
+            break
+
+         record = future.result()
+         f.write(json.dumps(record)+'\n')
+         f.flush()
+
+         cli_progress_test(ii+1, len(futures))
+         if record['status'] == 'ERROR':
+            print('\n-->%s: download failed. %s'%(record['productFilename'], record['message']))
+
+         if (on_download is not None) and (record['status'] != 'ERROR'):
+            on_download(record)
+
+         records.append(record)
+
    print('')
 
-   return images
+   return pd.DataFrame(records, columns = download_manifest_columns)
+
+
+# Caches shared between the targets processed by the same process.
+isochrone_files_cache = {}
+sfd_query_cache = []
+zpt_tables_cache = []
+
+
+def load_zpt_tables():
+   """
+   This routine loads the tables of the EDR3 parallax zero-point correction only once per process, and returns the zpt module.
+   """
+   from zero_point import zpt
+
+   if len(zpt_tables_cache) == 0:
+      zpt.load_tables()
+      zpt_tables_cache.append(zpt)
+
+   return zpt
+
+
+def load_isochrone_file(isochrone_filename):
+   """
+   This routine reads a PARSEC isochrone file, parsing it only once per process.
+   """
+
+   if isochrone_filename not in isochrone_files_cache:
+      isochrone_files_cache[isochrone_filename] = np.loadtxt(isochrone_filename, usecols = [7, 1, 3, 23, 24, 25])
+
+   return isochrone_files_cache[isochrone_filename]
 
 
 def read_isochrones(Ages, Zs, max_gmag = -3.5):
@@ -1065,7 +2072,7 @@ def read_isochrones(Ages, Zs, max_gmag = -3.5):
    for Z_model in Z_models:
       print('Readding Z:', Z_model)
       try:
-         isochrone = np.loadtxt('./Auxiliary/PARSEC_Tracks/%s.dat'%Z_model, usecols = [7, 1, 3, 23, 24, 25])
+         isochrone = load_isochrone_file('./Auxiliary/PARSEC_Tracks/%s.dat'%Z_model)
       except:
          print("Could not find isochrones in ./Auxiliary/PARSEC_Tracks/")
          sys.exit(1)
@@ -1116,30 +2123,31 @@ def combine_isochrones(isochrones, cmd_broadening = 0.05, extended_HB = False):
 
 def cmd_cleaning(table, isochrones_cmd, distance = None, AV = None, clipping_sigma = 3., plots = True, plot_name = ''):
    """
-   This routine will clean the CMD by rejecting stars more than intrinsic_broadening + clipping_sigma away from the used isochrone(s).
+   This routine will clean the CMD by rejecting stars more than intrinsic_broadening + clipping_sigma away from the used isochrone(s). The table is not modified, and only the membership is returned.
    """
+   import matplotlib.pyplot as plt
 
    from shapely.geometry.point import Point
    from shapely.affinity import scale
    from descartes import PolygonPatch
    
    if AV is None:
-      table['AV'] = get_AV_map(table.loc[:, ['ra','dec']])
+      AV = get_AV_map(table.loc[:, ['ra','dec']])
+   AV = np.broadcast_to(AV, (len(table),)).astype(float)
 
-   try:
-      table.distance
-   except:
-      table['distance'] = distance
+   if 'distance' in table.columns:
+      distance = table.distance.values
+   distance = np.broadcast_to(distance, (len(table),)).astype(float)
 
    member_cmd = pd.Series(index = table.index, dtype=bool)
 
-   table[['gmag_0','bpmag_0','rpmag_0']] = table.loc[:, ['gmag','bpmag','rpmag']] - (simple_reddening_correction(table.loc[:, 'AV']) + np.expand_dims((5.*np.log10((1.5+table.loc[:, 'distance'])*1e3)-5.), 1))
+   mags_0 = pd.DataFrame(table.loc[:, ['gmag','bpmag','rpmag']].values - (simple_reddening_correction(AV) + np.expand_dims((5.*np.log10((1.5+distance)*1e3)-5.), 1)), index = table.index, columns = ['gmag_0','bpmag_0','rpmag_0'])
 
    has_cmd = table.loc[:, ['gmag', 'bpmag', 'rpmag']].notnull().all(axis = 1)
 
    print('Selecting stars in the cmd.')
 
-   stars_cmd = [scale(Point((stars_color, stars_mag)).buffer(1), xfact=stars_color_error, yfact=stars_mag_error) for stars_color, stars_mag, stars_color_error, stars_mag_error in zip(table.loc[has_cmd, 'bpmag_0']-table.loc[has_cmd, 'rpmag_0'], table.loc[has_cmd, 'gmag_0'], clipping_sigma*np.sqrt(table.loc[has_cmd, 'bpmag_error']**2+table.loc[has_cmd, 'rpmag_error']**2), clipping_sigma*table.loc[has_cmd, 'gmag_error'])]
+   stars_cmd = [scale(Point((stars_color, stars_mag)).buffer(1), xfact=stars_color_error, yfact=stars_mag_error) for stars_color, stars_mag, stars_color_error, stars_mag_error in zip(mags_0.loc[has_cmd, 'bpmag_0']-mags_0.loc[has_cmd, 'rpmag_0'], mags_0.loc[has_cmd, 'gmag_0'], clipping_sigma*np.sqrt(table.loc[has_cmd, 'bpmag_error']**2+table.loc[has_cmd, 'rpmag_error']**2), clipping_sigma*table.loc[has_cmd, 'gmag_error'])]
 
    labels_cmd = np.zeros_like(stars_cmd, dtype=bool)
    for ii, star in enumerate(stars_cmd):
@@ -1158,10 +2166,10 @@ def cmd_cleaning(table, isochrones_cmd, distance = None, AV = None, clipping_sig
          ax.add_patch(patch)
       except:
          pass
-      ax.plot((table.bpmag_0-table.rpmag_0).loc[member_cmd == True] , table.gmag_0.loc[member_cmd == True] , 'b.', label = 'selected', ms = 1., zorder = 1)
-      ax.plot((table.bpmag_0-table.rpmag_0).loc[member_cmd == False] , table.gmag_0.loc[member_cmd == False] , 'k.', label = 'rejected', ms = 0.5, zorder = 0, alpha = 0.5)
-      ax.set_ylim([table.gmag_0.loc[member_cmd == True].max()+1, table.gmag_0.loc[member_cmd == True].min()-1.])
-      ax.set_xlim([(table.bpmag_0-table.rpmag_0).min()-1., (table.bpmag_0-table.rpmag_0).max()+1.])      
+      ax.plot((mags_0.bpmag_0-mags_0.rpmag_0).loc[member_cmd == True] , mags_0.gmag_0.loc[member_cmd == True] , 'b.', label = 'selected', ms = 1., zorder = 1)
+      ax.plot((mags_0.bpmag_0-mags_0.rpmag_0).loc[member_cmd == False] , mags_0.gmag_0.loc[member_cmd == False] , 'k.', label = 'rejected', ms = 0.5, zorder = 0, alpha = 0.5)
+      ax.set_ylim([mags_0.gmag_0.loc[member_cmd == True].max()+1, mags_0.gmag_0.loc[member_cmd == True].min()-1.])
+      ax.set_xlim([(mags_0.bpmag_0-mags_0.rpmag_0).min()-1., (mags_0.bpmag_0-mags_0.rpmag_0).max()+1.])      
       ax.set_xlabel(r'$G_{BP}-G_{RP}$')
       ax.set_ylabel(r'$G$')
       plt.legend()
@@ -1187,6 +2195,8 @@ def get_AV_map(table):
    """
    This routine downloads the reddening maps.
    """
+   import astropy.units as u
+   from astropy.coordinates import SkyCoord
 
    from dustmaps.sfd import SFDQuery
 
@@ -1194,7 +2204,10 @@ def get_AV_map(table):
 
    icrs = SkyCoord(ra = np.array(table.ra)*u.deg, dec = np.array(table.dec)*u.deg, frame = 'icrs')
 
-   sfd = SFDQuery()
+   # The SFD maps are loaded only once per process.
+   if len(sfd_query_cache) == 0:
+      sfd_query_cache.append(SFDQuery())
+   sfd = sfd_query_cache[0]
    
    AV = 3.1*sfd(icrs)  # multiply by 0.86 if you want to use Schlafly & Finkbeiner 2011 (ApJ 737, 103)
 
@@ -1211,7 +2224,100 @@ def simple_reddening_correction(AV):
    return Ax
 
 
-def members_prob(table, clf, vars, clipping_prob = 3, data_0 = None):
+def set_gmm_parameters(clf, weights, means, covariances):
+   """
+   This routine sets the parameters of a fitted GaussianMixture (clf), including the Cholesky decomposition of the precisions used during the scoring.
+   """
+
+   from scipy import linalg
+
+   if clf.covariance_type in ['full', 'tied']:
+      covariances_list = covariances if clf.covariance_type == 'full' else [covariances]
+      precisions_cholesky = []
+      for covariance in covariances_list:
+         covariance_cholesky = linalg.cholesky(covariance, lower = True)
+         precisions_cholesky.append(linalg.solve_triangular(covariance_cholesky, np.eye(len(covariance)), lower = True).T)
+      precisions_cholesky = np.array(precisions_cholesky)
+      if clf.covariance_type == 'tied':
+         precisions_cholesky = precisions_cholesky[0]
+         precisions = np.dot(precisions_cholesky, precisions_cholesky.T)
+      else:
+         precisions = np.einsum('kij,klj->kil', precisions_cholesky, precisions_cholesky)
+   else:
+      precisions_cholesky = 1. / np.sqrt(covariances)
+      precisions = 1. / covariances
+
+   clf.weights_ = weights
+   clf.means_ = means
+   clf.covariances_ = covariances
+   clf.precisions_cholesky_ = precisions_cholesky
+   clf.precisions_ = precisions
+
+   return clf
+
+
+def minibatch_gmm_fit(clf, data, batch_size = 50000, n_init_samples = 50000, max_iter = 100, tol = 1e-3, random_state = 0):
+   """
+   This routine fits a GaussianMixture (clf) to large tables with bounded memory. The model is initialized on a random subsample and refined through EM passes in which the sufficient statistics are accumulated chunk by chunk.
+   """
+
+   n_samples, n_features = data.shape
+   rng = np.random.RandomState(random_state)
+
+   init_idx = rng.choice(n_samples, min(n_samples, n_init_samples), replace = False)
+   clf.fit(data[init_idx])
+
+   previous_log_likelihood = -np.inf
+   for iteration in range(max_iter):
+      Nk = np.zeros(clf.n_components)
+      Sx = np.zeros((clf.n_components, n_features))
+      Sxx = np.zeros((clf.n_components, n_features, n_features))
+      log_likelihood = 0.
+
+      # E-step using the sufficient statistics of each chunk
+      for start in range(0, n_samples, batch_size):
+         chunk = data[start:start+batch_size]
+         log_prob_norm, log_resp = clf._estimate_log_prob_resp(chunk)
+         resp = np.exp(log_resp)
+         log_likelihood += log_prob_norm.sum()
+         Nk += resp.sum(axis = 0)
+         Sx += np.dot(resp.T, chunk)
+         Sxx += np.einsum('nk,ni,nj->kij', resp, chunk, chunk)
+
+      log_likelihood /= n_samples
+
+      # M-step
+      Nk += 10 * np.finfo(resp.dtype).eps
+      means = Sx / Nk[:, np.newaxis]
+      covariances = Sxx / Nk[:, np.newaxis, np.newaxis] - np.einsum('ki,kj->kij', means, means)
+
+      if clf.covariance_type == 'full':
+         covariances += clf.reg_covar * np.eye(n_features)
+      elif clf.covariance_type == 'tied':
+         covariances = (Nk[:, np.newaxis, np.newaxis] * covariances).sum(axis = 0) / Nk.sum() + clf.reg_covar * np.eye(n_features)
+      elif clf.covariance_type == 'diag':
+         covariances = np.diagonal(covariances, axis1 = 1, axis2 = 2) + clf.reg_covar
+      else:
+         covariances = np.diagonal(covariances, axis1 = 1, axis2 = 2).mean(axis = 1) + clf.reg_covar
+
+      set_gmm_parameters(clf, Nk / Nk.sum(), means, covariances)
+
+      if np.abs(log_likelihood - previous_log_likelihood) < tol:
+         break
+      previous_log_likelihood = log_likelihood
+
+   return clf
+
+
+def minibatch_score_samples(clf, data, batch_size = 50000):
+   """
+   This routine scores the data in chunks using a fitted model (clf).
+   """
+
+   return np.concatenate([clf.score_samples(data[start:start+batch_size]) for start in range(0, len(data), batch_size)])
+
+
+def members_prob(table, clf, vars, clipping_prob = 3, data_0 = None, batch_size = None):
    """
    This routine will find probable members through scoring of a passed model (clf).
    """
@@ -1233,9 +2339,13 @@ def members_prob(table, clf, vars, clipping_prob = 3, data_0 = None):
 
       data_std = data.loc[clustering_data, :].std().values
 
-      clf.fit(data.loc[clustering_data, :] / data_std)
-
-      log_prob = clf.score_samples(data / data_std)
+      if (batch_size is not None) and (len(data) > batch_size):
+         # Online EM for very large tables, e.g. when a wide control field is included.
+         minibatch_gmm_fit(clf, data.loc[clustering_data, :].values / data_std, batch_size = batch_size, n_init_samples = batch_size)
+         log_prob = minibatch_score_samples(clf, data.values / data_std, batch_size = batch_size)
+      else:
+         clf.fit(data.loc[clustering_data, :] / data_std)
+         log_prob = clf.score_samples(data / data_std)
       label_GMM = log_prob >= np.median(log_prob[clustering_data])-clipping_prob*np.std(log_prob[clustering_data])
 
       results.loc[has_vars, 'member_clustering_prob'] = log_prob
@@ -1244,21 +2354,22 @@ def members_prob(table, clf, vars, clipping_prob = 3, data_0 = None):
    return results
 
 
-def pm_cleaning_GMM_recursive(table, vars, alt_table = None, data_0 = None, n_components = 1, covariance_type = 'full', clipping_prob = 3, plots = True, verbose = False, plot_name = ''):
+def pm_cleaning_GMM_recursive(table, vars, alt_table = None, data_0 = None, n_components = 1, covariance_type = 'full', clipping_prob = 3, batch_size = None, plots = True, verbose = False, plot_name = ''):
    """
-   This routine iteratively find members using a Gaussian mixture model.
+   This routine iteratively find members using a Gaussian mixture model. If batch_size is set, tables larger than batch_size are fitted with online EM. Only the columns in vars and clustering_data are read, so the tables do not need to be copied before the call.
    """
+   import matplotlib.pyplot as plt
+   from sklearn import mixture
    
-   table['real_data'] = True
-   
-   try:
-      table['clustering_data']
-   except:
-      table['clustering_data'] = 1
+   # Only the clustering variables are taken from the input tables, which are left untouched.
+   if 'clustering_data' in table.columns:
+      table = table.loc[:, vars+['clustering_data']]
+   else:
+      table = table.loc[:, vars].assign(clustering_data = 1)
+   table = table.assign(real_data = True)
 
    if alt_table is not None:
-      alt_table['real_data'] = False
-      alt_table['clustering_data'] = 0
+      alt_table = alt_table.loc[:, vars].assign(real_data = False, clustering_data = 0)
       table = pd.concat([table, alt_table], ignore_index = True, sort=True)
 
    clf = mixture.GaussianMixture(n_components = n_components, covariance_type = covariance_type, means_init = np.zeros((n_components, len(vars))))
@@ -1274,7 +2385,9 @@ def pm_cleaning_GMM_recursive(table, vars, alt_table = None, data_0 = None, n_co
       if iteration > 3:
          data_0 = None
 
-      fitting = members_prob(clust, clf, vars, clipping_prob = clipping_prob,  data_0 = data_0)
+      with StageReport('gmm_iteration', rows_in = len(clust), iteration = iteration) as stage:
+         fitting = members_prob(clust, clf, vars, clipping_prob = clipping_prob,  data_0 = data_0, batch_size = batch_size)
+         stage['rows_out'] = (fitting.member_clustering == 1).sum()
       
       table['member_clustering'] = fitting.member_clustering
       table['member_clustering_prob'] = fitting.member_clustering_prob
@@ -1318,25 +2431,77 @@ def remove_file(file_name):
       pass
 
 
-def applied_pert(XYmqxyrd_filename):
+def read_XYmqxyrd_header(XYmqxyrd_filename):
    """
-   This routine will read the XYmqxyrd file and find whether the PSF perturbation worked . If file not found then False.
+   This routine reads the header of a hst1pass output file, stopping at the first source. It returns a dictionary with the runtime parameters (HMIN, FMIN, NPERTs, FILT, EXPTI, etc.) as strings, the central values of the PSF perturbation, if any, as an array in 'CENTRAL PERT PSF', and the number of header lines in 'n_header_lines'.
    """
 
-   try:
-      f = open(XYmqxyrd_filename, 'r')
-      perts = []
-      for index, line in enumerate(f):
-         if '# CENTRAL PERT PSF' in line:
-            for index, line in enumerate(f):
+   header = {}
+   n_header_lines = 0
+   with open(XYmqxyrd_filename, 'r') as f:
+      for line in f:
+         if not line.startswith('#'):
+            break
+         n_header_lines += 1
+
+         if line.startswith('# CENTRAL PERT PSF'):
+            perts = []
+            for line in f:
+               n_header_lines += 1
                if len(line[10:-1].split()) > 0:
                   perts.append([float(pert) for pert in line[10:-1].split()])
                else:
                   break
-            f.close()
-            break
+            header['CENTRAL PERT PSF'] = np.array(perts)
+         elif ':' in line:
+            key, value = line[1:].split(':', 1)
+            if key.strip() not in header:
+               header[key.strip()] = value.strip()
+
+   header['n_header_lines'] = n_header_lines
+
+   return header
+
+
+def XYmqxyrd_binary_filename(XYmqxyrd_filename):
+   """
+   This routine returns the name of the binary copy of a hst1pass output file.
+   """
+
+   return XYmqxyrd_filename+'.npy'
+
+
+def read_XYmqxyrd(XYmqxyrd_filename, save_binary = True):
+   """
+   This routine reads the sources in a hst1pass output file into a NumPy structured array with the columns X, Y, m, q, x, y, r, d. The text file is parsed only once: a binary copy is saved next to it and used afterwards, unless the text file is newer.
+   """
+
+   binary_filename = XYmqxyrd_binary_filename(XYmqxyrd_filename)
+
+   if os.path.isfile(binary_filename) and (os.path.getmtime(binary_filename) >= os.path.getmtime(XYmqxyrd_filename)):
+      return np.load(binary_filename)
+
+   dtype = [('X', 'f8'), ('Y', 'f8'), ('m', 'f4'), ('q', 'f4'), ('x', 'f8'), ('y', 'f8'), ('r', 'f8'), ('d', 'f8')]
+   table = pd.read_csv(XYmqxyrd_filename, sep = r'\s+', comment = '#', header = None, names = [name for name, type in dtype], dtype = dict(dtype))
+   sources = np.empty(len(table), dtype = dtype)
+   for name, type in dtype:
+      sources[name] = table[name].values
+
+   if save_binary:
+      np.save(binary_filename, sources)
+
+   return sources
+
+
+def applied_pert(XYmqxyrd_filename):
+   """
+   This routine will read the XYmqxyrd file and find whether the PSF perturbation worked . If file not found then False.
+   """
+
+   try:
+      perts = read_XYmqxyrd_header(XYmqxyrd_filename).get('CENTRAL PERT PSF', [])
       if len(perts) > 0:
-         return np.array(perts).ptp() != 0
+         return np.ptp(perts) != 0
       else:
          print('CAUTION: No information about PSF perturbation found in %s!'%XYmqxyrd_filename)
          return True
@@ -1344,16 +2509,102 @@ def applied_pert(XYmqxyrd_filename):
       return False
 
 
-def get_fmin(i_exptime):
+def get_fmin(i_exptime):
+   """
+   This routine returns the best value for FMIN to be used in hst1pass execution based on the integration time
+   """
+
+   # These are the values for fmin at the given lower_exptime and upper_exptime
+   lower_fmin, upper_fmin = 1000, 5000
+   lower_exptime, upper_exptime = 50, 500
+
+   return min(max((int(lower_fmin + (upper_fmin - lower_fmin) * (i_exptime - lower_exptime) / (upper_exptime - lower_exptime)), 1000)), 10000)
+
+
+def predict_pert_grid(HST_image_filename, fmin, min_donors = 10, safety_factor = 1., max_pert_grid = 5):
+   """
+   This routine predicts the finest PERT grid that hst1pass will be able to use with an image. hst1pass needs at least min_donors bright, isolated and unsaturated stars in every zone of the grid to perturb the PSF. The number of such stars is estimated here with a quick pass over the image that mimics the criteria used by the Fortran routine.
+   """
+   from astropy.io import fits
+   from scipy.ndimage import maximum_filter, uniform_filter
+
+   hdul = fits.open(HST_image_filename)
+
+   x_donors, y_donors = [], []
+   y_offset = 0
+   for hdu in hdul:
+      if (hdu.name != 'SCI') or (hdu.data is None):
+         continue
+
+      # Chips are stacked one on top of the other, as hst1pass does.
+      pix = hdu.data.astype(np.float32)
+      sky = np.nanmedian(pix)
+      saturation = hdu.header.get('SATURATE', np.inf)
+
+      flux = 9 * (uniform_filter(pix, size = 3) - sky)
+      donors = (pix == maximum_filter(pix, size = 19)) & (pix >= fmin / 9.) & (pix <= saturation) & (flux >= fmin)
+      donors[:10, :] = donors[-10:, :] = donors[:, :10] = donors[:, -10:] = False
+
+      jj, ii = np.nonzero(donors)
+      x_donors.append(ii / pix.shape[1])
+      y_donors.append(jj + y_offset)
+      y_offset += pix.shape[0]
+
+   hdul.close()
+
+   if y_offset == 0:
+      return 1, 0
+
+   x_donors = np.concatenate(x_donors)
+   y_donors = np.concatenate(y_donors) / y_offset
+
+   for pert_grid in range(max_pert_grid, 0, -1):
+      donors_per_zone = np.histogram2d(x_donors, y_donors, bins = pert_grid, range = [[0, 1], [0, 1]])[0]
+      if donors_per_zone.min() >= min_donors * safety_factor:
+         break
+
+   return pert_grid, len(x_donors)
+
+
+def pert_grid_cache_key(instrument, detector, filter, exptime, predicted_pert_grid):
+   """
+   This routine returns the key used to store the PERT grid in the cache. Exposure times are grouped in classes a factor of 2 wide.
+   """
+
+   return '%s%s_%s_%i_%i'%(instrument, detector, filter, int(np.log2(max(exptime, 1.))), predicted_pert_grid)
+
+
+def read_pert_grid_cache(pert_grid_cache_filename):
+   """
+   This routine reads the PERT grids that worked in previous executions of hst1pass. It returns a dictionary with the last one used for each key.
+   """
+
+   import json
+
+   pert_grid_cache = {}
+   if (pert_grid_cache_filename is not None) and os.path.isfile(pert_grid_cache_filename):
+      with open(pert_grid_cache_filename, 'r') as f:
+         for line in f:
+            try:
+               record = json.loads(line)
+               pert_grid_cache[record['key']] = record['pert_grid']
+            except ValueError:
+               # Possibly an interrupted write
+               pass
+
+   return pert_grid_cache
+
+
+def save_pert_grid_cache(pert_grid_cache_filename, key, pert_grid):
    """
-   This routine returns the best value for FMIN to be used in hst1pass execution based on the integration time
+   This routine appends the PERT grid used with an image to the cache. Single line appends are safe when several hst1pass run in parallel.
    """
 
-   # These are the values for fmin at the given lower_exptime and upper_exptime
-   lower_fmin, upper_fmin = 1000, 5000
-   lower_exptime, upper_exptime = 50, 500
+   import json
 
-   return min(max((int(lower_fmin + (upper_fmin - lower_fmin) * (i_exptime - lower_exptime) / (upper_exptime - lower_exptime)), 1000)), 10000)
+   if pert_grid_cache_filename is not None:
+      with open(pert_grid_cache_filename, 'a') as f:
+         f.write(json.dumps({'key': key, 'pert_grid': pert_grid})+'\n')
 
 
 def hst1pass_multiproc_run(args):
@@ -1364,10 +2615,12 @@ def hst1pass_multiproc_run(args):
    return hst1pass(*args)
 
 
-def hst1pass(HST_path, obs_id, HST_image, force_fmin, force_hst1pass, remove_previous_XYmqxyrd, verbose):
+def hst1pass(HST_path, obs_id, HST_image, force_fmin, force_hst1pass, remove_previous_XYmqxyrd, verbose, pert_grid_cache_filename = None):
    """
-   This routine will execute hst1pass Fortran routine using the correct arguments.
+   This routine will execute hst1pass Fortran routine using the correct arguments. The PERT grid is predicted from the image and the cache of previous executions, so most images need a single execution of hst1pass.
    """
+   from astropy.io import fits
+   from astropy.time import Time
 
    #Define HST servicing missions times
    t_sm3 = Time('2002-03-12').mjd
@@ -1409,61 +2662,566 @@ def hst1pass(HST_path, obs_id, HST_image, force_fmin, force_hst1pass, remove_pre
 
       if remove_previous_XYmqxyrd:
          remove_file(XYmqxyrd_filename)
-
-      pert_grid = 5
-      while not applied_pert(XYmqxyrd_filename) and (pert_grid > 0):
-         # In principle, we should be abble to fine-tune FMIN knowing the exptime and the filter. Maybe for the next version.
-         bashCommand = "./Auxiliary/hst1pass.e HMIN=5 FMIN=%s PMAX=999999 GDC=%s PSF=%s PERT%i=AUTO OUT=XYmqxyrd OUTDIR=%s %s"%(fmin, gdc_filename, psf_filename, pert_grid, output_dir, HST_image_filename)
-         process = subprocess.Popen(bashCommand.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-         output, error = process.communicate()
-         pert_grid -= 1
-      
-      if verbose:
-         print('    Used PERT PSF = %sx%s'%(pert_grid, pert_grid))
+         remove_file(XYmqxyrd_binary_filename(XYmqxyrd_filename))
+
+      if not applied_pert(XYmqxyrd_filename):
+         predicted_pert_grid, n_donors = predict_pert_grid(HST_image_filename, fmin)
+         pert_grid_key = pert_grid_cache_key(instrument, detector, filter, hdul[0].header['EXPTIME'], predicted_pert_grid)
+         pert_grid = read_pert_grid_cache(pert_grid_cache_filename).get(pert_grid_key, predicted_pert_grid)
+
+         if verbose:
+            print('  %i PSF perturbation donors found. Starting with PERT PSF = %ix%i'%(n_donors, pert_grid, pert_grid))
+
+         # The prediction can be too optimistic. In that case, we try again with coarser grids.
+         used_pert_grid = pert_grid
+         while not applied_pert(XYmqxyrd_filename) and (pert_grid > 0):
+            # In principle, we should be abble to fine-tune FMIN knowing the exptime and the filter. Maybe for the next version.
+            bashCommand = "./Auxiliary/hst1pass.e HMIN=5 FMIN=%s PMAX=999999 GDC=%s PSF=%s PERT%i=AUTO OUT=XYmqxyrd OUTDIR=%s %s"%(fmin, gdc_filename, psf_filename, pert_grid, output_dir, HST_image_filename)
+            with StageReport('hst1pass', image = HST_image, pert_grid = pert_grid):
+               process = subprocess.Popen(bashCommand.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+               output, error = process.communicate()
+            used_pert_grid = pert_grid
+            pert_grid -= 1
+
+         # Only grids that hst1pass could actually apply are cached.
+         if applied_pert(XYmqxyrd_filename):
+            save_pert_grid_cache(pert_grid_cache_filename, pert_grid_key, used_pert_grid)
+            if verbose:
+               print('    Used PERT PSF = %sx%s'%(used_pert_grid, used_pert_grid))
+         elif verbose:
+            print('    No PERT PSF could be applied.')
 
       remove_file(HST_image.replace('_flc','_psf'))
 
 
-def launch_hst1pass(flc_images, HST_obs_to_use, HST_path, force_fmin = None, force_hst1pass = True, remove_previous_XYmqxyrd = True, verbose = True, use_parallel = True):
+def launch_hst1pass(flc_images, HST_obs_to_use, HST_path, force_fmin = None, force_hst1pass = True, remove_previous_XYmqxyrd = True, verbose = True, pert_grid_cache_filename = None, context = None):
    """
    This routine will launch hst1pass routine in parallel or serial 
    """
-   from multiprocessing import Pool, cpu_count
+
+   if context is None:
+      context = ExecutionContext(n_processes = 1)
 
    args = []
    for HST_image_obsid in [HST_obs_to_use] if not isinstance(HST_obs_to_use, list) else HST_obs_to_use:
       for index_image, (obs_id, HST_image) in flc_images.loc[flc_images['parent_obsid'] == HST_image_obsid, ['obs_id', 'productFilename']].iterrows():
-         args.append((HST_path, obs_id, HST_image, force_fmin, force_hst1pass, remove_previous_XYmqxyrd, verbose))
-   
-   if (len(args) > 1) and use_parallel:
-      pool = Pool(min(cpu_count(), len(args)))
-      pool.map(hst1pass_multiproc_run, args)
-      pool.close()
+         args.append((HST_path, obs_id, HST_image, force_fmin, force_hst1pass, remove_previous_XYmqxyrd, verbose, pert_grid_cache_filename))
    
-   else:
-      for arg in args:
-         hst1pass_multiproc_run(arg)
+   context.map(hst1pass_multiproc_run, args)
 
    remove_file('LOG.psfperts.fits')
    remove_file('fort.99')
 
 
-def check_mat(mat_filename, iteration, min_stars_alignment = 100, alpha = 0.01, center_tolerance = 1e-3, plots = True, fix_mat = True, clipping_prob = 2, verbose= True):
+# Rejection radii (pixels) used by xym2pm_Gaia during the iterative match.
+xym2pm_rejection_radii = np.array([99.0, 50.00, 25.00, 15.0, 10.00, 8.00, 5.00, 3.50, 2.00, 1.50, 1.20, 1.00, 0.80, 0.60, 0.45, 0.35, 0.25, 0.20, 0.16, 0.12, 0.09, 0.07, 0.05, 0.04, 0.03])
+
+# Columns and formats of the LNK and MAT files written by xym2pm_Gaia
+lnk_columns = ['xc_hst', 'yc_hst', 'm_hst', 'q_hst', 'xr_hst', 'yr_hst', 'xhst_gaia', 'yhst_gaia', 'x_gaia', 'y_gaia', 'g_gaia', 'xpm_gaia', 'ypm_gaia', 'dra_gaia', 'ddec_gaia', 'ra_gaia', 'dec_gaia', 'era_gaia', 'edec_gaia', 'pmra_gaia', 'epmra_gaia', 'pmdec_gaia', 'epmdec_gaia']
+lnk_formats = ['%12.4f']*13 + ['%16.5f']*2 + ['%14.10f']*2 + ['%14.5f']*2 + ['%10.4f']*4
+lnk_decimals = [4]*13 + [5]*2 + [10]*2 + [5]*2 + [4]*4
+
+
+def rd2xy(ra, dec, ra0, dec0):
+   """
+   This routine projects (ra, dec) onto the tangent plane centered in (ra0, dec0). It returns the (x, y) coordinates in degrees, as rd2x and rd2y in xym2pm_Gaia.
+   """
+
+   cosra, sinra = np.cos(np.radians(ra - ra0)), np.sin(np.radians(ra - ra0))
+   cosde, sinde = np.cos(np.radians(dec)), np.sin(np.radians(dec))
+   cosd0, sind0 = np.cos(np.radians(dec0)), np.sin(np.radians(dec0))
+
+   rrrr = sind0*sinde + cosd0*cosde*cosra
+
+   x = np.degrees(cosde*sinra/rrrr)
+   y = np.degrees((cosd0*sinde - sind0*cosde*cosra)/rrrr)
+
+   # Stars in the other hemisphere
+   x = np.where(rrrr < 0, 90., x)
+   y = np.where(rrrr < 0, 90., y)
+
+   return x, y
+
+
+def glob_fit6(x1, y1, x2, y2):
+   """
+   This routine finds the six-parameter linear transformation from (x1, y1) to (x2, y2): x2 = A*(x1-x1o)+B*(y1-y1o)+x2o, y2 = C*(x1-x1o)+D*(y1-y1o)+y2o. It returns (A, B, C, D, x1o, y1o, x2o, y2o), or the identity if it can not be computed.
+   """
+
+   n = len(x1)
+   if n >= 3:
+      x1o, y1o, x2o, y2o = x1.mean(), y1.mean(), x2.mean(), y2.mean()
+      dx1, dy1, dx2, dy2 = x1-x1o, y1-y1o, x2-x2o, y2-y2o
+
+      sx, sy, sw, sz = dx1.sum(), dy1.sum(), dx2.sum(), dy2.sum()
+      dsxx = sx*sx - n*(dx1*dx1).sum()
+      dsyy = sy*sy - n*(dy1*dy1).sum()
+      dsxy = sx*sy - n*(dx1*dy1).sum()
+
+      dlta = dsxx*dsyy - dsxy*dsxy
+
+      if dlta != 0:
+         dswx = sw*sx - n*(dx2*dx1).sum()
+         dswy = sw*sy - n*(dx2*dy1).sum()
+         dszx = sz*sx - n*(dy2*dx1).sum()
+         dszy = sz*sy - n*(dy2*dy1).sum()
+
+         return ((dswx*dsyy-dswy*dsxy)/dlta, (dswy*dsxx-dswx*dsxy)/dlta, (dszx*dsyy-dszy*dsxy)/dlta, (dszy*dsxx-dszx*dsxy)/dlta, x1o, y1o, x2o, y2o)
+
+   return (1., 0., 0., 1., 0., 0., 0., 0.)
+
+
+def apply_fit6(fit, x, y):
+   """
+   This routine applies a transformation found by glob_fit6.
+   """
+
+   A, B, C, D, x1o, y1o, x2o, y2o = fit
+
+   return A*(x-x1o)+B*(y-y1o)+x2o, C*(x-x1o)+D*(y-y1o)+y2o
+
+
+def barsig(values, siglim):
+   """
+   This routine returns the clipped mean, the mean absolute deviation and the number of used values, as barsig in xym2pm_Gaia.
+   """
+
+   bar, sig, nuse = 0., 9e9, 0
+   for iteration in range(5):
+      used = np.abs(values-bar) <= siglim*sig
+      nuse = used.sum()
+      if nuse == 0:
+         return 0., 0.999, 0
+      sig = np.abs(values[used]-bar).sum()/nuse
+      bar = values[used].sum()/nuse
+
+   return bar, sig, nuse
+
+
+def ord_brite(x, y, m, n_brightest):
+   """
+   This routine returns the indices of (approximately) the n_brightest brightest stars, sorted by magnitude, as ord_brite in xym2pm_Gaia.
+   """
+
+   if (len(m) == 0) or (m.max() == m.min()):
+      return np.argsort(m, kind = 'stable')
+
+   mhist = np.bincount((1 + (m-m.min())/(m.max()-m.min())*100).astype(int), minlength = 102)[1:]
+   mh = np.argmax(np.cumsum(mhist) >= min(n_brightest, len(m))) + 1
+   muse = m.min() + (mh+1.5)/100.*(m.max()-m.min())
+
+   brightest = np.flatnonzero(m < muse)
+
+   return brightest[np.argsort(m[brightest], kind = 'stable')]
+
+
+def find_offset(x1, y1, m1, x2, y2, m2, max_voters = 5000, chunk_size = 2**22):
+   """
+   This routine finds the offset between two lists voting with all the pairs of stars in 2 pixels bins. In crowded fields only the max_voters brightest stars of each list vote. It returns the pairs closer than 5 pixels once the offset is applied.
+   """
+   from scipy.spatial import cKDTree
+
+   voters1 = np.argsort(m1, kind = 'stable')[:max_voters]
+   voters2 = np.argsort(m2, kind = 'stable')[:max_voters]
+   xv1, yv1, xv2, yv2 = x1[voters1], y1[voters1], x2[voters2], y2[voters2]
+
+   # Pairs are voted in chunks of about chunk_size pairs.
+   n_rows = max(1, chunk_size // max(1, len(xv2)))
+   votes = np.zeros(501*501, dtype = int)
+   for start in range(0, len(xv1), n_rows):
+      offi = np.trunc((xv2[None, :]-xv1[start:start+n_rows, None])/2 + 0.5).astype(np.int32)
+      offj = np.trunc((yv2[None, :]-yv1[start:start+n_rows, None])/2 + 0.5).astype(np.int32)
+      inside = (np.abs(offi) <= 250) & (np.abs(offj) <= 250)
+      votes += np.bincount((250+offi[inside])*501 + (250+offj[inside]), minlength = 501*501)
+
+   votes = votes.reshape(501, 501)
+   votes = votes[:-1, :-1] + votes[1:, :-1] + votes[:-1, 1:] + votes[1:, 1:]
+   imx, jmx = np.unravel_index(np.argmax(votes), votes.shape)
+
+   OX = (imx - 250 + 0.5)*2
+   OY = (jmx - 250 + 0.5)*2
+
+   neighbours = cKDTree(np.c_[x2, y2]).query_ball_point(np.c_[x1+OX, y1+OY], r = 5.0)
+   n1 = np.repeat(np.arange(len(x1)), [len(n) for n in neighbours])
+   n2 = np.array([n2 for n in neighbours for n2 in sorted(n)], dtype = int)
+   close = np.hypot(x1[n1]-x2[n2]+OX, y1[n1]-y2[n2]+OY) < 5.0
+
+   return n1[close], n2[close]
+
+
+def triangle_match(x1, y1, m1, x2, y2, m2, n_brightest = 50, max_side = 2500.):
+   """
+   This routine finds the pairs of stars in common between two lists comparing the triangles formed by their brightest stars, as miracle_match3d in xym2pm_Gaia. Both lists should have similar scales.
+   """
+   from itertools import combinations
+   from scipy.spatial import cKDTree
+
+   if (len(x1) < n_brightest) or (len(x2) < n_brightest):
+      return np.array([], dtype = int), np.array([], dtype = int)
+
+   bright1 = ord_brite(x1, y1, m1, n_brightest)[:n_brightest]
+   bright2 = ord_brite(x2, y2, m2, n_brightest)[:n_brightest]
+
+   def triangles(x, y, first_vertices):
+      # Each side is paired with its opposite vertex, and sides are sorted by length.
+      na, nb, nc = np.array([t for t in combinations(range(n_brightest), 3) if t[0] < first_vertices]).T
+      sides = np.c_[np.hypot(x[na]-x[nb], y[na]-y[nb]), np.hypot(x[na]-x[nc], y[na]-y[nc]), np.hypot(x[nb]-x[nc], y[nb]-y[nc])]
+      vertices = np.c_[nc, nb, na]
+      valid = (sides.min(axis = 1) > 0) & (sides.max(axis = 1) <= max_side)
+      order = np.argsort(sides[valid], axis = 1, kind = 'stable')
+      return np.take_along_axis(sides[valid], order, axis = 1), np.take_along_axis(vertices[valid], order, axis = 1)
+
+   xb1, yb1 = x1[bright1], y1[bright1]
+   xb2, yb2 = x2[bright2], y2[bright2]
+
+   sides1, vertices1 = triangles(xb1, yb1, n_brightest)
+   sides2, vertices2 = triangles(xb2, yb2, 10)
+
+   if (len(sides1) == 0) or (len(sides2) == 0):
+      return np.array([], dtype = int), np.array([], dtype = int)
+
+   distance, nearest = cKDTree(sides1).query(sides2, distance_upper_bound = 2.0)
+   tree2_bright = cKDTree(np.c_[xb2, yb2])
+   tree2 = cKDTree(np.c_[x2, y2])
+
+   for candidate in np.flatnonzero(np.isfinite(distance)):
+      t1, t2 = vertices1[nearest[candidate]], vertices2[candidate]
+      fit = glob_fit6(xb1[t1], yb1[t1], xb2[t2], yb2[t2])
+
+      xt, yt = apply_fit6(fit, xb1, yb1)
+      dmu, nmu = tree2_bright.query(np.c_[xt, yt], distance_upper_bound = 2.5)
+      found = np.isfinite(dmu)
+
+      if found.sum() >= 10:
+         A, B, C, D, x1o, y1o, x2o, y2o = glob_fit6(xb1[found], yb1[found], xb2[nmu[found]], yb2[nmu[found]])
+         # The final transformation is forced to be conformal
+         A, B = (A+D)/2, (B-C)/2
+         xt, yt = apply_fit6((A, B, -B, A, x1o, y1o, x2o, y2o), x1, y1)
+         dmu, nmu = tree2.query(np.c_[xt, yt], distance_upper_bound = 1.5)
+         found = np.isfinite(dmu)
+         found[found] = m2[nmu[found]] <= -3.5
+
+         return np.flatnonzero(found), nmu[found]
+
+   return np.array([], dtype = int), np.array([], dtype = int)
+
+
+def purify_matches(x1, y1, x2, y2, dmax):
+   """
+   This routine removes, one at a time, the pairs of stars that are not consistent with a linear transformation to within dmax pixels.
+   """
+
+   keep = np.ones(len(x1), dtype = bool)
+   while keep.sum() >= 3:
+      xt, yt = apply_fit6(glob_fit6(x1[keep], y1[keep], x2[keep], y2[keep]), x1[keep], y1[keep])
+      dd = np.hypot(x2[keep]-xt, y2[keep]-yt)
+      good = dd < max(0.9*dd.max(), dmax)
+      if good.all():
+         break
+      keep[keep] = good
+
+   return keep
+
+
+def incorporate_matches(x1b, y1b, x2b, y2b, x1, y1, x2, y2, disc):
+   """
+   This routine finds, using the transformation implied by a list of pairs, the closest star of the second list to each star of the first one, within disc pixels (L1 distance). Pairs are one-to-one, which avoids false pairs in crowded fields.
+   """
+   from scipy.spatial import cKDTree
+
+   xt, yt = apply_fit6(glob_fit6(x1b, y1b, x2b, y2b), x1, y1)
+   dmin, nmin = cKDTree(np.c_[x2, y2]).query(np.c_[xt, yt], p = 1, distance_upper_bound = disc)
+   n1 = np.flatnonzero(dmin < disc)
+
+   # Each star of the second list is only paired with its closest star of the first list.
+   order = np.lexsort((dmin[n1], nmin[n1]))
+   n1 = n1[order]
+   closest = np.r_[True, nmin[n1][1:] != nmin[n1][:-1]]
+   n1 = np.sort(n1[closest])
+
+   return n1, nmin[n1]
+
+
+def miracle_match(x1, y1, m1, x2, y2, m2, n_rejection_iterations, start = None):
+   """
+   This routine finds the stars in common between two lists, as miracle_match in xym2pm_Gaia. If no starting pairs of indices are given, they are searched assuming a simple offset or, else, comparing triangles of bright stars. The pairs are then refined using all the stars and the rejection radii of the first n_rejection_iterations iterations. It returns the indices of the stars in common.
+   """
+
+   n1, n2 = (np.array([], dtype = int), np.array([], dtype = int)) if start is None else start
+
+   methods = []
+   if len(n1) == 0:
+      methods = [lambda: find_offset(x1, y1, m1, x2, y2, m2), lambda: triangle_match(x1, y1, m1, x2, y2, m2)]
+      min_starting_pairs = [lambda n: ((n >= 0.5*len(x1)) or (n >= 0.5*len(x2))) and (n >= 5), lambda n: n >= 10]
+
+   for method in range(max(1, len(methods))):
+      if len(methods) > 0:
+         n1, n2 = methods[method]()
+         if not min_starting_pairs[method](len(n1)):
+            continue
+
+      x1b, y1b, x2b, y2b = x1[n1], y1[n1], x2[n2], y2[n2]
+
+      n_net = 7
+      if n_rejection_iterations < n_net:
+         n_net = max(1, n_rejection_iterations-1)
+      disc = xym2pm_rejection_radii[n_net-1]
+
+      keep = purify_matches(x1b, y1b, x2b, y2b, max(2.0, disc))
+      n1, n2 = incorporate_matches(x1b[keep], y1b[keep], x2b[keep], y2b[keep], x1, y1, x2, y2, disc)
+
+      for iteration in range(n_rejection_iterations):
+         if len(n1) == 0:
+            break
+         xt, yt = apply_fit6(glob_fit6(x2[n2], y2[n2], x1[n1], y1[n1]), x2[n2], y2[n2])
+         good = np.hypot(xt-x1[n1], yt-y1[n1]) < xym2pm_rejection_radii[iteration]
+         n1, n2 = n1[good], n2[good]
+
+      if (len(n1) >= 10) or (len(methods) == 0):
+         return n1, n2
+
+   return np.array([], dtype = int), np.array([], dtype = int)
+
+
+def wcs_proximity_match(hst_ra, hst_dec, gaia_ra, gaia_dec, ra_cent, dec_cent, search_radius):
+   """
+   This routine matches each HST source with the closest Gaia star within search_radius arcsec, using the (ra, dec) coordinates given by the header WCS, as the BRUTE mode of xym2pm_Gaia. It returns the indices of the pairs found.
+   """
+   from scipy.spatial import cKDTree
+
+   hst_u, hst_v = rd2xy(hst_ra, hst_dec, ra_cent, dec_cent)
+   gaia_u, gaia_v = rd2xy(gaia_ra, gaia_dec, ra_cent, dec_cent)
+
+   dmin, nmin = cKDTree(np.c_[gaia_u, gaia_v]*3600.).query(np.c_[hst_u, hst_v]*3600., distance_upper_bound = search_radius*(1+1e-9))
+   found = np.isfinite(dmin)
+
+   return nmin[found], np.flatnonzero(found)
+
+
+def xym2pm_Gaia_limits_exceeded(n_gaia, hst, max_hash_conflicts = 0.01, max_stars = 999999):
+   """
+   This routine checks whether a field is too large or too crowded for the fixed-size arrays and hash tables of the xym2pm_Gaia Fortran routine. The routine keeps only the brightest source per cell of its 2001x2001 matching hash, so fields where more than a fraction max_hash_conflicts of the HST sources would be lost are better matched with python_xym2pm_Gaia.
+   """
+
+   if (n_gaia > max_stars) or (len(hst) > max_stars):
+      return True
+
+   if len(hst) == 0:
+      return False
+
+   x, y = hst['X'], hst['Y']
+   x_span, y_span = max(x.max()-x.min(), 2000.), max(y.max()-y.min(), 2000.)
+   cells = (1 + 2000*((x+0.5)-x.min())/x_span).astype(int)*2002 + (1 + 2000*((y+0.5)-y.min())/y_span).astype(int)
+
+   return (len(cells) - len(np.unique(cells))) > max_hash_conflicts*len(cells)
+
+
+def python_xym2pm_Gaia(gaia, hst, ra_cent, dec_cent, pixel_scale, instrument, detector, crval = None, max_separation = 5.0, min_stars_alignment = 25, use_sat = True, mat = None, force_mat = False, wcs_search_radius = None, xcen = 5000., ycen = 5000., xy_epoch = 2015.5, gaia_epoch = 2016.0):
+   """
+   This routine matches the Gaia stars with the sources found by hst1pass in an HST image, following the same steps as the xym2pm_Gaia Fortran routine: tangent-plane projection, search of an initial match (offset vote or triangles of bright stars), iterative six-parameter linear transformations with progressively relaxed magnitude and QFIT limits, and nearest-neighbour match of all the stars. gaia is a 2D array with the columns of the Gaia input table, and hst is a structured array as returned by read_XYmqxyrd. It returns the LNK table (a DataFrame) and the MAT array, with the same columns as the files written by xym2pm_Gaia, or (None, None) if no match was found.
+
+   Nearest-neighbour searches use KD-trees, so there are no limits in the number of stars and crowded fields are matched in O(N log N). If wcs_search_radius is given, the initial match is searched within that radius (arcsec) using the (ra, dec) coordinates of the HST sources, as the BRUTE mode of xym2pm_Gaia.
+   """
+   from scipy.spatial import cKDTree
+
+   ra, era, dec, edec, pmra, epmra, pmdec, epmdec, gmag, use_gaia = gaia.T
+
+   # Stars are projected onto a tangent plane in pixels
+   dra, ddec = rd2xy(ra, dec, ra_cent, dec_cent)
+   x_o, y_o = xcen - dra*3600./pixel_scale, ycen + ddec*3600./pixel_scale
+
+   # Positions at the epoch of the HST image. Only stars with PMs are used.
+   dyears = xy_epoch - gaia_epoch
+   if dyears != 0:
+      with_pm = (pmra != 0) & (pmdec != 0) & (epmra != 0) & (epmdec != 0)
+      xpm_o = np.where(with_pm, x_o - pmra/1000./pixel_scale*dyears, 0.)
+      ypm_o = np.where(with_pm, y_o + pmdec/1000./pixel_scale*dyears, 0.)
+   else:
+      xpm_o, ypm_o = x_o.copy(), y_o.copy()
+
+   valid_gaia = (xpm_o > 0) & (ypm_o > 0)
+   use_gaia = valid_gaia & (use_gaia == 1)
+
+   # Radius that would cover the detector size
+   rad_det = {('ACS', 'HRC'): 0.01, ('ACS', 'WFC'): 0.06, ('WFC3', 'UVIS'): 0.045, ('WFC3', 'IR'): 0.035}.get((instrument, detector), 0.)
+   if crval is None:
+      crval = (ra_cent, dec_cent)
+   dra_loc, ddec_loc = rd2xy(crval[0], crval[1], ra_cent, dec_cent)
+   xcen_loc, ycen_loc = xcen - dra_loc*3600./pixel_scale, ycen + ddec_loc*3600./pixel_scale
+   initial_gaia = valid_gaia & (np.hypot(xpm_o-xcen_loc, ypm_o-ycen_loc) < (rad_det*3600./pixel_scale+200.))
+
+   xc, yc, mh, qh = hst['X'].astype(float), hst['Y'].astype(float), hst['m'].astype(float), hst['q'].astype(float)
+
+   def hst_stars(mlim, qlim, saturated = use_sat):
+      if saturated:
+         return np.flatnonzero((mh <= mlim) & (qh >= 0) & (qh <= qlim))
+      else:
+         return np.flatnonzero((mh <= mlim) & (qh > 0) & (qh <= qlim))
+
+   def match(gaia_stars, hst_stars, n_rejection_iterations, start = None):
+      # Indices are converted to and from the subsets
+      if start is not None:
+         n1, n2 = [np.clip(np.searchsorted(stars, indices), 0, max(len(stars)-1, 0)) for stars, indices in zip((gaia_stars, hst_stars), start)]
+         in_subsets = (gaia_stars[n1] == start[0]) & (hst_stars[n2] == start[1]) if (len(gaia_stars) > 0) and (len(hst_stars) > 0) else np.zeros(len(n1), dtype = bool)
+         start = (n1[in_subsets], n2[in_subsets])
+      n1, n2 = miracle_match(xpm_o[gaia_stars], ypm_o[gaia_stars], gmag[gaia_stars], xc[hst_stars], yc[hst_stars], mh[hst_stars], n_rejection_iterations, start = start)
+      return gaia_stars[n1], hst_stars[n2]
+
+   def pairs_from_mat(mat):
+      # MAT files store positions, so stars are identified again by their position.
+      gaia_tree, hst_tree = cKDTree(np.c_[xpm_o, ypm_o]), cKDTree(np.c_[xc, yc])
+      dg, ng = gaia_tree.query(mat[:, 0:2], distance_upper_bound = 1e-3)
+      dh, nh = hst_tree.query(mat[:, 2:4], distance_upper_bound = 1e-3)
+      found = np.isfinite(dg) & np.isfinite(dh)
+      return ng[found], nh[found]
+
+   gaia_stars = np.flatnonzero(use_gaia)
+
+   if (mat is not None) and force_mat:
+      pairs = pairs_from_mat(mat)
+   else:
+      start = pairs_from_mat(mat) if mat is not None else None
+
+      # Proximity match in equatorial coordinates. As in the BRUTE mode of xym2pm_Gaia, its pairs replace those of the previous MAT as starting point whenever a search radius is given, so the option is meant for sparse fields where the other methods fail.
+      if (wcs_search_radius is not None) and ((instrument, detector) in [('ACS', 'WFC'), ('WFC3', 'UVIS')]):
+         bright_hst, region_gaia = hst_stars(-8., 0.3, saturated = True), np.flatnonzero(initial_gaia)
+         n_gaia, n_hst = wcs_proximity_match(hst['r'][bright_hst], hst['d'][bright_hst], ra[region_gaia], dec[region_gaia], ra_cent, dec_cent, wcs_search_radius)
+         if len(n_hst) > 0:
+            start = (region_gaia[n_gaia], bright_hst[n_hst])
+
+      # First guess with saturated stars
+      initial_pairs = match(np.flatnonzero(initial_gaia), hst_stars(-8., 0.3, saturated = True), 5, start = start)
+      if len(initial_pairs[0]) == 0:
+         return None, None
+
+      bar = barsig(gmag[initial_pairs[0]] - mh[initial_pairs[1]], 2.0)[0]
+
+      if not use_sat:
+         if len(match(gaia_stars, hst_stars(-8., 0.3), 5)[0]) == 0:
+            return None, None
+
+      # The best match possible is searched, relaxing the magnitude and QFIT limits, and the number of required stars.
+      mlims = [-12.5]
+      while mlims[-1] < 21.5-bar:
+         mlims.append(mlims[-1] + 0.5)
+      qlims = [0.05]
+      while qlims[-1] < 0.3:
+         qlims.append(qlims[-1] + 0.05)
+
+      matches_cache = {}
+      def relaxed_match(mlim, qlim):
+         if (mlim, qlim) not in matches_cache:
+            matches_cache[(mlim, qlim)] = match(gaia_stars, hst_stars(mlim, qlim), 5, start = initial_pairs)
+         return matches_cache[(mlim, qlim)]
+
+      nlim, nstep = 500, 50
+      mlim, qlim = mlims[0], qlims[0]
+      pairs = relaxed_match(mlim, qlim)
+      while (len(pairs[0]) < nlim) and (nlim >= min_stars_alignment):
+         for qlim in qlims:
+            for mlim in mlims:
+               pairs = relaxed_match(mlim, qlim)
+               if len(pairs[0]) >= nlim:
+                  break
+            if len(pairs[0]) >= nlim:
+               break
+         if len(pairs[0]) < nlim:
+            mlim, qlim = mlims[0], qlims[0]
+            if nlim < 100:
+               nstep = 1
+            nlim -= nstep
+            pairs = relaxed_match(mlim, qlim)
+
+      if len(pairs[0]) < min_stars_alignment:
+         return None, None
+
+      pairs = match(gaia_stars, hst_stars(-8., 0.3, saturated = True), 5, start = pairs)
+      pairs = match(gaia_stars, hst_stars(mlim, qlim), 5, start = pairs)
+
+      # Stars with residuals larger than 3.5 times the average are removed
+      xt, yt = apply_fit6(glob_fit6(xc[pairs[1]], yc[pairs[1]], xpm_o[pairs[0]], ypm_o[pairs[0]]), xc[pairs[1]], yc[pairs[1]])
+      dr = np.hypot(xpm_o[pairs[0]]-xt, ypm_o[pairs[0]]-yt)
+      n_rejection_iterations = min(np.argmin(np.abs(xym2pm_rejection_radii - 3.5*barsig(dr, 3.5)[0])) + 2, len(xym2pm_rejection_radii))
+      good = dr < xym2pm_rejection_radii[n_rejection_iterations-1]
+      if good.sum() == 0:
+         return None, None
+
+      pairs = match(gaia_stars, hst_stars(mlim, qlim), n_rejection_iterations, start = (pairs[0][good], pairs[1][good]))
+
+   if len(pairs[0]) < 3:
+      return None, None
+
+   # MAT: stars used in the transformation from HST to Gaia
+   fit = glob_fit6(xc[pairs[1]], yc[pairs[1]], xpm_o[pairs[0]], ypm_o[pairs[0]])
+   xglob, yglob = apply_fit6(fit, xc[pairs[1]], yc[pairs[1]])
+   mat = np.c_[xpm_o[pairs[0]], ypm_o[pairs[0]], xc[pairs[1]], yc[pairs[1]], gmag[pairs[0]], mh[pairs[1]], xpm_o[pairs[0]]-xglob, ypm_o[pairs[0]]-yglob, xglob, yglob]
+
+   # LNK: closest HST source to each Gaia star
+   A, B, C, D, Xo, Yo, Wo, Zo = fit
+   delta = A*D-B*C
+   xr = (D/delta)*(xpm_o-Wo) + (-B/delta)*(ypm_o-Zo) + Xo
+   yr = (-C/delta)*(xpm_o-Wo) + (A/delta)*(ypm_o-Zo) + Yo
+
+   dmin, nmin = cKDTree(np.c_[xc, yc]).query(np.c_[xr, yr], distance_upper_bound = min(max_separation, 9.))
+   found = np.isfinite(dmin) & ((xpm_o != 0) | (ypm_o != 0))
+   nmin = np.where(found, nmin, 0)
+
+   xhst_gaia, yhst_gaia = apply_fit6(fit, xc[nmin], yc[nmin])
+   hst_columns = np.c_[xc[nmin], yc[nmin], mh[nmin], qh[nmin], hst['x'][nmin], hst['y'][nmin], xhst_gaia, yhst_gaia]
+   hst_columns[~found, :] = 0.
+
+   lnk = pd.DataFrame(np.c_[hst_columns, x_o, y_o, gmag, xpm_o, ypm_o, dra*3600., ddec*3600., ra, dec, era/1000., edec/1000., pmra, epmra, pmdec, epmdec], columns = lnk_columns)
+
+   return lnk, mat
+
+
+def write_lnk(lnk_filename, lnk):
+   """
+   This routine writes a LNK table with the same format used by xym2pm_Gaia.
+   """
+
+   np.savetxt(lnk_filename, lnk[lnk_columns].values, fmt = lnk_formats, header = ' '.join(lnk_columns), comments = '# ')
+
+
+def lnk_as_read(lnk):
+   """
+   This routine rounds a LNK table as it is written in the LNK file, and flags zeros as missing values, as xym2pm_Gaia does when the LNK file is read.
+   """
+
+   lnk = lnk.round(dict(zip(lnk_columns, lnk_decimals)))
+
+   return lnk.mask(lnk == 0.0)
+
+
+def mat_binary_filename(mat_filename):
+   """
+   This routine returns the name of the binary copy of a MAT file.
+   """
+
+   return mat_filename+'.npy'
+
+
+def check_mat(mat_filename, iteration, min_stars_alignment = 100, alpha = 0.01, center_tolerance = 1e-3, plots = True, fix_mat = True, clipping_prob = 2, verbose= True, mat = None, save_mat = True):
    """
-   This routine will read the transformation file MAT and provide a quality flag based on how Gaussian the transformation is.
+   This routine will read the transformation file MAT and provide a quality flag based on how Gaussian the transformation is. The MAT array can be given directly if it is already in memory. If fix_mat, the stars that deviate from a spherical Gaussian are removed for the next iteration, and the MAT file is only rewritten if save_mat and some star was removed. It returns the quality flags and the MAT array for the next iteration.
    """
+   import matplotlib.pyplot as plt
+   from scipy import stats
 
-   mat = np.loadtxt(mat_filename)
+   if mat is None:
+      mat = np.loadtxt(mat_filename)
 
    if fix_mat:
-      clf = mixture.GaussianMixture(n_components = 1, covariance_type = 'spherical')
-      clf.fit(mat[:, 6:8])
-      log_prob = clf.score_samples(mat[:, 6:8])
+      # Log-likelihood of a single spherical Gaussian, as a one-component GaussianMixture.
+      residuals = mat[:, 6:8] - mat[:, 6:8].mean(axis = 0)
+      variance = (residuals**2).mean() + 1e-6
+      log_prob = -0.5*(residuals**2).sum(axis = 1)/variance - np.log(2*np.pi*variance)
       good_for_alignment = log_prob >= np.median(log_prob)-clipping_prob*np.std(log_prob)
-      if verbose and (good_for_alignment.sum() < len(log_prob)): print('   Fixing MAT file for next iteration.')
-      np.savetxt(mat_filename, mat[good_for_alignment, :], fmt='%12.4f')
+      if good_for_alignment.sum() < len(log_prob):
+         if verbose: print('   Fixing MAT file for next iteration.')
+         if save_mat: np.savetxt(mat_filename, mat[good_for_alignment, :], fmt='%12.4f')
    else:
-      good_for_alignment = [True]*len(mat)
+      good_for_alignment = np.ones(len(mat), dtype = bool)
 
    with warnings.catch_warnings():
       warnings.simplefilter("ignore")
@@ -1491,13 +3249,16 @@ def check_mat(mat_filename, iteration, min_stars_alignment = 100, alpha = 0.01,
       plt.savefig(mat_filename.split('.MAT')[0]+'_MAT_%i.png'%iteration, bbox_inches='tight')
       plt.close()
 
-   return valid
+   return valid, mat[good_for_alignment, :]
 
 
-def xym2pm_Gaia(iteration, Gaia_HST_table_field, Gaia_HST_table_filename, HST_image_filename, lnk_filename, mat_filename, date_reference_second_epoch, only_use_members, force_pixel_scale, force_max_separation, force_use_sat, fix_mat, force_wcs_search_radius, min_stars_alignment, verbose, force_xym2pm, plots):   
+def xym2pm_Gaia(iteration, Gaia_HST_table_filename, HST_image_filename, lnk_filename, mat_filename, date_reference_second_epoch, only_use_members, force_pixel_scale, force_max_separation, force_use_sat, fix_mat, force_wcs_search_radius, min_stars_alignment, verbose, force_xym2pm, plots, matcher = 'fortran', previous_mat = None):   
    """
-   This routine will execute xym2pm_Gaia Fortran routine using the correct arguments.
+   This routine will execute xym2pm_Gaia Fortran routine using the correct arguments, or its Python version python_xym2pm_Gaia if matcher is 'python'. With matcher 'auto', the Python version is only used when the field exceeds the limits of the Fortran routine. The Gaia input table has to be written beforehand with write_xym2pm_Gaia_input. previous_mat is the corrected MAT of the previous iteration, kept in memory by launch_xym2pm_Gaia. It returns the match and the corrected MAT for the next iteration, which is not written to disk.
    """
+   from astropy.io import fits
+   from astropy.wcs import WCS
+   from astropy.wcs.utils import proj_plane_pixel_scales
 
    hdul = fits.open(HST_image_filename)
    t_max = hdul[0].header['EXPEND']
@@ -1518,12 +3279,48 @@ def xym2pm_Gaia(iteration, Gaia_HST_table_field, Gaia_HST_table_filename, HST_im
 
    pixel_scale_mas = 1e3 * pixel_scale
 
-   if not os.path.isfile(lnk_filename) or force_xym2pm:
+   lnk, mat = None, None
 
-      f = open(Gaia_HST_table_filename, 'w+')
-      f.write('# ')
-      Gaia_HST_table_field.loc[:, ['ra', 'ra_error', 'dec', 'dec_error', 'pmra', 'pmra_error', 'pmdec', 'pmdec_error', 'gmag', 'use_for_alignment']].astype({'use_for_alignment': 'int32'}).to_csv(f, index = False, sep = ' ', na_rep = 0)
-      f.close()
+   if (not os.path.isfile(lnk_filename) or force_xym2pm) and (matcher in ['python', 'auto']):
+      gaia = np.loadtxt(Gaia_HST_table_filename, ndmin = 2)
+      hst = read_XYmqxyrd(HST_image_filename.split('.fits')[0]+'.XYmqxyrd')
+
+      if matcher == 'auto':
+         # Crowded or very large fields are matched with KD-trees.
+         matcher = 'python' if xym2pm_Gaia_limits_exceeded(len(gaia), hst) else 'fortran'
+         if verbose and (matcher == 'python'): print('-->%s: field too crowded for xym2pm_Gaia.e, using python_xym2pm_Gaia.'%os.path.basename(HST_image_filename))
+
+   if (not os.path.isfile(lnk_filename) or force_xym2pm) and (matcher == 'python'):
+
+      if force_max_separation is None:
+         max_separation = 5.0
+      else:
+         max_separation = force_max_separation
+
+      # The previous MAT, or that of a previous run, is used as starting point, as xym2pm_Gaia does.
+      if previous_mat is not None:
+         pass
+      elif os.path.isfile(mat_binary_filename(mat_filename)):
+         previous_mat = np.load(mat_binary_filename(mat_filename))
+      elif os.path.isfile(mat_filename):
+         previous_mat = np.loadtxt(mat_filename, ndmin = 2)
+
+      with StageReport('python_xym2pm_Gaia', rows_in = len(gaia), image = os.path.basename(HST_image_filename), iteration = iteration, hst_stars = len(hst)) as stage:
+         lnk, mat = python_xym2pm_Gaia(gaia, hst, ra_cent, dec_cent, pixel_scale, hdul[0].header['INSTRUME'].strip(), hdul[0].header['DETECTOR'].strip(), crval = (hdul[1].header['CRVAL1'], hdul[1].header['CRVAL2']), max_separation = max_separation, min_stars_alignment = min_stars_alignment, use_sat = force_use_sat, mat = previous_mat, force_mat = fix_mat and (iteration > 0), wcs_search_radius = force_wcs_search_radius)
+         stage['rows_out'] = 0 if lnk is None else len(lnk)
+
+      if lnk is None:
+         # The LNK and MAT of the previous iteration are not a solution for this one.
+         remove_file(lnk_filename)
+         remove_file(mat_filename)
+         remove_file(mat_binary_filename(mat_filename))
+         print('-->%s: no match found.'%os.path.basename(HST_image_filename))
+         return pd.DataFrame(), None
+
+      write_lnk(lnk_filename, lnk)
+      lnk = lnk_as_read(lnk)
+
+   elif not os.path.isfile(lnk_filename) or force_xym2pm:
 
       # Here it goes the executable line. Input values can be fine-tuned here
       if force_use_sat:
@@ -1532,6 +3329,9 @@ def xym2pm_Gaia(iteration, Gaia_HST_table_field, Gaia_HST_table_filename, HST_im
          use_sat = ''
 
       if (fix_mat) and (iteration > 0):
+         # xym2pm_Gaia.e only reads the MAT of the previous iteration from its file.
+         if previous_mat is not None:
+            np.savetxt(mat_filename, previous_mat, fmt='%12.4f')
          use_mat = " MAT=\"%s\" USEMAT+"%(mat_filename.split('./')[1])
       else:
          use_mat = ''
@@ -1548,9 +3348,11 @@ def xym2pm_Gaia(iteration, Gaia_HST_table_field, Gaia_HST_table_filename, HST_im
 
       bashCommand = "./Auxiliary/xym2pm_Gaia.e %s %s RACEN=%f DECEN=%f XCEN=5000.0 YCEN=5000.0 PSCL=%s SIZE=10000 DISP=%.1f NMIN=%i TIME=2015.5%s%s%s"%(Gaia_HST_table_filename, HST_image_filename, ra_cent, dec_cent, pixel_scale, max_separation, min_stars_alignment, use_sat, use_mat, use_brute)
 
-      process = subprocess.Popen(bashCommand.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-      output, error = process.communicate()
+      with StageReport('xym2pm_Gaia', image = os.path.basename(HST_image_filename), iteration = iteration):
+         process = subprocess.Popen(bashCommand.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+         output, error = process.communicate()
 
+   fixed_mat = None
    try:
       # Next are threshold rejection values for the MAT files.
       if (iteration > 0) & only_use_members:
@@ -1558,14 +3360,24 @@ def xym2pm_Gaia(iteration, Gaia_HST_table_field, Gaia_HST_table_filename, HST_im
       else:
          alpha = 1e-32
 
-      valid_mat = check_mat(mat_filename, iteration, min_stars_alignment, alpha = alpha, fix_mat = fix_mat, clipping_prob = 3., plots = plots, verbose = verbose)
+      # The MAT of the Python matcher is in memory, or in binary format if it was not run.
+      if matcher == 'auto':
+         matcher = 'python' if os.path.isfile(mat_binary_filename(mat_filename)) else 'fortran'
+
+      if (matcher == 'python') and (mat is None) and os.path.isfile(mat_binary_filename(mat_filename)):
+         mat = np.load(mat_binary_filename(mat_filename))
+
+      valid_mat, fixed_mat = check_mat(mat_filename, iteration, min_stars_alignment, alpha = alpha, fix_mat = fix_mat, clipping_prob = 3., plots = plots, verbose = verbose, mat = mat, save_mat = False)
 
       if all(valid_mat):
 
-         f = open(lnk_filename, 'r')
-         header = [w.replace('m_hst', filter) for w in f.readline().rstrip().strip("# ").split(' ')]
-         lnk = pd.read_csv(f, names=header, sep = '\s+', comment='#', na_values = 0.0).set_index(Gaia_HST_table_field.index)
-         f.close()
+         if lnk is None:
+            f = open(lnk_filename, 'r')
+            header = [w.replace('m_hst', filter) for w in f.readline().rstrip().strip("# ").split(' ')]
+            lnk = pd.read_csv(f, names=header, sep = r'\s+', comment='#', na_values = 0.0).set_index(np.load(xym2pm_Gaia_index_filename(Gaia_HST_table_filename)))
+            f.close()
+         else:
+            lnk = lnk.rename(columns = {'m_hst': filter}).set_index(np.load(xym2pm_Gaia_index_filename(Gaia_HST_table_filename)))
 
          # Positional and mag error is know to be proportional to the QFIT parameter.
          eradec_hst = lnk.q_hst
@@ -1579,52 +3391,122 @@ def xym2pm_Gaia(iteration, Gaia_HST_table_field, Gaia_HST_table_filename, HST_im
 
          # Notice the 1e3. xym2pm_Gaia.e takes the error in mas/yr but returns it in arcsec.
 
-         lnk['relative_hst_gaia_pmra_error'] = eradec_hst / t_baseline
-         lnk['relative_hst_gaia_pmdec_error'] = eradec_hst / t_baseline
-         lnk['gaia_ra_uncertaintity'] = 1e3 * lnk.era_gaia / t_baseline
-         lnk['gaia_dec_uncertaintity'] = 1e3 * lnk.edec_gaia / t_baseline
+         lnk['relative_hst_gaia_pmra_error'] = eradec_hst / t_baseline
+         lnk['relative_hst_gaia_pmdec_error'] = eradec_hst / t_baseline
+         lnk['gaia_ra_uncertaintity'] = 1e3 * lnk.era_gaia / t_baseline
+         lnk['gaia_dec_uncertaintity'] = 1e3 * lnk.edec_gaia / t_baseline
+
+         lnk['%s_error'%filter] = lnk.q_hst.replace({0:lnk.q_hst.max()})
+
+         match = lnk.loc[:, [filter, '%s_error'%filter, 'relative_hst_gaia_pmra', 'relative_hst_gaia_pmra_error', 'relative_hst_gaia_pmdec', 'relative_hst_gaia_pmdec_error', 'gaia_ra_uncertaintity', 'gaia_dec_uncertaintity']]
+
+         print('-->%s: matched %i stars.'%(os.path.basename(HST_image_filename), len(match)))
+
+      else:
+         print('-->%s: bad quality match.'%os.path.basename(HST_image_filename))
+         if not valid_mat[0]:
+            print('   Non Gaussian distribution found in the transformation')
+         if not valid_mat[1]:
+            print('   Not (0,0) average of the distribution')
+         if not valid_mat[2]:
+            print('   Less than %i stars used during the transformation'%min_stars_alignment)
+         print('   Skipping image.')
+         match = pd.DataFrame()
+   except:
+      print('-->%s: no match found.'%os.path.basename(HST_image_filename))
+      match = pd.DataFrame()
+
+   return match, fixed_mat
+
+
+def xym2pm_Gaia_index_filename(Gaia_HST_table_filename):
+   """
+   This routine returns the name of the file with the index of the stars in the Gaia input table of xym2pm_Gaia.
+   """
+
+   return Gaia_HST_table_filename.split('.ascii')[0]+'_index.npy'
+
+
+def write_xym2pm_Gaia_input(Gaia_HST_table_field, Gaia_HST_table_filename, lnk_filename, force_xym2pm = True):
+   """
+   This routine writes the Gaia input table of xym2pm_Gaia and the index of its stars. It is run by the parent process, so the workers only receive file names instead of the tables. The table is only written if xym2pm_Gaia is going to be executed.
+   """
+
+   np.save(xym2pm_Gaia_index_filename(Gaia_HST_table_filename), Gaia_HST_table_field.index.values)
+
+   if not os.path.isfile(lnk_filename) or force_xym2pm:
+      f = open(Gaia_HST_table_filename, 'w+')
+      f.write('# ')
+      Gaia_HST_table_field.loc[:, ['ra', 'ra_error', 'dec', 'dec_error', 'pmra', 'pmra_error', 'pmdec', 'pmdec_error', 'gmag', 'use_for_alignment']].astype({'use_for_alignment': 'int32'}).to_csv(f, index = False, sep = ' ', na_rep = 0)
+      f.close()
+
+
+def xym2pm_Gaia_multiproc(args):
+   """
+   This routine pipes xym2pm_Gaia into multiple threads.
+   """
+
+   return xym2pm_Gaia(*args)
+
+
+def xym2pm_Gaia_filenames(HST_path, obs_id, HST_image):
+   """
+   This routine returns the names of the image, the Gaia input table, and the LNK and MAT files used by xym2pm_Gaia for an HST image.
+   """
+
+   HST_image_filename = HST_path+'mastDownload/HST/'+obs_id+'/'+HST_image
+   Gaia_HST_table_filename = HST_path+'Gaia_%s.ascii'%HST_image.split('.fits')[0]
+   lnk_filename = HST_image_filename.split('.fits')[0]+'.LNK'
+   mat_filename = HST_image_filename.split('.fits')[0]+'.MAT'
+
+   return HST_image_filename, Gaia_HST_table_filename, lnk_filename, mat_filename
 
-         lnk['%s_error'%filter] = lnk.q_hst.replace({0:lnk.q_hst.max()})
 
-         match = lnk.loc[:, [filter, '%s_error'%filter, 'relative_hst_gaia_pmra', 'relative_hst_gaia_pmra_error', 'relative_hst_gaia_pmdec', 'relative_hst_gaia_pmdec_error', 'gaia_ra_uncertaintity', 'gaia_dec_uncertaintity']]
+def prepare_xym2pm_Gaia(Gaia_HST_table, obs_id, HST_image_filename, lnk_filename, mat_filename, min_stars_alignment = 100, remove_previous_files = True):
+   """
+   This routine finds the Gaia stars within an HST image before its first xym2pm_Gaia iteration. If not enough stars are flagged for the alignment, all of them will be used.
+   """
 
-         print('-->%s: matched %i stars.'%(os.path.basename(HST_image_filename), len(match)))
+   if remove_previous_files:
+      remove_file(mat_filename)
+      remove_file(mat_binary_filename(mat_filename))
+      remove_file(lnk_filename)
 
-      else:
-         print('-->%s: bad quality match.'%os.path.basename(HST_image_filename))
-         if not valid_mat[0]:
-            print('   Non Gaussian distribution found in the transformation')
-         if not valid_mat[1]:
-            print('   Not (0,0) average of the distribution')
-         if not valid_mat[2]:
-            print('   Less than %i stars used during the transformation'%min_stars_alignment)
-         print('   Skipping image.')
-         match = pd.DataFrame()
-   except:
-      print('-->%s: no match found.'%os.path.basename(HST_image_filename))
-      match = pd.DataFrame()
+   Gaia_HST_table = find_stars_to_align(Gaia_HST_table, HST_image_filename)
+   if (Gaia_HST_table.loc[Gaia_HST_table['HST_image'].str.contains(str(obs_id)), 'use_for_alignment'].sum() < min_stars_alignment):
+      Gaia_HST_table.loc[Gaia_HST_table['HST_image'].str.contains(str(obs_id)), 'use_for_alignment'] = True
 
-   return match
+   return Gaia_HST_table
 
 
-def xym2pm_Gaia_multiproc(args):
+def reference_stars_change(previous_reference_stars, reference_stars):
    """
-   This routine pipes xym2pm_Gaia into multiple threads.
+   This routine returns the fraction of reference stars of an image that changed between two alignments.
    """
 
-   return xym2pm_Gaia(*args)
+   changed = len(previous_reference_stars.symmetric_difference(reference_stars))
 
+   return changed / max(len(previous_reference_stars), 1)
 
-def launch_xym2pm_Gaia(Gaia_HST_table, data_products_by_obs, HST_obs_to_use, HST_path, date_reference_second_epoch, only_use_members = False, force_pixel_scale = None, force_max_separation = None, force_use_sat = True, fix_mat = True, force_wcs_search_radius = None, n_components = 1, clipping_prob = 6, min_stars_alignment = 100, use_mean = 'wmean', plots = True, verbose = True, force_xym2pm = True, remove_previous_files = True, use_parallel = True, plot_name = ''):
+
+def launch_xym2pm_Gaia(Gaia_HST_table, data_products_by_obs, HST_obs_to_use, HST_path, date_reference_second_epoch, only_use_members = False, force_pixel_scale = None, force_max_separation = None, force_use_sat = True, fix_mat = True, force_wcs_search_radius = None, n_components = 1, clipping_prob = 6, min_stars_alignment = 100, use_mean = 'wmean', plots = True, verbose = True, force_xym2pm = True, remove_previous_files = True, context = None, cmd_polygons_path = None, interactive = True, reuse_cmd_selections = True, first_iteration_matches = None, matcher = 'fortran', realign_threshold = 0., mat_plots = False, plot_name = ''):
    """
-   This routine will launch xym2pm_Gaia Fortran routine in parallel or serial using the correct arguments.
+   This routine will launch xym2pm_Gaia Fortran routine in parallel or serial using the correct arguments. Images in first_iteration_matches already went through their first iteration, e.g. in launch_HST_pipeline. In later iterations, images are only aligned again if the fraction of their reference stars that changed is larger than realign_threshold. The corrected MATs are kept in memory between iterations and written once, in binary format, at the end. The diagnostic plots of the MAT files are only made if mat_plots.
    """
-   from multiprocessing import Pool, cpu_count
+
+   if context is None:
+      context = ExecutionContext(n_processes = 1)
+
+   if first_iteration_matches is None:
+      first_iteration_matches = {}
+
+   # Reference stars and match of each image in its last alignment, and its MAT file and corrected MAT
+   alignments = {}
+   mats = {}
 
    n_images = len(data_products_by_obs.loc[data_products_by_obs['parent_obsid'].isin([HST_obs_to_use] if not isinstance(HST_obs_to_use, list) else HST_obs_to_use), :])
    
-   if (n_images > 1) and use_parallel:
-      pool = Pool(min(cpu_count(), n_images))
+   if (n_images > 1) and context.parallel:
       plots = False
       verbose = False
 
@@ -1636,33 +3518,47 @@ def launch_xym2pm_Gaia(Gaia_HST_table, data_products_by_obs, HST_obs_to_use, HST
       print("-----------")
 
       args = []
+      aligned_images = []
+      lnks = []
+      n_reused = 0
       for index_image, (obs_id, HST_image) in data_products_by_obs.loc[data_products_by_obs['parent_obsid'].isin([HST_obs_to_use] if not isinstance(HST_obs_to_use, list) else HST_obs_to_use), ['obs_id', 'productFilename']].iterrows():
 
-         HST_image_filename = HST_path+'mastDownload/HST/'+obs_id+'/'+HST_image
-         Gaia_HST_table_filename = HST_path+'Gaia_%s.ascii'%HST_image.split('.fits')[0]
-         lnk_filename = HST_image_filename.split('.fits')[0]+'.LNK'
-         mat_filename = HST_image_filename.split('.fits')[0]+'.MAT'
+         HST_image_filename, Gaia_HST_table_filename, lnk_filename, mat_filename = xym2pm_Gaia_filenames(HST_path, obs_id, HST_image)
 
          if iteration == 0:
-            if remove_previous_files:
-               remove_file(mat_filename)
-               remove_file(lnk_filename)
+            if HST_image in first_iteration_matches:
+               in_image = Gaia_HST_table['HST_image'].str.contains(str(obs_id))
+               match, mats[HST_image] = first_iteration_matches[HST_image][0], (mat_filename, first_iteration_matches[HST_image][1])
+               alignments[HST_image] = (Gaia_HST_table.index[in_image & (Gaia_HST_table['use_for_alignment'] == True)], match)
+               lnks.append(match)
+               continue
 
-            Gaia_HST_table = find_stars_to_align(Gaia_HST_table, HST_image_filename)
-            if (Gaia_HST_table.loc[Gaia_HST_table['HST_image'].str.contains(str(obs_id)), 'use_for_alignment'].sum() < min_stars_alignment):
-               Gaia_HST_table.loc[Gaia_HST_table['HST_image'].str.contains(str(obs_id)), 'use_for_alignment'] = True
+            Gaia_HST_table = prepare_xym2pm_Gaia(Gaia_HST_table, obs_id, HST_image_filename, lnk_filename, mat_filename, min_stars_alignment = min_stars_alignment, remove_previous_files = remove_previous_files)
 
-         Gaia_HST_table_field = Gaia_HST_table.loc[Gaia_HST_table['HST_image'].str.contains(str(obs_id)), :]
+         in_image = Gaia_HST_table['HST_image'].str.contains(str(obs_id))
+         reference_stars = Gaia_HST_table.index[in_image & (Gaia_HST_table['use_for_alignment'] == True)]
 
-         args.append((iteration, Gaia_HST_table_field, Gaia_HST_table_filename, HST_image_filename, lnk_filename, mat_filename, date_reference_second_epoch, only_use_members, force_pixel_scale, force_max_separation, force_use_sat, fix_mat, force_wcs_search_radius, min_stars_alignment, verbose, force_xym2pm, plots))
+         # Images whose reference stars did not change (much) keep their previous match.
+         if (HST_image in alignments) and (reference_stars_change(alignments[HST_image][0], reference_stars) <= realign_threshold):
+            lnks.append(alignments[HST_image][1])
+            n_reused += 1
+            continue
 
-      if (len(args) > 1) and use_parallel:
-         lnks = pool.map(xym2pm_Gaia_multiproc, args)
+         write_xym2pm_Gaia_input(Gaia_HST_table.loc[in_image, :], Gaia_HST_table_filename, lnk_filename, force_xym2pm = force_xym2pm)
 
-      else:
-         lnks = []
-         for arg in args:
-            lnks.append(xym2pm_Gaia_multiproc(arg))
+         args.append((iteration, Gaia_HST_table_filename, HST_image_filename, lnk_filename, mat_filename, date_reference_second_epoch, only_use_members, force_pixel_scale, force_max_separation, force_use_sat, fix_mat, force_wcs_search_radius, min_stars_alignment, verbose, force_xym2pm, plots and mat_plots, matcher, mats.get(HST_image, (None, None))[1]))
+         aligned_images.append((HST_image, reference_stars, mat_filename))
+
+      if n_reused > 0:
+         print('-->%i images with the same reference stars as in the previous iteration. Using their previous match.'%n_reused)
+
+      matches = []
+      for (HST_image, reference_stars, mat_filename), (match, fixed_mat) in zip(aligned_images, context.map(xym2pm_Gaia_multiproc, args)):
+         alignments[HST_image] = (reference_stars, match)
+         mats[HST_image] = (mat_filename, fixed_mat)
+         matches.append(match)
+
+      lnks += matches
 
       try:
          lnks = pd.concat(lnks, sort=True)
@@ -1670,7 +3566,9 @@ def launch_xym2pm_Gaia(Gaia_HST_table, data_products_by_obs, HST_obs_to_use, HST
          print('WARNING: No match could be found for any of the images. Please try with other parameters.\nExiting now.')
          sys.exit(1)
 
-      lnks_averaged = lnks.groupby(lnks.index).apply(weighted_avg_err)
+      with StageReport('lnk_averaging', rows_in = len(lnks), iteration = iteration) as stage:
+         lnks_averaged = grouped_weighted_avg_err(lnks)
+         stage['rows_out'] = len(lnks_averaged)
       
       # Gaia positional errors have to be added in quadrature 
       lnks_averaged['relative_hst_gaia_pmra_mean_error'] = np.sqrt(lnks_averaged['relative_hst_gaia_pmra_mean_error']**2 +  lnks_averaged['gaia_ra_uncertaintity_mean']**2)
@@ -1690,17 +3588,19 @@ def launch_xym2pm_Gaia(Gaia_HST_table, data_products_by_obs, HST_obs_to_use, HST
             hst_filters = [col for col in lnks_averaged.columns if ('F' in col) & ('error' not in col) & ('std' not in col) & ('_mean' not in col)]
             hst_filters.sort()
             if len(hst_filters) == 2:
-               Gaia_HST_table['clustering_data'] =  manual_select_from_cmd((Gaia_HST_table[hst_filters[0]]-Gaia_HST_table[hst_filters[1]]).rename('%s - %s'%(hst_filters[0], hst_filters[1])), Gaia_HST_table[hst_filters[1]])
+               color, mag = (Gaia_HST_table[hst_filters[0]]-Gaia_HST_table[hst_filters[1]]).rename('%s - %s'%(hst_filters[0], hst_filters[1])), Gaia_HST_table[hst_filters[1]]
+               Gaia_HST_table['clustering_data'] =  manual_select_from_cmd(color, mag, polygon_filename = cmd_polygon_filename(cmd_polygons_path, color.name, mag.name, iteration = iteration), interactive = interactive, reuse = reuse_cmd_selections)
             else:
                for cmd_filter in hst_filters:
-                  Gaia_HST_table['%s_clustering_data_cmd'%cmd_filter] =  manual_select_from_cmd((Gaia_HST_table['gmag']-Gaia_HST_table[cmd_filter]).rename('Gmag - %s'%cmd_filter), Gaia_HST_table['gmag'].rename('Gmag'))
+                  color, mag = (Gaia_HST_table['gmag']-Gaia_HST_table[cmd_filter]).rename('Gmag - %s'%cmd_filter), Gaia_HST_table['gmag'].rename('Gmag')
+                  Gaia_HST_table['%s_clustering_data_cmd'%cmd_filter] =  manual_select_from_cmd(color, mag, polygon_filename = cmd_polygon_filename(cmd_polygons_path, color.name, mag.name, iteration = iteration), interactive = interactive, reuse = reuse_cmd_selections)
 
                cmd_clustering_filters = [col for col in Gaia_HST_table.columns if '_clustering_data_cmd' in col]
                Gaia_HST_table['clustering_data'] = (Gaia_HST_table.loc[:, cmd_clustering_filters] == True).any(axis = 1)
                Gaia_HST_table.drop(columns = cmd_clustering_filters, inplace = True)
 
          # Select stars in the PM space asuming spherical covariance (Reasonable for dSphs and globular clusters) 
-         pm_clustering = pm_cleaning_GMM_recursive(Gaia_HST_table.copy(), ['relative_hst_gaia_pmra_%s'%use_mean, 'relative_hst_gaia_pmdec_%s'%use_mean], data_0 = [0, 0], n_components = 1, covariance_type = 'spherical', clipping_prob = clipping_prob, plots = plots, plot_name = '%s_%i'%(plot_name, iteration))
+         pm_clustering = pm_cleaning_GMM_recursive(Gaia_HST_table, ['relative_hst_gaia_pmra_%s'%use_mean, 'relative_hst_gaia_pmdec_%s'%use_mean], data_0 = [0, 0], n_components = 1, covariance_type = 'spherical', clipping_prob = clipping_prob, plots = plots, plot_name = '%s_%i'%(plot_name, iteration))
          new_use_for_alignment = pm_clustering & Gaia_HST_table.clustering_data
 
          if iteration > 4:
@@ -1715,19 +3615,130 @@ def launch_xym2pm_Gaia(Gaia_HST_table, data_products_by_obs, HST_obs_to_use, HST
          iteration += 1
       else:
          convergence = True
-   
-   if (n_images > 1) and use_parallel:
-      pool.close()
+
+   for mat_filename, fixed_mat in mats.values():
+      if fixed_mat is not None:
+         np.save(mat_binary_filename(mat_filename), fixed_mat)
 
    Gaia_HST_table = Gaia_HST_table[Gaia_HST_table['relative_hst_gaia_pmdec_%s'%use_mean].notnull() & Gaia_HST_table['relative_hst_gaia_pmra_%s'%use_mean].notnull()]
 
    return Gaia_HST_table
 
 
+def hst1pass_xym2pm_Gaia_multiproc(args):
+   """
+   This routine pipes hst1pass and the first xym2pm_Gaia iteration of an image into multiple threads.
+   """
+
+   hst1pass_args, xym2pm_args = args
+
+   hst1pass(*hst1pass_args)
+
+   return xym2pm_Gaia(*xym2pm_args)
+
+
+def launch_HST_pipeline(Gaia_HST_table, data_products_by_obs, HST_obs_to_use, HST_path, date_reference_second_epoch, n_transfers = 4, base_url = 'https://mast.stsci.edu/api/v0.1/Download/file', force_fmin = None, force_hst1pass = True, pert_grid_cache_filename = None, only_use_members = False, force_pixel_scale = None, force_max_separation = None, force_use_sat = True, fix_mat = True, force_wcs_search_radius = None, n_components = 1, clipping_prob = 6, min_stars_alignment = 100, use_mean = 'wmean', plots = True, verbose = True, force_xym2pm = True, remove_previous_files = True, context = None, cmd_polygons_path = None, interactive = True, reuse_cmd_selections = True, matcher = 'fortran', realign_threshold = 0., mat_plots = False, plot_name = ''):
+   """
+   This routine downloads the HST images and, as soon as each FLC image lands, runs hst1pass and the first xym2pm_Gaia iteration on it using a pool of processes. This way downloads, source finding and matching overlap. The remaining iterations are performed by launch_xym2pm_Gaia.
+   """
+
+   import queue
+   import threading
+
+   if context is None:
+      context = ExecutionContext(n_processes = 1)
+
+   # Landed images, the end of the downloads and finished images arrive through the same queue.
+   events = queue.Queue()
+   stop = threading.Event()
+
+   # Stages are named as in run_pipeline without --pipeline_hst, although here they overlap.
+   def download():
+      try:
+         with StageReport('download_HST_images', rows_in = len(data_products_by_obs)) as stage:
+            hst_images = download_HST_images(data_products_by_obs, path = HST_path, n_transfers = n_transfers, base_url = base_url, on_download = lambda record: events.put(('landed', record)), stop = stop)
+            stage['rows_out'] = (hst_images.status != 'ERROR').sum()
+         events.put(('downloaded', hst_images))
+      except Exception as e:
+         events.put(('downloaded', e))
+
+   # The workers are forked before the downloader thread starts.
+   context.start()
+
+   downloader = threading.Thread(target = download)
+   downloader.start()
+
+   futures = {}
+   first_iteration_matches = {}
+   failed_images = []
+   hst_images = None
+   downloading = True
+
+   # This stage also includes the first xym2pm_Gaia iteration of each image.
+   try:
+      with StageReport('launch_hst1pass') as stage:
+         while downloading or (len(futures) > 0):
+            event, content = events.get()
+
+            if event == 'downloaded':
+               downloading = False
+               hst_images = content
+
+            elif event == 'landed':
+               # Images that just landed are sent to the pool.
+               if content['productSubGroupDescription'] == 'FLC':
+                  obs_id, HST_image = content['obs_id'], content['productFilename']
+                  HST_image_filename, Gaia_HST_table_filename, lnk_filename, mat_filename = xym2pm_Gaia_filenames(HST_path, obs_id, HST_image)
+
+                  Gaia_HST_table = prepare_xym2pm_Gaia(Gaia_HST_table, obs_id, HST_image_filename, lnk_filename, mat_filename, min_stars_alignment = min_stars_alignment, remove_previous_files = remove_previous_files)
+                  write_xym2pm_Gaia_input(Gaia_HST_table.loc[Gaia_HST_table['HST_image'].str.contains(str(obs_id)), :], Gaia_HST_table_filename, lnk_filename, force_xym2pm = force_xym2pm)
+
+                  hst1pass_args = (HST_path, obs_id, HST_image, force_fmin, force_hst1pass, remove_previous_files, verbose and not context.parallel, pert_grid_cache_filename)
+                  xym2pm_args = (0, Gaia_HST_table_filename, HST_image_filename, lnk_filename, mat_filename, date_reference_second_epoch, only_use_members, force_pixel_scale, force_max_separation, force_use_sat, fix_mat, force_wcs_search_radius, min_stars_alignment, verbose and not context.parallel, force_xym2pm, False, matcher)
+
+                  future = context.submit(hst1pass_xym2pm_Gaia_multiproc, (hst1pass_args, xym2pm_args))
+                  futures[future] = HST_image
+                  future.add_done_callback(lambda future: events.put(('done', future)))
+
+            else:
+               # Images that finished their first iteration are collected.
+               HST_image = futures.pop(content)
+               try:
+                  first_iteration_matches[HST_image] = content.result()
+               except Exception as e:
+                  # launch_xym2pm_Gaia does not run hst1pass, so these images are not used.
+                  print('-->%s: hst1pass or the first xym2pm_Gaia iteration failed. Skipping image. %s'%(HST_image, e))
+                  failed_images.append(HST_image)
+         stage['rows_in'] = len(first_iteration_matches) + len(failed_images)
+   finally:
+      # If anything fails, the pending downloads and images are cancelled.
+      stop.set()
+      for future in futures:
+         future.cancel()
+      downloader.join()
+
+   if isinstance(hst_images, Exception):
+      raise hst_images
+
+   remove_file('LOG.psfperts.fits')
+   remove_file('fort.99')
+
+   downloaded = data_products_by_obs['productFilename'].isin(hst_images.loc[hst_images.status != 'ERROR', 'productFilename'])
+   flc_images = data_products_by_obs[(data_products_by_obs['productSubGroupDescription'] == 'FLC') & downloaded & ~data_products_by_obs['productFilename'].isin(failed_images)]
+
+   with StageReport('launch_xym2pm_Gaia', rows_in = len(Gaia_HST_table)) as stage:
+      Gaia_HST_table = launch_xym2pm_Gaia(Gaia_HST_table, flc_images, HST_obs_to_use, HST_path, date_reference_second_epoch, only_use_members = only_use_members, force_pixel_scale = force_pixel_scale, force_max_separation = force_max_separation, force_use_sat = force_use_sat, fix_mat = fix_mat, force_wcs_search_radius = force_wcs_search_radius, n_components = n_components, clipping_prob = clipping_prob, min_stars_alignment = min_stars_alignment, use_mean = use_mean, plots = plots, verbose = verbose, force_xym2pm = force_xym2pm, remove_previous_files = remove_previous_files, context = context, cmd_polygons_path = cmd_polygons_path, interactive = interactive, reuse_cmd_selections = reuse_cmd_selections, first_iteration_matches = first_iteration_matches, matcher = matcher, realign_threshold = realign_threshold, mat_plots = mat_plots, plot_name = plot_name)
+      stage['rows_out'] = len(Gaia_HST_table)
+
+   return Gaia_HST_table, hst_images
+
+
 def find_stars_to_align(stars_catalog, HST_image_filename):
    """
    This routine will find which stars from stars_catalog within and HST image.
    """
+   from astropy.io import fits
+   from astropy.wcs import WCS
 
    from shapely.geometry.polygon import Polygon as shap_polygon
    from shapely.geometry import Point
@@ -1811,9 +3822,48 @@ def weighted_avg_err(table):
    return pd.concat([weighted_avg, weighted_avg_error, avg, avg_error, std])
 
 
+def grouped_weighted_avg_err(table):
+   """
+   Weighted average, its error, average, its error and standard deviation of every column for each group of rows with the same index, as table.groupby(table.index).apply(weighted_avg_err) but computed with segmented reductions over the sorted index.
+   """
+
+   table = table.iloc[np.argsort(table.index.values, kind = 'stable'), :]
+   keys, starts, sizes = np.unique(table.index.values, return_index = True, return_counts = True)
+
+   def group_sum(values):
+      return np.add.reduceat(values, starts) if len(values) > 0 else np.zeros(0)
+
+   def group_std(values, ddof):
+      valid = ~np.isnan(values)
+      count = group_sum(valid.astype(float))
+      mean = group_sum(np.where(valid, values, 0.)) / count
+      squares = group_sum(np.where(valid, (values - np.repeat(mean, sizes))**2, 0.))
+      return mean, np.where(count > ddof, np.sqrt(squares / (count - ddof)), np.nan)
+
+   var_cols = [x for x in table.columns if not '_error' in x]
+
+   weighted_avg, weighted_avg_error, avg, avg_error, std = {}, {}, {}, {}, {}
+   with np.errstate(divide = 'ignore', invalid = 'ignore'):
+      for col in var_cols:
+         x_i = table[col].values.astype(float)
+         if '%s_error'%col in table.columns:
+            ex_i = table['%s_error'%col].values.astype(float)
+         else:
+            ex_i = np.repeat(group_std(x_i, 0)[1], sizes)
+
+         weighted_variance = 1./group_sum(np.nan_to_num(1./ex_i**2, nan = 0., posinf = np.inf))
+         weighted_avg['%s_wmean'%col] = group_sum(np.where(np.isnan(x_i/ex_i**2), 0., x_i/ex_i**2)) * weighted_variance
+         weighted_avg_error.setdefault('%s_wmean_error'%('%s_error'%col).rstrip('_error'), np.sqrt(weighted_variance))
+
+         avg['%s_mean'%col], std['%s_std'%col] = group_std(x_i, 1)
+         avg_error['%s_mean_error'%col] = std['%s_std'%col] / np.sqrt(sizes)
+
+   return pd.DataFrame({**weighted_avg, **weighted_avg_error, **avg, **avg_error, **std}, index = pd.Index(keys, name = table.index.name))
+
+
 def absolute_pm(table):
    """
-   This routine computes the absolute PM just adding the absolute differences between Gaia and HST PMs.
+   This routine computes the absolute PM just adding the absolute differences between Gaia and HST PMs. The table is only read, and the absolute PMs are returned as new columns to be joined to it.
    """   
 
    pm_differences_wmean = table.loc[:, ['pmra', 'pmdec']] - table.loc[:, ['relative_hst_gaia_pmra_wmean', 'relative_hst_gaia_pmdec_wmean']].values
@@ -1825,11 +3875,68 @@ def absolute_pm(table):
    pm_differences_weighted = weighted_avg_err(pm_differences_wmean.join(pm_differences_wmean_error))
    pm_differences = weighted_avg_err(pm_differences_mean.join(pm_differences_mean_error))
 
-   table['hst_gaia_pmra_wmean'], table['hst_gaia_pmdec_wmean'] = table.relative_hst_gaia_pmra_wmean + pm_differences_weighted.pmra_wmean, table.relative_hst_gaia_pmdec_wmean + pm_differences_weighted.pmdec_wmean
-   table['hst_gaia_pmra_wmean_error'], table['hst_gaia_pmdec_wmean_error'] = np.sqrt(table.relative_hst_gaia_pmra_wmean_error**2 + pm_differences_weighted.pmra_wmean_error**2), np.sqrt(table.relative_hst_gaia_pmdec_wmean_error**2 + pm_differences_weighted.pmdec_wmean_error**2)
+   absolute = pd.DataFrame(index = table.index)
+
+   absolute['hst_gaia_pmra_wmean'], absolute['hst_gaia_pmdec_wmean'] = table.relative_hst_gaia_pmra_wmean + pm_differences_weighted.pmra_wmean, table.relative_hst_gaia_pmdec_wmean + pm_differences_weighted.pmdec_wmean
+   absolute['hst_gaia_pmra_wmean_error'], absolute['hst_gaia_pmdec_wmean_error'] = np.sqrt(table.relative_hst_gaia_pmra_wmean_error**2 + pm_differences_weighted.pmra_wmean_error**2), np.sqrt(table.relative_hst_gaia_pmdec_wmean_error**2 + pm_differences_weighted.pmdec_wmean_error**2)
+
+   absolute['hst_gaia_pmra_mean'], absolute['hst_gaia_pmdec_mean'] = table.relative_hst_gaia_pmra_mean + pm_differences.pmra_mean, table.relative_hst_gaia_pmdec_mean + pm_differences.pmdec_mean
+   absolute['hst_gaia_pmra_mean_error'], absolute['hst_gaia_pmdec_mean_error'] = np.sqrt(table.relative_hst_gaia_pmra_mean_error**2 + pm_differences.pmra_mean_error**2), np.sqrt(table.relative_hst_gaia_pmdec_mean_error**2 + pm_differences.pmdec_mean_error**2)
+
+   return absolute
+
+
+def local_pm_correction(table, k = 25, max_radius = None, statistic = 'median', min_neighbours = 5):
+   """
+   This routine removes spatially correlated residuals from the absolute PMs. For every star, the offset of its k closest reference stars (use_for_alignment) in the tangent plane with respect to the mean PM of all the reference stars is subtracted, see Figure 3 in https://iopscience.iop.org/article/10.3847/1538-4357/aaa3ec/pdf. The offset is their median or, if statistic is 'wmean', their weighted average. Reference stars are not used to correct themselves. max_radius (arcsec) limits the neighbours used, and stars with less than min_neighbours are not corrected.
+   """
+   from scipy.spatial import cKDTree
+
+   reference = np.flatnonzero(table.use_for_alignment.values == True)
+
+   if len(reference) < min_neighbours:
+      print('-->Not enough reference stars for the local correction.')
+      return table
+
+   x, y = rd2xy(table.ra.values, table.dec.values, table.ra.mean(), table.dec.mean())
+   positions = np.c_[x, y]*3600.
+
+   # One extra neighbour, as reference stars are their own closest neighbour.
+   distances, neighbours = cKDTree(positions[reference]).query(positions, k = min(k+1, len(reference)), distance_upper_bound = np.inf if max_radius is None else max_radius)
+   distances, neighbours = distances.reshape(len(table), -1), neighbours.reshape(len(table), -1)
+   valid = np.isfinite(distances)
+   valid &= reference[np.minimum(neighbours, len(reference)-1)] != np.arange(len(table))[:, None]
+   valid &= np.cumsum(valid, axis = 1) <= k
+   neighbours = np.minimum(neighbours, len(reference)-1)
 
-   table['hst_gaia_pmra_mean'], table['hst_gaia_pmdec_mean'] = table.relative_hst_gaia_pmra_mean + pm_differences.pmra_mean, table.relative_hst_gaia_pmdec_mean + pm_differences.pmdec_mean
-   table['hst_gaia_pmra_mean_error'], table['hst_gaia_pmdec_mean_error'] = np.sqrt(table.relative_hst_gaia_pmra_mean_error**2 + pm_differences.pmra_mean_error**2), np.sqrt(table.relative_hst_gaia_pmdec_mean_error**2 + pm_differences.pmdec_mean_error**2)
+   corrected = valid.sum(axis = 1) >= min_neighbours
+
+   for use_mean in ['wmean', 'mean']:
+      for pm in ['pmra', 'pmdec']:
+         col = 'hst_gaia_%s_%s'%(pm, use_mean)
+         values, errors = table[col].values, table['%s_error'%col].values
+
+         residuals = np.where(valid, values[reference][neighbours] - np.nanmean(values[reference]), np.nan)
+         residual_errors = np.where(valid, errors[reference][neighbours], np.nan)
+
+         with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            if statistic == 'wmean':
+               weights = 1./residual_errors**2
+               offset = np.nansum(residuals*weights, axis = 1)/np.nansum(np.where(np.isnan(residuals), np.nan, weights), axis = 1)
+               offset_error = 1./np.sqrt(np.nansum(np.where(np.isnan(residuals), np.nan, weights), axis = 1))
+            else:
+               offset = np.nanmedian(residuals, axis = 1)
+               offset_error = 1.2533*np.nanstd(residuals, axis = 1)/np.sqrt(np.sum(~np.isnan(residuals), axis = 1))
+
+         offset = np.where(corrected & np.isfinite(offset), offset, 0.)
+         offset_error = np.where(corrected & np.isfinite(offset_error), offset_error, 0.)
+
+         table['%s_local_offset'%col] = offset
+         table[col] = values - offset
+         table['%s_error'%col] = np.sqrt(errors**2 + offset_error**2)
+
+   print('-->Local correction applied to %i stars using up to %i neighbours.'%(corrected.sum(), k))
 
    return table
 
@@ -1847,6 +3954,7 @@ def cli_progress_test(current, end_val, bar_length=50):
 
 
 def add_inner_title(ax, title, loc, size=None, **kwargs):
+    import matplotlib.pyplot as plt
     from matplotlib.offsetbox import AnchoredText
     from matplotlib.patheffects import withStroke
 
@@ -1864,6 +3972,11 @@ def plot_results(table, hst_image_list, HST_path, use_mean = 'wmean', plot_name_
    """
    Plot results
    """
+   import matplotlib.pyplot as plt
+   from astropy.io import fits
+   from astropy.wcs import WCS
+   import astropy.units as u
+   from astropy.visualization import ImageNormalize, ManualInterval
 
    pmra_lims = [table['hst_gaia_pmra_%s'%use_mean].mean()-5*table['hst_gaia_pmra_%s'%use_mean].std(), table['hst_gaia_pmra_%s'%use_mean].mean()+5*table['hst_gaia_pmra_%s'%use_mean].std()]
    pmdec_lims = [table['hst_gaia_pmdec_%s'%use_mean].mean()-5*table['hst_gaia_pmdec_%s'%use_mean].std(), table['hst_gaia_pmdec_%s'%use_mean].mean()+5*table['hst_gaia_pmdec_%s'%use_mean].std()]
@@ -2041,13 +4154,14 @@ def get_object_properties(args):
    """
    This routine will try to obtain all the required object properties from Simbad or from the user.
    """
+   from astropy.time import Time
+   import astropy.units as u
+   from astropy.coordinates import SkyCoord
 
    #Try to get object:
    if (args.ra is None) or (args.dec is None):
       try:
          from astroquery.simbad import Simbad
-         import astropy.units as u
-         from astropy.coordinates import SkyCoord
 
          customSimbad = Simbad()
          customSimbad.add_votable_fields('distance', 'propermotions', 'dim', 'fe_h')
@@ -2069,7 +4183,7 @@ def get_object_properties(args):
                   args.distance = float(object_table['Distance_distance'])
                elif object_table['Distance_unit'] == 'pc':
                   args.distance = float(object_table['Distance_distance']*1e-3)
-            else:
+            elif not args.silent:
                try:
                   args.distance = float(input('Distance to the object not found, please enter distance in kpc (Press enter to skip): '))
                except:
@@ -2079,6 +4193,8 @@ def get_object_properties(args):
          if (args.feh is None) and args.use_members and not args.force_manual_cmd_cleaning:
             if (object_table['Fe_H_Fe_H'].mask == False):
                args.feh = float(object_table['Fe_H_Fe_H'])
+            elif args.silent:
+               args.feh = [-3., 0.]
             else:
                try:
                   print('Metallicity [Fe/H] not defined, please enter one or more values for [Fe/H] separated by spaces (Press enter to adopt the default values [-3, 0]): ')
@@ -2093,7 +4209,7 @@ def get_object_properties(args):
          if args.max_search_radius is None:
             if (object_table['GALDIM_MAJAXIS'].mask == False):
                args.max_search_radius = max(2.0 * np.round(float(2. * object_table['GALDIM_MAJAXIS'] / 60.), 2), 0.1)
-            else:
+            elif not args.silent:
                try:
                   args.max_search_radius = float(input('Search radius not defined, please enter the search radius in degrees (Press enter to adopt the default value of 1 deg): '))
                except:
@@ -2161,6 +4277,9 @@ def get_object_properties(args):
                args.max_parallax = 999.
 
       except:
+         if args.silent and ((args.ra is None) or (args.dec is None)):
+            print('Object %s not found and (ra, dec) not defined. Please provide --ra and --dec.\nExiting now.'%args.name)
+            sys.exit(1)
          if args.ra is None:
             args.ra = float(input('R.A. not defined, please enter R.A. in degrees: '))
          if args.dec is None:
@@ -2241,10 +4360,14 @@ def get_object_properties(args):
    args.HST_path = args.base_path+'HST/'
    args.Gaia_path = args.base_path+'Gaia/'
    args.Gaia_ind_queries_path = args.Gaia_path+'individual_queries/'
+   if args.cmd_polygons_path is None:
+      args.cmd_polygons_path = args.base_path+'CMD_polygons/'
    
    args.used_HST_obs_table_filename = args.base_path + args.base_file_name+'_used_HST_images.csv'
    args.HST_Gaia_table_filename = args.base_path + args.base_file_name+'.csv'
    args.logfile = args.base_path + args.base_file_name+'.log'
+   args.run_report_filename = args.base_path + args.base_file_name+'_run_report'
+   args.profile_path = args.base_path+'Profiles/'
    args.queries = args.Gaia_path + args.base_file_name+'_queries.log'
    
    args.Gaia_raw_table_filename = args.Gaia_path + args.base_file_name+'_raw.csv'
@@ -2280,9 +4403,276 @@ def str2bool(v):
       raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
-def main(argv):  
+def remove_cli_options(argv, options):
    """
-   Inputs
+   This routine removes the given options, and their values, from a list of command line arguments.
+   """
+
+   clean_argv = []
+   skip = False
+   for arg in argv:
+      if skip and not arg.startswith('--'):
+         continue
+      skip = False
+      if arg.split('=')[0] in options:
+         skip = '=' not in arg
+         continue
+      clean_argv.append(arg)
+
+   return clean_argv
+
+
+def read_targets(targets_filename, argv):
+   """
+   This routine reads the list of targets and returns the arguments for each of them. The list is a CSV file with at least a 'name' column or 'ra' and 'dec' columns. Any other column is taken as a per-target override of the corresponding option.
+   """
+
+   targets = pd.read_csv(targets_filename, dtype = str, skipinitialspace = True)
+
+   return [target_arguments(target.dropna().to_dict(), argv) for index_target, target in targets.iterrows()]
+
+
+def target_arguments(target, argv):
+   """
+   This routine returns the name and the command line arguments of a target, given as a dictionary of option values ('name' or 'ra' and 'dec', plus any other option) that are added to argv.
+   """
+
+   target = dict(target)
+   target_argv = list(argv)
+
+   if 'name' not in target:
+      target['name'] = 'ra_%.3f_dec_%.3f'%(float(target['ra']), float(target['dec']))
+
+   for option, value in target.items():
+      if option == 'name':
+         target_argv += ['--name', str(value).strip()]
+      elif isinstance(value, (list, tuple)):
+         target_argv += ['--%s'%option] + [str(v) for v in value]
+      else:
+         target_argv += ['--%s'%option] + str(value).split()
+
+   return str(target['name']).strip(), target_argv
+
+
+def job_arguments(target, argv):
+   """
+   This routine returns the name and the command line arguments of a job sent to the service, as target_arguments. It raises ValueError for invalid jobs, or jobs that change options of the service processes rather than of their target.
+   """
+
+   service_options = ['serve', 'serve_host', 'targets', 'targets_n_processes', 'build_gaia_catalog', 'gaia_catalog', 'gaia_catalog_level', 'n_processes', 'use_parallel', 'keep_gaia_session', 'non_interactive']
+
+   if not isinstance(target, dict) or (('name' not in target) and not (('ra' in target) and ('dec' in target))):
+      raise ValueError('A job needs a "name", or "ra" and "dec".')
+
+   name, target_argv = target_arguments(target, argv)
+
+   # Options are compared once parsed, so abbreviations of the service options are also caught.
+   parser = build_parser()
+   job_args, unknown = parser.parse_known_args(target_argv)
+   if len(unknown) > 0:
+      raise ValueError('Unknown options %s.'%' '.join(unknown))
+   service_args = parser.parse_known_args(argv)[0]
+   changed = ['--%s'%option for option in service_options if getattr(job_args, option) != getattr(service_args, option)]
+   if len(changed) > 0:
+      raise ValueError('Options %s are set by the service and cannot be changed by a job.'%' '.join(changed))
+
+   return name, target_argv
+
+
+def batch_log_filename(name):
+   """
+   This routine returns the log file of a target in ./batch_logs/. Characters other than letters, digits, '_', '.' and '-' are replaced, so names received by the service cannot point outside the directory.
+   """
+   import re
+
+   name = re.sub(r'[^A-Za-z0-9_.-]', '_', str(name)).lstrip('.')
+
+   return './batch_logs/%s.log'%(name if len(name) > 0 else 'target')
+
+
+def run_target(target):
+   """
+   This routine runs the whole pipeline for a single target and returns its status and timing.
+   """
+
+   import time
+   import traceback
+   from contextlib import redirect_stdout, redirect_stderr
+
+   name, target_argv = target
+
+   start_time = time.time()
+   status, message = 'done', ''
+
+   with open(batch_log_filename(name), 'w') as f, redirect_stdout(f), redirect_stderr(f):
+      try:
+         main(target_argv)
+      except SystemExit as e:
+         if e.code:
+            status, message = 'failed', 'Exit code %s'%e.code
+      except Exception as e:
+         traceback.print_exc()
+         status, message = 'failed', repr(e)
+
+   return {'name': name, 'status': status, 'wall_time': round(time.time() - start_time, 2), 'message': message}
+
+
+def launch_targets(targets_filename, argv, n_processes = None):
+   """
+   This routine runs the pipeline for all the targets in targets_filename using a pool of processes. Each process keeps its caches (isochrones, dust maps) between targets.
+   """
+
+   from multiprocessing import Pool, cpu_count
+
+   if n_processes is None:
+      n_processes = cpu_count()
+
+   argv = remove_cli_options(argv, ['--targets', '--targets_n_processes'])
+
+   # Targets cannot be interactive. Also, pool workers cannot spawn their own pools.
+   argv += ['--non_interactive', 'True']
+   if n_processes > 1:
+      argv += ['--use_parallel', 'False']
+
+   targets = read_targets(targets_filename, argv)
+   create_dir('./batch_logs/')
+
+   print('Processing %i targets using %i processes. Individual logs are stored in ./batch_logs/'%(len(targets), n_processes))
+
+   report = []
+   if (len(targets) > 1) and (n_processes > 1):
+      pool = Pool(min(n_processes, len(targets)))
+      for ii, target_report in enumerate(pool.imap_unordered(run_target, targets)):
+         print('(%i/%i) %s: %s in %.1f s. %s'%(ii+1, len(targets), target_report['name'], target_report['status'], target_report['wall_time'], target_report['message']))
+         report.append(target_report)
+      pool.close()
+      pool.join()
+   else:
+      for ii, target in enumerate(targets):
+         target_report = run_target(target)
+         print('(%i/%i) %s: %s in %.1f s. %s'%(ii+1, len(targets), target_report['name'], target_report['status'], target_report['wall_time'], target_report['message']))
+         report.append(target_report)
+
+   report = pd.DataFrame(report)
+   report_filename = os.path.splitext(targets_filename)[0]+'_report.csv'
+   report.to_csv(report_filename, index = False)
+
+   print('\n%i targets done, %i failed. Report saved in %s\n'%((report.status == 'done').sum(), (report.status == 'failed').sum(), report_filename))
+
+   return report
+
+
+def warm_up_worker():
+   """
+   This routine loads the heavy dependencies and the static tables (parallax zero-point, dust maps) in a worker of the service, so they are ready before the first job arrives.
+   """
+
+   import matplotlib
+   matplotlib.use('Agg')
+   import matplotlib.pyplot  # noqa: F401
+   import astropy.coordinates, astropy.io.fits, astropy.wcs  # noqa: F401
+   import scipy.stats  # noqa: F401
+   import sklearn.mixture  # noqa: F401
+
+   try:
+      load_zpt_tables()
+      from dustmaps.sfd import SFDQuery
+      if len(sfd_query_cache) == 0:
+         sfd_query_cache.append(SFDQuery())
+   except Exception as e:
+      print('-->Could not preload the static tables: %s'%e)
+
+
+def run_service(argv, host = '127.0.0.1', port = 8765, n_processes = None):
+   """
+   This routine runs a local HTTP service that processes targets sent as JSON jobs, using a pool of processes that keep their imports, tables, caches and Gaia session between jobs. Outputs are stored as in a normal run, and logs in ./batch_logs/.
+
+   POST /jobs with {"name": ..., or "ra": ..., "dec": ..., plus any other option}, as a row of a --targets file, returns the job id.
+   GET /jobs returns the status of all jobs, and GET /jobs/<id> that of one job.
+   """
+
+   import json
+   import threading
+   import uuid
+   from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+   from multiprocessing import Pool, cpu_count
+
+   if n_processes is None:
+      n_processes = cpu_count()
+
+   # Jobs cannot be interactive. Also, jobs always run in pool workers, which cannot spawn their own pools.
+   argv = argv + ['--non_interactive', 'True', '--keep_gaia_session', 'True', '--use_parallel', 'False']
+
+   create_dir('./batch_logs/')
+
+   pool = Pool(n_processes, initializer = warm_up_worker)
+   jobs = {}
+   jobs_lock = threading.Lock()
+
+   def job_status(job_id):
+      job = jobs[job_id]
+      status = {'id': job_id, 'name': job['name'], 'submitted': job['submitted']}
+      if job['result'].ready():
+         status.update(job['result'].get())
+      else:
+         status['status'] = 'pending'
+      return status
+
+   class JobsHandler(BaseHTTPRequestHandler):
+
+      def reply(self, code, content):
+         body = json.dumps(content).encode()
+         self.send_response(code)
+         self.send_header('Content-Type', 'application/json')
+         self.send_header('Content-Length', str(len(body)))
+         self.end_headers()
+         self.wfile.write(body)
+
+      def do_POST(self):
+         if self.path.rstrip('/') != '/jobs':
+            return self.reply(404, {'error': 'Unknown path %s'%self.path})
+         try:
+            target = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            name, target_argv = job_arguments(target, argv)
+         except SystemExit:
+            return self.reply(400, {'error': 'Invalid job: wrong option values.'})
+         except ValueError as e:
+            return self.reply(400, {'error': 'Invalid job: %s'%e})
+
+         job_id = uuid.uuid4().hex[:12]
+         with jobs_lock:
+            jobs[job_id] = {'name': name, 'submitted': pd.Timestamp.now().isoformat(timespec = 'seconds'), 'result': pool.apply_async(run_target, ((name, target_argv),))}
+         print('-->Job %s: %s queued.'%(job_id, name))
+         self.reply(202, {'id': job_id, 'name': name})
+
+      def do_GET(self):
+         path = self.path.rstrip('/').split('/')
+         with jobs_lock:
+            if path == ['', 'jobs']:
+               return self.reply(200, [job_status(job_id) for job_id in jobs])
+            elif (len(path) == 3) and (path[:2] == ['', 'jobs']) and (path[2] in jobs):
+               return self.reply(200, job_status(path[2]))
+         self.reply(404, {'error': 'Unknown job or path %s'%self.path})
+
+      def log_message(self, format, *args):
+         pass
+
+   server = ThreadingHTTPServer((host, port), JobsHandler)
+   print('Serving jobs at http://%s:%i/jobs using %i processes. Press Ctrl+C to stop.'%(host, port, n_processes))
+
+   try:
+      server.serve_forever()
+   except KeyboardInterrupt:
+      print('\nStopping the service.')
+   finally:
+      server.server_close()
+      pool.terminate()
+      pool.join()
+
+
+def build_parser():
+   """
+   This routine builds the command line parser. It does not need any heavy dependency, so the options can be parsed (or --help shown) right away.
    """
 
    parser = argparse.ArgumentParser(description="This script derives proper motions (PM) combining HST and Gaia data.")
@@ -2310,6 +4700,7 @@ def main(argv):
    parser.add_argument('--prepare_for_clustering', type = float, default = 0, help = 'Preselect sources before the last clustering')
    parser.add_argument('--clipping_prob_pm', type=float, default=3., help='Sigma used for clipping pm and parallax. Default is 3.')
    parser.add_argument('--pm_n_components', type=int, default=2, help='Number of Gaussian componnents for pm and parallax clustering. Default is 1.')
+   parser.add_argument('--gmm_batch_size', type=int, default=None, help='If set, tables larger than this number of stars are clustered using online EM over chunks of this size. Useful for very large control fields. Default is None (in-memory fit).')
 
    # Search options
    parser.add_argument('--search_type', type=str, default = 'box', help='Shape of the area to search. Options are "box", "cone" or "anulus". The "box" size is controlled by the "search_width" and "search_height" parameters. The "cone" radius is controlled by the "search_radius" parameter.')
@@ -2340,9 +4731,13 @@ def main(argv):
    # Gaia options
    parser.add_argument('--gaia_user', type=str, default = None, help='Gaia username. Useful for automatization of the script.')
    parser.add_argument('--gaia_paswd', type=str, default = None, help='Gaia password. Useful for automatization of the script.')
+   parser.add_argument('--gaia_sync_max_area', type=float, default = 0.01, help='Gaia queries of smaller areas (in deg^2) are launched as synchronous jobs, which avoids polling the archive. They are launched again as asynchronous jobs if they reach the 2000 rows limit of synchronous jobs. Default is 0.01.')
    parser.add_argument('--clean_uwe', type = str2bool, default = True)
    parser.add_argument('--norm_uwe', type = str2bool, default = True)
    parser.add_argument('--source_table', type = str, default = 'gaiaedr3.gaia_source', help='Gaia source table. Default is gaiaedr3.gaia_source.')
+   parser.add_argument('--gaia_catalog', type=str, default = None, help='Directory with a local copy of the Gaia source table, partitioned by HEALPix and stored as Parquet files (see --build_gaia_catalog), to be used instead of the Gaia archive. It requires pyarrow. Default is None.')
+   parser.add_argument('--build_gaia_catalog', type=str, nargs='+', default = None, help='Build the local copy of the Gaia source table in --gaia_catalog from these CSV or ECSV files with its columns, e.g. those of the bulk download of the Gaia archive, and exit. Default is None.')
+   parser.add_argument('--gaia_catalog_level', type=int, default = 5, help='HEALPix level of the partitions of the local copy of the Gaia source table built with --build_gaia_catalog. Default is 5.')
    parser.add_argument('--save_individual_queries', type = str2bool, default = True, help='If True, the code will save the individual queries.')
    parser.add_argument('--remove_quality_cols', type = str2bool, default = False, help='If True, the code will remove all quality columns from the final table, except "clean_label".')
    parser.add_argument('--clean_data', type = str2bool, default = False, help = 'Screen out bad measurements based on Gaia EDR3 quality flags. Default is False.')
@@ -2354,32 +4749,96 @@ def main(argv):
    # HST options
    parser.add_argument('--force_hst1pass', type=str2bool, default=False, help='Force the program to perform the search for sources in the HST images. Default is False, which will use existing files if any.')
    parser.add_argument('--fmin', type=int, default= None, help='Minimum flux above the sky to substract a source in the HST image. Default is automatic from HST integration time.')
+   parser.add_argument('--pert_grid_cache', type=str, default = './pert_grid_cache.jsonl', help='File where the PERT grids used by hst1pass are stored for each detector, filter and exposure time, so they can be reused with similar images. Default is ./pert_grid_cache.jsonl.')
    parser.add_argument('--pixel_scale', type=float, default= None, help='Pixel scale in arcsec/pixel used to compute the tangential plane during the match between epochs. Default is automatic from HST images.')
    parser.add_argument('--hst_filters', type=str, nargs='+', default = ['any'], help='Required filter for the HST images.')
    parser.add_argument('--hst_integration_time_min', type=float, default = 50, help='Required integration time for the HST images.')
    parser.add_argument('--hst_integration_time_max', type=float, default = 550, help='Required integration time for the HST images.')
    parser.add_argument('--time_baseline', type=float, default = 1460, help='Minimum time baseline with respect to Gaia EDR3 in days. Default 1460.')
+   parser.add_argument('--pipeline_hst', type=str2bool, default=True, help='Process each HST image (hst1pass and first xym2pm_Gaia iteration) as soon as it is downloaded, instead of waiting for all the downloads to finish. Default is True.')
+   parser.add_argument('--n_transfers', type=int, default = 4, help='Number of simultaneous downloads from MAST. Default 4.')
+   parser.add_argument('--mast_download_url', type=str, default = 'https://mast.stsci.edu/api/v0.1/Download/file', help='MAST download service. Default is https://mast.stsci.edu/api/v0.1/Download/file.')
+   parser.add_argument('--hst_obs_policy', type=str, default = 'ask', help='How to select the HST observations to use. "ask" the user, use "all" of them, "none", or a list of the observation numbers shown within parentheses, e.g. "1 3". Default is "ask", or "all" with --non_interactive.')
+   parser.add_argument('--hst_obs_min_gaia_stars', type=int, default = None, help='Only use HST observations with at least this number of Gaia stars. Default is None.')
+   parser.add_argument('--hst_obs_min_baseline', type=float, default = None, help='Only use HST observations with at least this time baseline in years. Default is None.')
 
    # HST-Gaia match options
    parser.add_argument('--force_xym2pm', type=str2bool, default=False, help='Force the program to perform the match between Gaia and HST sources. Default is False, which will use existing files if any.')
+   parser.add_argument('--xym2pm_matcher', type=str, default = 'fortran', choices = ['fortran', 'python', 'auto'], help='Implementation used to match the Gaia and HST sources: the xym2pm_Gaia Fortran routine, its NumPy/SciPy version, which does not need the executable and has no limits in the number of stars, or auto, which uses the NumPy/SciPy version only for fields too crowded for the Fortran routine. Default is fortran.')
+   parser.add_argument('--realign_threshold', type=float, default = 0., help='Fraction of the reference stars of an HST image that has to change between iterations to align the image again. Otherwise its previous match is used. Default is 0, which aligns again any image whose reference stars changed.')
    parser.add_argument('--fix_mat', type=str2bool, default=True, help='Force to select the best stars in the MAT files to perform the alignment in the next iteration.')
    parser.add_argument('--max_separation', type=float, default= None, help='Maximum allowed separation in pixels during the match between epochs. Default 10 pixels.')
    parser.add_argument('--force_use_sat', type=str2bool, default=True, help='Force the program to use saturated stars during the match between epochs. Default is True.')
    parser.add_argument('--force_wcs_search_radius', type=float, default= None, help='When set to a radius (in arcsec), the program search the closest Gaia star to each bright star in the HST image within that distance to perform a pre-alignment between the two frames. Useful when not many stars are available. Default is None.')
    parser.add_argument('--min_stars_alignment', type=int, default = 25, help='Minimum number of stars per HST image to be used for the epochs alignment. Default 25.')
 
+   # Local correction options
+   parser.add_argument('--local_correction', type=str2bool, default=False, help='Subtract from the absolute PM of each star the PM offset of its closest reference stars, to remove spatially correlated residuals of the alignment. Default is False.')
+   parser.add_argument('--local_correction_k', type=int, default = 25, help='Number of closest reference stars used in the local correction. Default is 25.')
+   parser.add_argument('--local_correction_radius', type=float, default = None, help='Maximum distance (in arcsec) of the reference stars used in the local correction. Default is None, no limit.')
+   parser.add_argument('--local_correction_statistic', type=str, default = 'median', choices = ['median', 'wmean'], help='Statistic used to compute the PM offset of the closest reference stars. Default is median.')
+
    #Miscellaneus options
    parser.add_argument('--use_parallel', type = str2bool, default = True, help='Use parallelized computation when possible. Default is True.')
+   parser.add_argument('--n_processes', type=int, default = None, help='Maximum number of processes shared by all the parallelized stages (Gaia queries, hst1pass and xym2pm_Gaia). Default is the number of CPUs.')
    parser.add_argument('--load_existing', type = str2bool, default = False, help='If True, the code will try to resume the previous search loading previous individual queries. It should be set to False if a new table is being downloaded. True when a specific search is failing due to connection problems.')
    parser.add_argument('--plots', type=str2bool, default=True, help='Create sanity plots. Default is True.')
+   parser.add_argument('--mat_plots', type=str2bool, default=False, help='Create a diagnostic plot of the MAT file of each HST image in each iteration. Default is False.')
    parser.add_argument('--silent', type=str2bool, default = False, help='Accept all default values without asking. Default is False.')
+   parser.add_argument('--non_interactive', type=str2bool, default = False, help='Run without any user interaction, e.g. in compute nodes. It implies --silent. HST observations are selected following --hst_obs_policy and CMD selections are replayed from --cmd_polygons_path. Default is False.')
+   parser.add_argument('--cmd_polygons_path', type=str, default = None, help='Directory where the CMD selections (lasso polygons) are saved and replayed from. Default is the CMD_polygons directory within the output directory.')
+   parser.add_argument('--reuse_cmd_selections', type=str2bool, default=True, help='Reuse CMD selections saved in previous runs. Set it to False to draw them again. Default is True.')
    parser.add_argument('--error_weighted', type = str2bool, default = True, help = 'The program will use error-weighted statistics to compute average PMs, if possible.')
    parser.add_argument('--remove_previous_files', type=str2bool, default=True, help='Remove previous intermediate files.')
    parser.add_argument('--verbose', type=str2bool, default=True, help='Program verbosity. Default True.')
-   parser.add_argument('--test_mode', type = str2bool, default = False)
+   parser.add_argument('--run_report', type=str2bool, default=True, help='Record the wall time, CPU time, peak memory and rows in and out of every stage of the run, including each Gaia query, hst1pass and xym2pm_Gaia execution, in a JSON and a CSV file next to the log file. Default is True.')
+   parser.add_argument('--profile', type=str, nargs='+', default = None, help='Profile these stages with cProfile, e.g. "--profile cmd_cleaning plot_fields launch_xym2pm_Gaia", or "all". Stages are named as in the run report. A .prof file and a summary of the top functions are saved in the Profiles directory for each execution of the stage. Default is None, which does not profile anything.')
+   parser.add_argument('--profile_top', type=int, default = 30, help='Number of functions in the summaries of the profiled stages. Default 30.')
+   parser.add_argument('--test_mode', type = str2bool, default = False, help='Run without network access using a synthetic Gaia table and synthetic HST observations. The HST stages are skipped. --ra and --dec have to be given. Default is False.')
+   parser.add_argument('--test_n_stars', type = int, default = 20000, help='Number of synthetic stars in the search area between G = 10 and 21 in test mode. Default 20000.')
+   parser.add_argument('--test_cluster_fraction', type = float, default = 0.3, help='Fraction of the synthetic stars that belong to the cluster in test mode. Default 0.3.')
+   parser.add_argument('--test_seed', type = int, default = 0, help='Random seed of the synthetic data in test mode. Default 0.')
+
+   # Batch options
+   parser.add_argument('--targets', type=str, default = None, help='CSV file with a list of targets to process. It should contain a "name" column, or "ra" and "dec" columns. Any other column overrides the corresponding option for that target. Default is None.')
+   parser.add_argument('--targets_n_processes', type=int, default = None, help='Number of targets processed simultaneously when using --targets or --serve. Default is the number of CPUs.')
+   parser.add_argument('--serve', type=int, default = None, help='Run as a local service listening on this port. Targets are sent as JSON jobs (POST /jobs) and processed by a pool of processes that keep their imports, tables and Gaia session warm. Default is None.')
+   parser.add_argument('--serve_host', type=str, default = '127.0.0.1', help='Host address of the service. Default is 127.0.0.1.')
+   parser.add_argument('--keep_gaia_session', type=str2bool, default = False, help='Keep the Gaia archive session open to be reused by the next targets of the same process. Default is False.')
+
+   return parser
 
+
+def main(argv):  
+   """
+   Inputs
+   """
+
+   parser = build_parser()
    args = parser.parse_args(argv)
 
+   if args.serve is not None:
+      run_service(remove_cli_options(argv, ['--serve', '--serve_host', '--targets_n_processes']), host = args.serve_host, port = args.serve, n_processes = args.targets_n_processes)
+      return
+
+   if args.targets is not None:
+      launch_targets(args.targets, argv, n_processes = args.targets_n_processes)
+      return
+
+   if args.build_gaia_catalog is not None:
+      if args.gaia_catalog is None:
+         print('Please provide the directory of the Gaia catalog with --gaia_catalog.\nExiting now.')
+         sys.exit(1)
+      build_gaia_catalog(args.build_gaia_catalog, args.gaia_catalog, level = args.gaia_catalog_level)
+      return
+
+   if args.non_interactive:
+      import matplotlib
+      matplotlib.use('Agg')
+      args.silent = True
+      if args.hst_obs_policy == 'ask':
+         args.hst_obs_policy = 'all'
+
    args = get_object_properties(args)
 
    """
@@ -2391,28 +4850,65 @@ def main(argv):
    create_dir(args.Gaia_path)
    if args.save_individual_queries:
       create_dir(args.Gaia_ind_queries_path)
+   if not os.path.isdir(args.cmd_polygons_path):
+      create_dir(args.cmd_polygons_path)
+
+   if args.run_report:
+      start_run_report(args.run_report_filename)
+
+   if args.profile is not None:
+      if not os.path.isdir(args.profile_path):
+         create_dir(args.profile_path)
+      start_profiling(args.profile, args.profile_path, top = args.profile_top)
 
    """
-   The script tries to load an existing Gaia table, otherwise it will download it from the Gaia archive.
+   A single pool of processes is shared by all the stages
    """
+   context = ExecutionContext(n_processes = args.n_processes if args.use_parallel else 1)
+
+   # The profiling and the run report are finished even if the run stops early, as the workers of --targets and --serve run the next targets in the same process.
+   try:
+      run_pipeline(args, context)
+   finally:
+      context.close()
 
-   astrometric_cols = 'l, b, ra, ra_error, dec, dec_error, parallax, parallax_error, pmra, pmra_error, pmdec, pmdec_error, dr2_radial_velocity, dr2_radial_velocity_error, ra_dec_corr, ra_parallax_corr, ra_pmra_corr, ra_pmdec_corr, dec_parallax_corr, dec_pmra_corr, dec_pmdec_corr, parallax_pmra_corr, parallax_pmdec_corr, pmra_pmdec_corr'
+      if args.profile is not None:
+         stop_profiling()
+         print('Profiles saved in %s'%args.profile_path)
 
-   photometric_cols = 'phot_g_mean_flux, phot_g_mean_mag AS gmag, (1.086*phot_g_mean_flux_error/phot_g_mean_flux) AS gmag_error, phot_bp_mean_mag AS bpmag, (1.086*phot_bp_mean_flux_error/phot_bp_mean_flux) AS bpmag_error, phot_rp_mean_mag AS rpmag, (1.086*phot_rp_mean_flux_error/phot_rp_mean_flux) AS rpmag_error, bp_rp, sqrt( power( (1.086*phot_bp_mean_flux_error/phot_bp_mean_flux), 2) + power( (1.086*phot_rp_mean_flux_error/phot_rp_mean_flux), 2) ) as bp_rp_error'
+      if args.run_report:
+         write_run_report(args.run_report_filename)
+         print('Run report saved in %s.json and %s.csv'%(args.run_report_filename, args.run_report_filename))
 
-   quality_cols = 'ecl_lat, pseudocolour, nu_eff_used_in_astrometry, visibility_periods_used, astrometric_excess_noise_sig, astrometric_params_solved, astrometric_n_good_obs_al, astrometric_chi2_al, phot_bp_rp_excess_factor, ruwe, (phot_bp_n_blended_transits+phot_rp_n_blended_transits) *1.0 / (phot_bp_n_obs + phot_rp_n_obs) AS beta, ipd_gof_harmonic_amplitude, phot_bp_n_contaminated_transits, phot_rp_n_contaminated_transits'
 
-   query, quality_cols = columns_n_conditions(args.source_table, args.search_type, astrometric_cols, photometric_cols, quality_cols, args.ra, args.dec,
+def run_pipeline(args, context):
+   """
+   This routine runs all the stages of the pipeline for a target, once its directories are created.
+   """
+
+   """
+   The script tries to load an existing Gaia table, otherwise it will download it from the Gaia archive.
+   """
+
+   query, quality_cols = columns_n_conditions(args.source_table, args.search_type, gaia_astrometric_cols, gaia_photometric_cols, gaia_quality_cols, args.ra, args.dec,
                                               args.min_search_radius, args.download_radius, args.search_width, args.search_height,
                                               max_gmag_error = args.max_gmag_error, max_rpmag_error = args.max_rpmag_error,
                                               max_bpmag_error = args.max_bpmag_error, min_parallax = args.min_parallax, max_parallax = args.max_parallax,
                                               max_parallax_error = args.max_parallax_error, min_pmra = args.min_pmra, max_pmra = args.max_pmra,
                                               max_pmra_error = args.max_pmra_error, min_pmdec = args.min_pmdec, max_pmdec = args.max_pmdec, max_pmdec_error = args.max_pmdec_error)
+   if args.test_mode:
+      test_mode = {'n_stars': args.test_n_stars, 'cluster_fraction': args.test_cluster_fraction, 'cluster_pm': None if None in (args.pmra, args.pmdec) else (args.pmra, args.pmdec), 'distance': 20. if args.distance is None else args.distance, 'seed': args.test_seed}
+   else:
+      test_mode = False
+
    try:
       Gaia_table = pd.read_csv(args.Gaia_raw_table_filename)
    except:
-      Gaia_table, Gaia_queries = incremental_query(query, args.area, min_gmag = args.min_gmag, max_gmag = args.max_gmag, norm_uwe = args.norm_uwe, use_parallel = args.use_parallel,
-                                                   test_mode = args.test_mode, save_individual_queries = args.save_individual_queries, name = args.name, gaia_user = args.gaia_user, gaia_paswd = args.gaia_paswd)
+      with StageReport('gaia_download') as stage:
+         Gaia_table, Gaia_queries = incremental_query(query, args.area, min_gmag = args.min_gmag, max_gmag = args.max_gmag, norm_uwe = args.norm_uwe, context = context,
+                                                      test_mode = test_mode, save_individual_queries = args.save_individual_queries, name = args.name, gaia_user = args.gaia_user, gaia_paswd = args.gaia_paswd, interactive = not args.non_interactive, keep_gaia_session = args.keep_gaia_session, gaia_sync_max_area = args.gaia_sync_max_area,
+                                                      catalog = None if args.gaia_catalog is None else ParquetCatalog(args.gaia_catalog))
+         stage['rows_out'] = len(Gaia_table)
 
       Gaia_table.to_csv(args.Gaia_raw_table_filename, index = False)
 
@@ -2427,18 +4923,20 @@ def main(argv):
       f.close()
 
 
-   # We fix some of the variables using the codes published with EDR3
-   zpt.load_tables()
-   Gaia_table['corrected_parallax'] = Gaia_table['parallax'] - zpt.get_zpt(Gaia_table['gmag'], Gaia_table['nu_eff_used_in_astrometry'], Gaia_table['pseudocolour'], Gaia_table['ecl_lat'], Gaia_table['astrometric_params_solved'])
-   Gaia_table['corrected_gmag'], Gaia_table['corrected_phot_g_mean_flux'] = correct_gband(Gaia_table['bp_rp'], Gaia_table['astrometric_params_solved'], Gaia_table['gmag'], Gaia_table['phot_g_mean_flux'])
-   Gaia_table['corrected_flux_excess_factor'] = correct_flux_excess_factor(Gaia_table['bp_rp'], Gaia_table['phot_bp_rp_excess_factor'])
+   with StageReport('corrections', rows_in = len(Gaia_table)) as stage:
+      # We fix some of the variables using the codes published with EDR3
+      zpt = load_zpt_tables()
+      Gaia_table['corrected_parallax'] = Gaia_table['parallax'] - zpt.get_zpt(Gaia_table['gmag'], Gaia_table['nu_eff_used_in_astrometry'], Gaia_table['pseudocolour'], Gaia_table['ecl_lat'], Gaia_table['astrometric_params_solved'])
+      Gaia_table['corrected_gmag'], Gaia_table['corrected_phot_g_mean_flux'] = correct_gband(Gaia_table['bp_rp'], Gaia_table['astrometric_params_solved'], Gaia_table['gmag'], Gaia_table['phot_g_mean_flux'])
+      Gaia_table['corrected_flux_excess_factor'] = correct_flux_excess_factor(Gaia_table['bp_rp'], Gaia_table['phot_bp_rp_excess_factor'])
 
-   clean_label = pre_clean_data(Gaia_table['gmag'], Gaia_table['corrected_flux_excess_factor'], Gaia_table['ruwe'], Gaia_table['ipd_gof_harmonic_amplitude'], Gaia_table['visibility_periods_used'], Gaia_table['astrometric_excess_noise_sig'], Gaia_table['astrometric_params_solved'], sigma_flux_excess_factor = args.sigma_flux_excess_factor, use_5p = True)
+      clean_label = pre_clean_data(Gaia_table['gmag'], Gaia_table['corrected_flux_excess_factor'], Gaia_table['ruwe'], Gaia_table['ipd_gof_harmonic_amplitude'], Gaia_table['visibility_periods_used'], Gaia_table['astrometric_excess_noise_sig'], Gaia_table['astrometric_params_solved'], sigma_flux_excess_factor = args.sigma_flux_excess_factor, use_5p = True)
 
-   Gaia_table['clean_label'] = clean_label
+      Gaia_table['clean_label'] = clean_label
 
-   Gaia_table = get_real_error(Gaia_table)
-   Gaia_table = select_conditions(args, Gaia_table)
+      Gaia_table = get_real_error(Gaia_table)
+      Gaia_table = select_conditions(args, Gaia_table)
+      stage['rows_out'] = len(Gaia_table)
 
    Gaia_table.to_csv(args.Gaia_raw_sel_table_filename)
 
@@ -2453,16 +4951,20 @@ def main(argv):
          """
          isochrones = read_isochrones(args.age, args.z, max_gmag = args.max_gmag)
          isochrones_cmd = combine_isochrones(isochrones, cmd_broadening = args.cmd_broadening, extended_HB = args.extend_HB)
-         Gaia_table['member_cmd_gaia'] = cmd_cleaning(Gaia_table.copy(), isochrones_cmd, distance = args.distance, AV = args.AV, clipping_sigma = args.clipping_sigma_cmd, plots = args.plots, plot_name = args.Gaia_path+'CMD_selection.png')
+         with StageReport('cmd_cleaning', rows_in = len(Gaia_table)) as stage:
+            Gaia_table['member_cmd_gaia'] = cmd_cleaning(Gaia_table, isochrones_cmd, distance = args.distance, AV = args.AV, clipping_sigma = args.clipping_sigma_cmd, plots = args.plots, plot_name = args.Gaia_path+'CMD_selection.png')
+            stage['rows_out'] = Gaia_table['member_cmd_gaia'].sum()
 
       else:
-         Gaia_table['member_cmd_gaia'] = manual_select_from_cmd(Gaia_table.bp_rp, Gaia_table.gmag)
+         Gaia_table['member_cmd_gaia'] = manual_select_from_cmd(Gaia_table.bp_rp, Gaia_table.gmag, polygon_filename = cmd_polygon_filename(args.cmd_polygons_path, 'bp_rp', 'gmag'), interactive = not args.non_interactive, reuse = args.reuse_cmd_selections)
 
       """
       Perform the selection in the PM-parallax space.
       """
       Gaia_table['clustering_data'] = Gaia_table['member_cmd_gaia']
-      Gaia_table['member_pm_gaia'] = pm_cleaning_GMM_recursive(Gaia_table.copy(), ['pmra', 'pmdec', 'parallax'], data_0 = [args.pmra, args.pmdec, args.parallax], n_components = args.pm_n_components, clipping_prob = args.clipping_prob_pm, plots = args.plots, plot_name = args.Gaia_path+'PM_selection')
+      with StageReport('pm_cleaning', rows_in = Gaia_table['clustering_data'].sum()) as stage:
+         Gaia_table['member_pm_gaia'] = pm_cleaning_GMM_recursive(Gaia_table, ['pmra', 'pmdec', 'parallax'], data_0 = [args.pmra, args.pmdec, args.parallax], n_components = args.pm_n_components, clipping_prob = args.clipping_prob_pm, batch_size = args.gmm_batch_size, plots = args.plots, plot_name = args.Gaia_path+'PM_selection')
+         stage['rows_out'] = Gaia_table['member_pm_gaia'].sum()
       
       if args.clean_data:
          gaia_selection_vars = ['member_cmd_gaia', 'member_pm_gaia', 'clean_label']
@@ -2476,7 +4978,12 @@ def main(argv):
    """
    The script tries to load an existing HST table, otherwise it will download it from the MAST archive.
    """
-   obs_table, data_products_by_obs = search_mast(args.ra, args.dec, args.search_width, args.search_height, filters = args.hst_filters, t_exptime_min = args.hst_integration_time_min, t_exptime_max = args.hst_integration_time_max, date_second_epoch = args.date_second_epoch, time_baseline = args.time_baseline)
+   with StageReport('search_mast') as stage:
+      if args.test_mode:
+         obs_table, data_products_by_obs = synthetic_mast_tables(args.ra, args.dec, date_second_epoch = args.date_second_epoch, seed = args.test_seed)
+      else:
+         obs_table, data_products_by_obs = search_mast(args.ra, args.dec, args.search_width, args.search_height, filters = args.hst_filters, t_exptime_min = args.hst_integration_time_min, t_exptime_max = args.hst_integration_time_max, date_second_epoch = args.date_second_epoch, time_baseline = args.time_baseline)
+      stage['rows_out'] = len(obs_table)
 
    obs_table.to_csv(args.HST_obs_table_filename, index = False)
    data_products_by_obs.to_csv(args.HST_data_table_products_filename, index = False)
@@ -2484,57 +4991,71 @@ def main(argv):
    """
    Plot results and find Gaia stars within HST fields
    """
-   Gaia_table, obs_table = plot_fields(Gaia_table, obs_table, args.HST_path, min_stars_alignment = args.min_stars_alignment, name = args.base_path+args.base_file_name+'_search_footprint.png')
+   with StageReport('plot_fields', rows_in = len(Gaia_table)) as stage:
+      Gaia_table, obs_table = plot_fields(Gaia_table, obs_table, args.HST_path, min_stars_alignment = args.min_stars_alignment, name = args.base_path+args.base_file_name+'_search_footprint.png')
+      stage['rows_out'] = len(obs_table)
 
-   if len(obs_table) > 0:
+   if args.test_mode:
+      print('Test mode: %i synthetic HST observations contain Gaia stars. Their images do not exist, so the HST stages are skipped.\n'%len(obs_table))
+
+   elif len(obs_table) > 0:
 
       """
       Ask whether the user wish to download the available HST images 
       """
 
-      print('Would you like to use the following HST observations?\n')
-      print(obs_table.loc[:, ['obsid', 'filters', 'n_exp', 'i_exptime', 'obs_time', 't_baseline', 'gaia_stars_per_obs', 'proposal_id', '']].to_string(index=False), '\n')
-
-      print("Type 'y' for all observations, 'n' for none. Type the number within parentheses at the right if you wish to use that specific set of observations. You can enter several numbers separated by space. \n")
-      HST_obs_to_use = input('Please type your answer and press enter: ')
+      HST_obs_to_use = select_HST_obs(obs_table, policy = args.hst_obs_policy, min_gaia_stars = args.hst_obs_min_gaia_stars, min_baseline = args.hst_obs_min_baseline)
 
-      try:
-         HST_obs_to_use = str2bool(HST_obs_to_use)
-      except:
-         try:
-            HST_obs_to_use = list(set([obsid for obsid in obs_table.obsid[[int(obsid)-1 for obsid in HST_obs_to_use.split()]] if np.isfinite(obsid)]))
-         except:
-            print('No valid input. Not downloading observations.')
-            HST_obs_to_use = False
+      if HST_obs_to_use is False:
+         print('\nExiting now.\n')
+         sys.exit(1)
 
+      data_products_to_use = data_products_by_obs.loc[data_products_by_obs['parent_obsid'].isin(HST_obs_to_use), :]
 
-      if HST_obs_to_use is not False:
-         if HST_obs_to_use is True:
-            HST_obs_to_use = list(obs_table['obsid'].values)
-         hst_images = download_HST_images(Table.from_pandas(data_products_by_obs.loc[data_products_by_obs['parent_obsid'].isin(HST_obs_to_use), :]), path = args.HST_path)
+      if args.pipeline_hst:
+         """
+         Download, hst1pass and first xym2pm_Gaia iteration overlap image by image
+         """
+         with StageReport('launch_HST_pipeline', rows_in = len(Gaia_table)) as stage:
+            Gaia_table_hst, hst_images = launch_HST_pipeline(Gaia_table, data_products_to_use, HST_obs_to_use, args.HST_path, args.date_second_epoch, n_transfers = args.n_transfers, base_url = args.mast_download_url, force_fmin = args.fmin, force_hst1pass = args.force_hst1pass, pert_grid_cache_filename = args.pert_grid_cache, only_use_members = args.use_members, force_pixel_scale = args.pixel_scale, force_max_separation = args.max_separation, force_use_sat = args.force_use_sat, fix_mat = args.fix_mat, force_wcs_search_radius = args.force_wcs_search_radius, n_components = args.pm_n_components, clipping_prob = args.clipping_prob_pm, min_stars_alignment = args.min_stars_alignment, use_mean = args.use_mean, plots = args.plots, verbose = args.verbose, force_xym2pm = args.force_xym2pm, remove_previous_files = args.remove_previous_files, context = context, cmd_polygons_path = args.cmd_polygons_path, interactive = not args.non_interactive, reuse_cmd_selections = args.reuse_cmd_selections, matcher = args.xym2pm_matcher, realign_threshold = args.realign_threshold, mat_plots = args.mat_plots, plot_name = args.base_path+'PM_selection')
+            stage['rows_out'] = len(Gaia_table_hst)
       else:
-         print('\nExiting now.\n')
-         sys.exit(1)
+         with StageReport('download_HST_images', rows_in = len(data_products_to_use)) as stage:
+            hst_images = download_HST_images(data_products_to_use, path = args.HST_path, n_transfers = args.n_transfers, base_url = args.mast_download_url)
+            stage['rows_out'] = (hst_images.status != 'ERROR').sum()
 
       """
       Select only flc
       """
-      drz_images = data_products_by_obs[(data_products_by_obs['productSubGroupDescription'] == 'DRZ') & (data_products_by_obs['parent_obsid'].isin(HST_obs_to_use))]
-      flc_images = data_products_by_obs[(data_products_by_obs['productSubGroupDescription'] == 'FLC') & (data_products_by_obs['parent_obsid'].isin(HST_obs_to_use))]
+      downloaded = data_products_by_obs['productFilename'].isin(hst_images.loc[hst_images.status != 'ERROR', 'productFilename'])
+      drz_images = data_products_by_obs[(data_products_by_obs['productSubGroupDescription'] == 'DRZ') & (data_products_by_obs['parent_obsid'].isin(HST_obs_to_use)) & downloaded]
+      flc_images = data_products_by_obs[(data_products_by_obs['productSubGroupDescription'] == 'FLC') & (data_products_by_obs['parent_obsid'].isin(HST_obs_to_use)) & downloaded]
 
-      """
-      Call hst1pass
-      """
-      launch_hst1pass(flc_images, HST_obs_to_use, args.HST_path, force_fmin = args.fmin, remove_previous_XYmqxyrd = args.remove_previous_files, force_hst1pass = args.force_hst1pass, use_parallel = args.use_parallel)
-      """
-      Call xym2pm_Gaia
-      """
-      Gaia_table_hst = launch_xym2pm_Gaia(Gaia_table.copy(), flc_images, HST_obs_to_use, args.HST_path, args.date_second_epoch, only_use_members = args.use_members, force_pixel_scale = args.pixel_scale, force_max_separation = args.max_separation, force_use_sat = args.force_use_sat, fix_mat = args.fix_mat, force_wcs_search_radius = args.force_wcs_search_radius, n_components = args.pm_n_components, clipping_prob = args.clipping_prob_pm, min_stars_alignment = args.min_stars_alignment, use_mean = args.use_mean, plots = args.plots, verbose = args.verbose, force_xym2pm = args.force_xym2pm, remove_previous_files = args.remove_previous_files, use_parallel = args.use_parallel, plot_name = args.base_path+'PM_selection')
+      if not args.pipeline_hst:
+         """
+         Call hst1pass
+         """
+         with StageReport('launch_hst1pass', rows_in = len(flc_images)):
+            launch_hst1pass(flc_images, HST_obs_to_use, args.HST_path, force_fmin = args.fmin, remove_previous_XYmqxyrd = args.remove_previous_files, force_hst1pass = args.force_hst1pass, pert_grid_cache_filename = args.pert_grid_cache, context = context)
+         """
+         Call xym2pm_Gaia
+         """
+         with StageReport('launch_xym2pm_Gaia', rows_in = len(Gaia_table)) as stage:
+            Gaia_table_hst = launch_xym2pm_Gaia(Gaia_table, flc_images, HST_obs_to_use, args.HST_path, args.date_second_epoch, only_use_members = args.use_members, force_pixel_scale = args.pixel_scale, force_max_separation = args.max_separation, force_use_sat = args.force_use_sat, fix_mat = args.fix_mat, force_wcs_search_radius = args.force_wcs_search_radius, n_components = args.pm_n_components, clipping_prob = args.clipping_prob_pm, min_stars_alignment = args.min_stars_alignment, use_mean = args.use_mean, plots = args.plots, verbose = args.verbose, force_xym2pm = args.force_xym2pm, remove_previous_files = args.remove_previous_files, context = context, cmd_polygons_path = args.cmd_polygons_path, interactive = not args.non_interactive, reuse_cmd_selections = args.reuse_cmd_selections, matcher = args.xym2pm_matcher, realign_threshold = args.realign_threshold, mat_plots = args.mat_plots, plot_name = args.base_path+'PM_selection')
+            stage['rows_out'] = len(Gaia_table_hst)
 
       """
       Obtain absolute PMs
       """
-      Gaia_table_hst = absolute_pm(Gaia_table_hst.copy())
+      with StageReport('absolute_pm', rows_in = len(Gaia_table_hst)):
+         Gaia_table_hst = Gaia_table_hst.join(absolute_pm(Gaia_table_hst))
+
+      if args.local_correction:
+         """
+         Local correction using k-neighbours
+         """
+         with StageReport('local_pm_correction', rows_in = len(Gaia_table_hst)):
+            Gaia_table_hst = local_pm_correction(Gaia_table_hst, k = args.local_correction_k, max_radius = args.local_correction_radius, statistic = args.local_correction_statistic)
 
       """
       Save Gaia and HST tables
@@ -2562,9 +5083,11 @@ def main(argv):
       f.close()
 
    else:
-      input('No suitable HST observations were found. Please try with different parameters.\nPress enter to exit.\n')
-   
-   print('TODO. Local Correction using k-neigbors. Figure 3 in https://iopscience.iop.org/article/10.3847/1538-4357/aaa3ec/pdf')
+      if args.silent:
+         print('No suitable HST observations were found. Please try with different parameters.\n')
+      else:
+         input('No suitable HST observations were found. Please try with different parameters.\nPress enter to exit.\n')
+
 
 if __name__ == '__main__':
     main(sys.argv[1:])
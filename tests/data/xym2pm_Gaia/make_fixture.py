@@ -0,0 +1,68 @@
+"""
+Writes the synthetic ACS/WFC field used by test_python_xym2pm_Gaia.py and records the LNK and MAT files of xym2pm_Gaia.e for it.
+
+The Gaia stars are moved to the epoch of the image with their PMs, projected as xym2pm_Gaia does, and placed in the HST frame with a rotation, a scale change, an offset and 0.03 pixels of noise. 10% of the stars in the footprint are missing from the HST list, which also has faint sources without Gaia counterpart. Usage, from this directory:
+
+   python make_fixture.py ../../../Auxiliary/xym2pm_Gaia.e
+"""
+
+import os
+import sys
+import subprocess
+
+import numpy as np
+from astropy.io import fits
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+
+from download_data_edr3 import rd2xy
+
+ra0, dec0, pixel_scale = 201.70, -47.48, 0.05
+
+
+def make_field(path, n_gaia = 300, n_faint = 500, seed = 42):
+   rng = np.random.default_rng(seed)
+
+   ddec = rng.uniform(-130, 130, n_gaia)/3600.
+   dec = dec0 + ddec
+   ra = ra0 + rng.uniform(-130, 130, n_gaia)/3600./np.cos(np.radians(dec0))
+   era, edec = rng.uniform(0.05, 0.5, n_gaia), rng.uniform(0.05, 0.5, n_gaia)
+   pmra, pmdec = rng.normal(-3, 2, n_gaia), rng.normal(-6, 2, n_gaia)
+   epmra, epmdec = rng.uniform(0.05, 0.5, n_gaia), rng.uniform(0.05, 0.5, n_gaia)
+   gmag = np.round(rng.uniform(13, 20.5, n_gaia), 4)
+   gaia = np.c_[ra, era, dec, edec, pmra, epmra, pmdec, epmdec, gmag, np.ones(n_gaia)]
+   np.savetxt(path+'Gaia_jtest01_flc.ascii', gaia, fmt = ['%.10f', '%.5f', '%.10f', '%.5f', '%.5f', '%.5f', '%.5f', '%.5f', '%.4f', '%i'], header = 'ra ra_error dec dec_error pmra pmra_error pmdec pmdec_error gmag use_for_alignment')
+
+   # Master frame positions at 2015.5
+   u, v = rd2xy(ra, dec, ra0, dec0)
+   xpm = 5000. - u*3600./pixel_scale + pmra/1000./pixel_scale*0.5
+   ypm = 5000. + v*3600./pixel_scale - pmdec/1000./pixel_scale*0.5
+
+   theta, scale = np.radians(23.), 1.0003
+   X = (np.cos(theta)*(xpm-5000.) + np.sin(theta)*(ypm-5000.))/scale + 2085. + rng.normal(0, 0.03, n_gaia)
+   Y = (-np.sin(theta)*(xpm-5000.) + np.cos(theta)*(ypm-5000.))/scale + 1997. + rng.normal(0, 0.03, n_gaia)
+   m = gmag - 26.3 + rng.normal(0, 0.05, n_gaia)
+   q = rng.uniform(0.01, 0.25, n_gaia)
+   saturated = m < -11.5
+   m[saturated], q[saturated] = m[saturated] - 2.5, 0.
+   inside = (X > 0) & (X < 4096) & (Y > 0) & (Y < 4096) & (rng.uniform(size = n_gaia) > 0.1)
+
+   Xf, Yf = rng.uniform(0, 4096, n_faint), rng.uniform(0, 4096, n_faint)
+   mf, qf = rng.uniform(-5.5, -1., n_faint), rng.uniform(0.02, 0.5, n_faint)
+
+   XX, YY = np.r_[X[inside], Xf], np.r_[Y[inside], Yf]
+   hst = np.c_[XX, YY, np.r_[m[inside], mf], np.r_[q[inside], qf], XX, YY, np.r_[ra[inside], np.full(n_faint, ra0)], np.r_[dec[inside], np.full(n_faint, dec0)]]
+   np.savetxt(path+'jtest01_flc.XYmqxyrd', hst[rng.permutation(len(hst))], fmt = ['%8.3f', '%8.3f', '%7.3f', '%6.3f', '%8.3f', '%8.3f', '%13.8f', '%13.8f'])
+
+   # xym2pm_Gaia.e only reads the headers of the image
+   header = fits.Header([('INSTRUME', 'ACS'), ('DETECTOR', 'WFC'), ('DATE-OBS', '2015-07-02'), ('TIME-OBS', '00:00:00'), ('RA_TARG', ra0), ('DEC_TARG', dec0)])
+   sci_header = fits.Header([('CRVAL1', ra0 + 0.001), ('CRVAL2', dec0 - 0.001)])
+   fits.HDUList([fits.PrimaryHDU(header = header), fits.ImageHDU(header = sci_header, name = 'SCI')]).writeto(path+'jtest01_flc.fits', overwrite = True)
+
+
+if __name__ == '__main__':
+   path = os.path.dirname(os.path.abspath(__file__))+'/'
+   make_field(path)
+
+   bashCommand = "%s Gaia_jtest01_flc.ascii jtest01_flc.fits RACEN=%f DECEN=%f XCEN=5000.0 YCEN=5000.0 PSCL=%s SIZE=10000 DISP=5.0 NMIN=25 TIME=2015.5 USESAT+"%(os.path.abspath(sys.argv[1]), ra0, dec0, pixel_scale)
+   subprocess.run(bashCommand.split(), cwd = path, stdout = subprocess.DEVNULL, check = True)
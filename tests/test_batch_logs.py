@@ -0,0 +1,32 @@
+"""
+Tests of the log files of the targets run by --targets and --serve.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import download_data_edr3 as pipeline
+
+
+def test_log_stays_in_batch_logs():
+   for name in ['NGC 104', '../../outside', 'a/b', '..', '']:
+      filename = pipeline.batch_log_filename(name)
+      assert os.path.dirname(filename) == './batch_logs'
+      assert '/' not in os.path.basename(filename)
+      assert not os.path.basename(filename).startswith('.')
+
+   assert pipeline.batch_log_filename('NGC 104') == './batch_logs/NGC_104.log'
+
+
+def test_target_with_path_in_name(tmp_path, monkeypatch):
+   monkeypatch.chdir(tmp_path)
+   monkeypatch.setattr(pipeline, 'main', lambda argv: print('done'))
+   os.makedirs('batch_logs')
+
+   result = pipeline.run_target(('../outside', []))
+
+   assert result['status'] == 'done'
+   assert os.listdir(tmp_path/'batch_logs') == ['_outside.log']
+   assert sorted(os.listdir(tmp_path)) == ['batch_logs']
@@ -0,0 +1,168 @@
+"""
+Tests of download_HST_images against a local HTTP server: skipping of complete files, resume of partial downloads, size and MD5 mismatches and cancellation.
+"""
+
+import os
+import sys
+import hashlib
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import download_data_edr3 as pipeline
+
+
+class MASTHandler(BaseHTTPRequestHandler):
+   """
+   Serves the files of the server by their dataURI, honouring Range requests.
+   """
+
+   def do_GET(self):
+      uri = parse_qs(urlparse(self.path).query)['uri'][0]
+      content = self.server.files[uri]
+      self.server.requests.append((uri, self.headers.get('Range')))
+      time.sleep(self.server.delay)
+
+      start = 0
+      if self.headers.get('Range') is not None:
+         start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+         self.send_response(206)
+      else:
+         self.send_response(200)
+      self.send_header('Content-Length', str(len(content) - start))
+      self.end_headers()
+      self.wfile.write(content[start:])
+
+   def log_message(self, format, *args):
+      pass
+
+
+@pytest.fixture
+def server():
+   server = ThreadingHTTPServer(('127.0.0.1', 0), MASTHandler)
+   server.files, server.requests, server.delay = {}, [], 0.
+   thread = threading.Thread(target = server.serve_forever, daemon = True)
+   thread.start()
+   server.base_url = 'http://127.0.0.1:%i/download'%server.server_address[1]
+   yield server
+   server.shutdown()
+   server.server_close()
+
+
+def products(server, sizes):
+   """
+   Products table, as search_data_products_by_obs returns it, with random files of the given sizes in the server.
+   """
+
+   rows = []
+   for ii, size in enumerate(sizes):
+      uri = 'mast:HST/product/jtest%02i_flc.fits'%ii
+      server.files[uri] = os.urandom(size)
+      rows.append({'parent_obsid': 1000+ii, 'obs_id': 'jtest%02i'%ii, 'productFilename': 'jtest%02i_flc.fits'%ii, 'productSubGroupDescription': 'FLC', 'dataURI': uri, 'size': size})
+
+   return pd.DataFrame(rows)
+
+
+def local_path(path, product):
+   return str(path)+'/mastDownload/HST/'+product['obs_id']+'/'+product['productFilename']
+
+
+def test_complete_files_are_always_skipped(server, tmp_path):
+   table = products(server, [1000, 5000])
+   path = str(tmp_path)+'/'
+
+   statuses = []
+   for run in range(4):
+      records = pipeline.download_HST_images(table, path = path, base_url = server.base_url)
+      statuses.append(sorted(records.status))
+
+   assert statuses == [['COMPLETE', 'COMPLETE']] + [['SKIPPED', 'SKIPPED']]*3
+   assert len(server.requests) == 2
+
+
+def test_partial_downloads_are_resumed(server, tmp_path):
+   table = products(server, [10000])
+   product = table.iloc[0]
+   content = server.files[product['dataURI']]
+
+   os.makedirs(os.path.dirname(local_path(tmp_path, product)))
+   with open(local_path(tmp_path, product)+'.part', 'wb') as f:
+      f.write(content[:4000])
+
+   records = pipeline.download_HST_images(table, path = str(tmp_path)+'/', base_url = server.base_url)
+
+   assert list(records.status) == ['COMPLETE']
+   assert server.requests == [(product['dataURI'], 'bytes=4000-')]
+   with open(local_path(tmp_path, product), 'rb') as f:
+      assert f.read() == content
+   assert records.md5[0] == hashlib.md5(content).hexdigest()
+
+
+def test_size_mismatch_is_an_error(server, tmp_path):
+   table = products(server, [3000])
+   table['size'] = 4000
+
+   records = pipeline.download_HST_images(table, path = str(tmp_path)+'/', base_url = server.base_url)
+
+   assert list(records.status) == ['ERROR']
+   assert 'Size mismatch' in records.message[0]
+   assert not os.path.isfile(local_path(tmp_path, table.iloc[0]))
+
+
+def test_md5_mismatch_downloads_again(server, tmp_path):
+   table = products(server, [2000])
+   product = table.iloc[0]
+   path = str(tmp_path)+'/'
+
+   pipeline.download_HST_images(table, path = path, base_url = server.base_url)
+
+   # Same size, different content
+   with open(local_path(tmp_path, product), 'wb') as f:
+      f.write(b'0'*2000)
+
+   records = pipeline.download_HST_images(table, path = path, base_url = server.base_url)
+
+   assert list(records.status) == ['COMPLETE']
+   assert len(server.requests) == 2
+   with open(local_path(tmp_path, product), 'rb') as f:
+      assert f.read() == server.files[product['dataURI']]
+
+
+def test_no_products(tmp_path):
+   records = pipeline.download_HST_images(pd.DataFrame(columns = ['obs_id', 'productFilename', 'dataURI']), path = str(tmp_path)+'/')
+
+   assert len(records) == 0
+   assert (records.status != 'ERROR').sum() == 0
+
+
+def test_stop_cancels_pending_transfers(server, tmp_path):
+   table = products(server, [1000]*5)
+   server.delay = 0.2
+   stop = threading.Event()
+
+   records = pipeline.download_HST_images(table, path = str(tmp_path)+'/', n_transfers = 1, base_url = server.base_url, on_download = lambda record: stop.set(), stop = stop)
+
+   assert len(records) == 1
+   assert len(server.requests) < 5
+
+
+def test_pipeline_error_stops_downloads(server, tmp_path, monkeypatch):
+   def failing_prepare(*args, **kwargs):
+      raise RuntimeError('prepare failed')
+
+   monkeypatch.setattr(pipeline, 'prepare_xym2pm_Gaia', failing_prepare)
+   table = products(server, [1000]*5)
+   server.delay = 0.2
+   threads = threading.active_count()
+
+   with pytest.raises(RuntimeError):
+      pipeline.launch_HST_pipeline(pd.DataFrame(), table, None, str(tmp_path)+'/', 0, n_transfers = 1, base_url = server.base_url)
+
+   assert threading.active_count() == threads
+   assert len(server.requests) < 5
@@ -0,0 +1,58 @@
+"""
+Regression test of grouped_weighted_avg_err against the groupby-apply of weighted_avg_err it replaces.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import download_data_edr3 as pipeline
+
+
+def matches(n_stars = 60, seed = 1):
+   """
+   Matches of several images, as they are concatenated in launch_xym2pm_Gaia: stars found in one or several images, some columns with their _error column and some without, and missing values.
+   """
+
+   rng = np.random.default_rng(seed)
+
+   index = np.repeat(np.arange(n_stars)*7 + 3, rng.integers(1, 5, n_stars))
+   rng.shuffle(index)
+   n = len(index)
+
+   table = pd.DataFrame({'F606W': rng.normal(-10, 2, n), 'F606W_error': rng.uniform(0.01, 0.2, n),
+                         'relative_hst_gaia_pmra': rng.normal(0, 3, n), 'relative_hst_gaia_pmra_error': rng.uniform(0.1, 1, n),
+                         'gaia_ra_uncertaintity': rng.uniform(0.1, 1, n)}, index = pd.Index(index, name = 'source_id'))
+
+   for col in table.columns:
+      table.loc[rng.uniform(size = n) < 0.15, col] = np.nan
+
+   return table
+
+
+def test_same_output_as_groupby_apply():
+   table = matches()
+
+   assert (table.index.value_counts() == 1).any()
+   assert table.isnull().any().all()
+
+   expected = table.groupby(level = 0).apply(pipeline.weighted_avg_err)
+   result = pipeline.grouped_weighted_avg_err(table)
+
+   assert sorted(result.columns) == sorted(expected.columns)
+   pd.testing.assert_frame_equal(result[expected.columns], expected, check_exact = False, rtol = 1e-10, check_names = False)
+
+
+def test_single_image():
+   table = matches(n_stars = 20, seed = 2)
+   table = table[~table.index.duplicated()]
+
+   expected = table.groupby(level = 0).apply(pipeline.weighted_avg_err)
+   result = pipeline.grouped_weighted_avg_err(table)
+
+   assert sorted(result.columns) == sorted(expected.columns)
+   pd.testing.assert_frame_equal(result[expected.columns], expected, check_exact = False, rtol = 1e-10, check_names = False)
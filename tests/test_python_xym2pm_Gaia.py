@@ -0,0 +1,111 @@
+"""
+Comparison of python_xym2pm_Gaia with the LNK and MAT files written by xym2pm_Gaia.e for a synthetic ACS/WFC field. The field and the Fortran output are recorded in data/xym2pm_Gaia, see make_fixture.py there.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import download_data_edr3 as pipeline
+
+data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'xym2pm_Gaia')+'/'
+
+
+@pytest.fixture(scope = 'module')
+def matches():
+   gaia = np.loadtxt(data_path+'Gaia_jtest01_flc.ascii', ndmin = 2)
+   hst = pipeline.read_XYmqxyrd(data_path+'jtest01_flc.XYmqxyrd', save_binary = False)
+
+   lnk, mat = pipeline.python_xym2pm_Gaia(gaia, hst, 201.70, -47.48, 0.05, 'ACS', 'WFC', crval = (201.701, -47.481), max_separation = 5.0, min_stars_alignment = 25, use_sat = True)
+
+   fortran_lnk = pd.read_csv(data_path+'jtest01_flc.LNK', sep = r'\s+', comment = '#', header = None, names = pipeline.lnk_columns)
+   fortran_mat = np.loadtxt(data_path+'jtest01_flc.MAT', ndmin = 2)
+
+   return lnk, mat, fortran_lnk, fortran_mat
+
+
+def test_same_stars_are_linked(matches):
+   lnk, mat, fortran_lnk, fortran_mat = matches
+
+   assert len(lnk) == len(fortran_lnk)
+   assert ((lnk.xc_hst != 0).values == (fortran_lnk.xc_hst != 0).values).all()
+   np.testing.assert_array_equal(lnk[['xc_hst', 'yc_hst', 'm_hst', 'q_hst']].values.round(3), fortran_lnk[['xc_hst', 'yc_hst', 'm_hst', 'q_hst']].values.round(3))
+
+
+def test_positions_agree(matches):
+   lnk, mat, fortran_lnk, fortran_mat = matches
+
+   for columns, tolerance in [(['x_gaia', 'y_gaia', 'xpm_gaia', 'ypm_gaia'], 1e-4), (['dra_gaia', 'ddec_gaia'], 1e-5), (['xhst_gaia', 'yhst_gaia'], 0.01)]:
+      np.testing.assert_allclose(lnk[columns].values, fortran_lnk[columns].values, rtol = 0, atol = tolerance)
+
+
+def test_transformation_stars_agree(matches):
+   lnk, mat, fortran_lnk, fortran_mat = matches
+
+   # Pairs are identified by the positions of their stars in both frames.
+   pairs = set(map(tuple, mat[:, 0:4].round(2)))
+   fortran_pairs = set(map(tuple, fortran_mat[:, 0:4].round(2)))
+   assert len(pairs & fortran_pairs) >= 0.95*max(len(pairs), len(fortran_pairs))
+
+   common = np.array([tuple(row) in fortran_pairs for row in mat[:, 0:4].round(2)])
+   fortran_common = np.array([tuple(row) in pairs for row in fortran_mat[:, 0:4].round(2)])
+   order, fortran_order = np.lexsort(mat[common, 0:2].T[::-1]), np.lexsort(fortran_mat[fortran_common, 0:2].T[::-1])
+   np.testing.assert_allclose(mat[common][order, 6:10], fortran_mat[fortran_common][fortran_order, 6:10], rtol = 0, atol = 0.01)
+
+
+def image_files(path, filenames):
+   """
+   Copies the fixture to path, with the header keywords that xym2pm_Gaia reads from the image.
+   """
+   import shutil
+   from astropy.io import fits
+
+   for filename in filenames:
+      shutil.copy(data_path+filename, path/filename)
+   header = fits.getheader(data_path+'jtest01_flc.fits')
+   header['EXPEND'], header['FILTER1'], header['FILTER2'] = 57205.1, 'F606W', 'CLEAR2L'
+   fits.HDUList([fits.PrimaryHDU(header = header), fits.ImageHDU(header = fits.getheader(data_path+'jtest01_flc.fits', 1))]).writeto(path/'jtest01_flc.fits')
+
+   return [str(path/filename) for filename in ['Gaia_jtest01_flc.ascii', 'jtest01_flc.fits', 'jtest01_flc.LNK', 'jtest01_flc.MAT']]
+
+
+def test_failed_iteration_removes_previous_solution(tmp_path, monkeypatch):
+   filenames = image_files(tmp_path, ['Gaia_jtest01_flc.ascii', 'jtest01_flc.XYmqxyrd', 'jtest01_flc.LNK', 'jtest01_flc.MAT'])
+   np.save(pipeline.mat_binary_filename(filenames[3]), np.loadtxt(filenames[3]))
+
+   monkeypatch.setattr(pipeline, 'python_xym2pm_Gaia', lambda *args, **kwargs: (None, None))
+
+   match, mat = pipeline.xym2pm_Gaia(1, *filenames, 58000., False, 0.05, None, True, True, None, 25, False, True, False, matcher = 'python')
+
+   assert len(match) == 0
+   assert mat is None
+   for filename in ['jtest01_flc.LNK', 'jtest01_flc.MAT', 'jtest01_flc.MAT.npy']:
+      assert not os.path.isfile(tmp_path/filename)
+
+
+def test_mat_is_kept_in_memory(tmp_path, monkeypatch):
+   filenames = image_files(tmp_path, ['Gaia_jtest01_flc.ascii', 'jtest01_flc.XYmqxyrd'])
+   np.save(pipeline.xym2pm_Gaia_index_filename(filenames[0]), np.arange(len(np.loadtxt(filenames[0], ndmin = 2))))
+
+   match, mat = pipeline.xym2pm_Gaia(0, *filenames, 58000., False, 0.05, None, True, True, None, 25, False, True, False, matcher = 'python')
+
+   assert len(match) > 0
+   assert len(mat) > 25
+   assert not os.path.isfile(filenames[3]) and not os.path.isfile(pipeline.mat_binary_filename(filenames[3]))
+
+   python_xym2pm_Gaia, starting_mats = pipeline.python_xym2pm_Gaia, []
+   def spy(*args, **kwargs):
+      starting_mats.append(kwargs['mat'])
+      return python_xym2pm_Gaia(*args, **kwargs)
+   monkeypatch.setattr(pipeline, 'python_xym2pm_Gaia', spy)
+
+   match, next_mat = pipeline.xym2pm_Gaia(1, *filenames, 58000., False, 0.05, None, True, True, None, 25, False, True, False, matcher = 'python', previous_mat = mat)
+
+   assert starting_mats[0] is mat
+   assert len(match) > 0
+   assert not os.path.isfile(filenames[3]) and not os.path.isfile(pipeline.mat_binary_filename(filenames[3]))
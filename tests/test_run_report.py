@@ -0,0 +1,112 @@
+"""
+Tests of the run report and the profiling of targets that stop early, as they are run by the workers of --targets and --serve.
+"""
+
+import os
+import sys
+import json
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import download_data_edr3 as pipeline
+
+
+def failing_pipeline(args, context):
+   with pipeline.StageReport('failing_stage'):
+      pass
+   sys.exit(1)
+
+
+def fake_download(data_products, path, n_transfers, base_url, on_download = None, stop = None):
+   for index, product in data_products.iterrows():
+      on_download(dict(product, status = 'COMPLETE'))
+   return data_products.assign(status = 'COMPLETE')
+
+
+@pytest.fixture
+def hst_pipeline(tmp_path, monkeypatch):
+   """
+   launch_HST_pipeline with the downloads, hst1pass and xym2pm_Gaia replaced, which returns the stages recorded in the run report.
+   """
+   monkeypatch.setattr(pipeline, 'download_HST_images', fake_download)
+   monkeypatch.setattr(pipeline, 'prepare_xym2pm_Gaia', lambda table, *args, **kwargs: table)
+   monkeypatch.setattr(pipeline, 'write_xym2pm_Gaia_input', lambda *args, **kwargs: None)
+   monkeypatch.setattr(pipeline, 'hst1pass_xym2pm_Gaia_multiproc', lambda args: (pd.DataFrame(), None))
+   monkeypatch.setattr(pipeline, 'launch_xym2pm_Gaia', lambda table, *args, **kwargs: table)
+   monkeypatch.chdir(tmp_path)
+
+   data_products = pd.DataFrame({'productFilename': ['ja_flc.fits', 'jb_flc.fits', 'ja_drz.fits'], 'obs_id': ['ja', 'jb', 'ja'], 'productSubGroupDescription': ['FLC', 'FLC', 'DRZ']})
+
+   def run():
+      pipeline.start_run_report(str(tmp_path/'report'))
+      try:
+         pipeline.launch_HST_pipeline(pd.DataFrame({'HST_image': ['ja jb']}), data_products, None, str(tmp_path)+'/', 0)
+      finally:
+         report = pipeline.write_run_report(str(tmp_path/'report'))
+      return list(report.stage)
+
+   return run
+
+
+def target(name, *options):
+   return (name, ['--name', name, '--ra', '10', '--dec', '-20', '--non_interactive', 'True'] + list(options))
+
+
+@pytest.fixture
+def batch_path(tmp_path, monkeypatch):
+   monkeypatch.chdir(tmp_path)
+   monkeypatch.setattr(pipeline, 'run_pipeline', failing_pipeline)
+   os.makedirs('batch_logs')
+   return tmp_path
+
+
+def test_report_of_failed_target(batch_path):
+   result = pipeline.run_target(target('t1'))
+
+   assert result['status'] == 'failed'
+   assert pipeline.run_report_variable not in os.environ
+
+   reports = list(batch_path.glob('t1/*_run_report.json'))
+   assert len(reports) == 1
+   with open(reports[0]) as f:
+      assert [record['stage'] for record in json.load(f)] == ['failing_stage']
+
+
+def test_next_target_without_report(batch_path):
+   pipeline.run_target(target('t1'))
+   pipeline.run_target(target('t2', '--run_report', 'False'))
+
+   assert len(list(batch_path.glob('t2/*_run_report*'))) == 0
+   with open(list(batch_path.glob('t1/*_run_report.jsonl'))[0]) as f:
+      assert len(f.readlines()) == 1
+
+
+def test_profiling_stops_with_failed_target(batch_path):
+   pipeline.run_target(target('t1', '--profile', 'all'))
+
+   assert pipeline.profile_variable not in os.environ
+   assert len(list(batch_path.glob('t1/Profiles/failing_stage_*.prof'))) == 1
+
+   pipeline.run_target(target('t2'))
+
+   assert len(list(batch_path.glob('t1/Profiles/failing_stage_*.prof'))) == 1
+   assert len(list(batch_path.glob('t2/Profiles/*'))) == 0
+
+
+def test_hst_pipeline_stages(hst_pipeline):
+   assert sorted(hst_pipeline()) == ['download_HST_images', 'launch_hst1pass', 'launch_xym2pm_Gaia']
+
+
+def test_profiling_hst_pipeline_stages(hst_pipeline, tmp_path, capsys):
+   pipeline.start_profiling(['launch_xym2pm_Gaia', 'not_a_stage'], str(tmp_path)+'/')
+   try:
+      hst_pipeline()
+   finally:
+      pipeline.stop_profiling()
+
+   assert len(list(tmp_path.glob('launch_xym2pm_Gaia_*.prof'))) == 1
+   warnings = [line for line in capsys.readouterr().out.split('\n') if line.startswith('WARNING')]
+   assert len(warnings) == 1 and 'not_a_stage' in warnings[0]
@@ -0,0 +1,34 @@
+"""
+Tests of the validation of the jobs sent to the service started with --serve.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import download_data_edr3 as pipeline
+
+service_argv = ['--gaia_catalog', '/data/gaia', '--non_interactive', 'True', '--keep_gaia_session', 'True', '--use_parallel', 'False']
+
+
+def test_valid_job():
+   name, argv = pipeline.job_arguments({'name': 'NGC 104', 'distance': 4.5, 'keep_gaia_session': 'True'}, service_argv)
+
+   assert name == 'NGC 104'
+   assert argv == service_argv + ['--name', 'NGC 104', '--distance', '4.5', '--keep_gaia_session', 'True']
+
+
+@pytest.mark.parametrize('options', [{'serve': 8000}, {'targets': 'targets.csv'}, {'targets_n_processes': 4}, {'build_gaia_catalog': 'gaia.csv'},
+                                     {'gaia_catalog': '/tmp'}, {'n_processes': 64}, {'use_parallel': 'True'}, {'non_interactive': 'False'}, {'targets_n': 4}])
+def test_service_options_are_rejected(options):
+   with pytest.raises(ValueError, match = 'set by the service'):
+      pipeline.job_arguments(dict(name = 'NGC 104', **options), service_argv)
+
+
+def test_invalid_jobs():
+   for target in [{'ra': 10}, ['NGC 104'], {'name': 'NGC 104', 'not_an_option': 1}]:
+      with pytest.raises(ValueError):
+         pipeline.job_arguments(target, service_argv)